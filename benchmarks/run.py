@@ -0,0 +1,232 @@
+"""
+Jocker benchmarks, they run on any host using the local backend.
+
+    python -m benchmarks.run [--shape small] [--repeat 3] [--output FILE]
+
+Results are printed, or written to FILE, as JSON.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+
+from jocker import parser as jockerfile_parser
+from jocker.archive import copy_tree
+from jocker.parser import Jockerfile
+from jocker.backends.local import LocalBackend
+
+from .startup import STARTUP_PATHS, import_time
+from .synthetic import SHAPES, generate_shape, generate_base, \
+    generate_jockerfile, run_commands
+
+
+def timed(func, repeat, setup=None):
+    """Return the durations of repeat calls to func, setup isn't timed"""
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def result(name, durations, **params):
+    """Return a benchmark result entry"""
+    return {
+        'name': name,
+        'params': params,
+        'runs': durations,
+        'min': min(durations),
+        'median': statistics.median(durations),
+    }
+
+
+def local_backend(workdir, jailname=None):
+    """Return a local backend keeping everything under workdir"""
+    backend_class = type('BenchBackend', (LocalBackend,), {
+        'JAILS_DIR': os.path.join(workdir, 'jails'),
+        'BASE_DIR': os.path.join(workdir, 'bases'),
+        'CACHE_DIR': os.path.join(workdir, 'cache'),
+    })
+    return backend_class(jailname)
+
+
+def bench_parse(workdir, args):
+    """Parse a Jockerfile and evaluate the env of every command"""
+    path = generate_jockerfile(os.path.join(workdir, 'Jockerfile'), 'bench',
+                               commands=run_commands(args.commands))
+
+    # parsed commands are kept in workdir, the first run stores them
+    jockerfile_parser.PARSE_CACHE_DIR = os.path.join(workdir, 'parsed')
+
+    def parse():
+        jockerfile_parser.PARSE_CACHE.clear()
+        jockerfile = Jockerfile(path)
+        for command in jockerfile.commands:
+            jockerfile.env(jockerfile.index_of(command))
+
+    return [result('parse', timed(parse, args.repeat),
+                   commands=args.commands)]
+
+
+def bench_copy_tree(workdir, args):
+    """Copy a synthetic tree into a new and into an up to date dest"""
+    src = os.path.join(workdir, 'tree')
+    dest = os.path.join(workdir, 'tree-copy')
+    size = generate_shape(src, args.shape)
+
+    def clean():
+        shutil.rmtree(dest, ignore_errors=True)
+
+    results = [
+        result('copy_tree', timed(lambda: copy_tree(src, dest), args.repeat,
+                                  setup=clean),
+               shape=args.shape, bytes=size),
+        result('copy_tree_unchanged',
+               timed(lambda: copy_tree(src, dest), args.repeat),
+               shape=args.shape, bytes=size),
+    ]
+    clean()
+    return results
+
+
+def bench_build(workdir, args):
+    """Build and install a base FROM a synthetic base with an ADD"""
+    backend = local_backend(workdir)
+    size = generate_base(backend.BASE_DIR, 'synthetic', args.shape)
+    context = os.path.join(workdir, 'context')
+    size += generate_shape(context, args.shape)
+    path = generate_jockerfile(
+        os.path.join(workdir, 'Jockerfile'), 'bench', base='synthetic',
+        commands=['ADD {context} /code'.format(context=context)]
+    )
+    jockerfile = Jockerfile(path)
+
+    def build(cache):
+        return lambda: backend.build(jockerfile, install=True, cache=cache)
+
+    results = [result('build', timed(build(False), args.repeat),
+                      shape=args.shape, bytes=size)]
+    build(True)()
+    results.append(result('build_cached', timed(build(True), args.repeat),
+                          shape=args.shape, bytes=size))
+    return results
+
+
+def bench_create(workdir, args):
+    """Create a jail root from a synthetic base with each copy mode"""
+    backend = local_backend(workdir, jailname='bench')
+    size = generate_base(backend.BASE_DIR, 'synthetic', args.shape)
+
+    def clean():
+        shutil.rmtree(backend.jaildir(), ignore_errors=True)
+
+    results = []
+    for mode in ('copy', 'reflink', 'hardlink'):
+        results.append(result(
+            'create', timed(lambda: backend.clone_base('synthetic', mode),
+                            args.repeat, setup=clean),
+            shape=args.shape, bytes=size, mode=mode
+        ))
+    clean()
+    return results
+
+
+def bench_exec(workdir, args):
+    """Exec commands in a running jail one by one and in a session"""
+    backend = local_backend(workdir, jailname='bench')
+    os.makedirs(backend.jaildir(), exist_ok=True)
+
+    def execs():
+        for _ in range(args.execs):
+            backend.exec('true')
+
+    def session():
+        with backend.session() as session:
+            for _ in range(args.execs):
+                session.exec('true')
+
+    backend.start()
+    try:
+        return [
+            result('exec', timed(execs, args.repeat), execs=args.execs),
+            result('exec_session', timed(session, args.repeat),
+                   execs=args.execs),
+        ]
+    finally:
+        backend.stop()
+
+
+def bench_startup(workdir, args):
+    """Import the CLI paths in a new interpreter"""
+    return [result('startup', timed(lambda: import_time(module), args.repeat),
+                   module=module)
+            for module in sorted(STARTUP_PATHS)]
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'copy_tree': bench_copy_tree,
+    'create': bench_create,
+    'build': bench_build,
+    'exec': bench_exec,
+    'startup': bench_startup,
+}
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description='Jocker benchmarks')
+    argparser.add_argument('benchmarks', nargs='*',
+                           help='benchmarks to run: {names} (default all)'
+                           .format(names=', '.join(sorted(BENCHMARKS))))
+    argparser.add_argument('--shape', choices=sorted(SHAPES),
+                           default='small',
+                           help='synthetic trees shape (default small)')
+    argparser.add_argument('--repeat', type=int, default=3,
+                           help='runs of each benchmark (default 3)')
+    argparser.add_argument('--commands', type=int, default=1000,
+                           help='commands of the parsed Jockerfile')
+    argparser.add_argument('--execs', type=int, default=100,
+                           help='commands exec\'d in the jail')
+    argparser.add_argument('--workdir', help='directory for generated data')
+    argparser.add_argument('--output', help='write results to this file')
+    args = argparser.parse_args(argv)
+
+    names = args.benchmarks or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            argparser.error('unknown benchmark {name}'.format(name=name))
+
+    logging.getLogger('jocker').setLevel(logging.WARNING)
+    results = []
+    for name in names:
+        workdir = tempfile.mkdtemp(prefix='jocker-bench-', dir=args.workdir)
+        try:
+            results.extend(BENCHMARKS[name](workdir, args))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+CLI startup budget, fails if a CLI path imports modules it doesn't need or
+takes longer than the budget to import.
+
+    python -m benchmarks.startup [--budget 0.1] [--repeat 5]
+"""
+import sys
+import json
+import argparse
+import subprocess
+
+
+# module imported by each CLI path and the modules it must not import
+STARTUP_PATHS = {
+    # --help and argument parsing
+    'jocker.run': ['jinja2', 'tarfile', 'jocker.backends', 'jocker.commands'],
+    # thin client forwarding to the daemon
+    'jocker.daemon': ['jinja2', 'tarfile', 'jocker.backends',
+                      'jocker.commands', 'socketserver'],
+    # jocker run
+    'jocker.runner': ['jinja2', 'tarfile', 'concurrent.futures'],
+}
+
+PROBE = """
+import sys, json, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{'time': time.perf_counter() - started,
+                   'modules': sorted(sys.modules)}}))
+"""
+
+
+def import_time(module):
+    """
+    Import module in a new interpreter, return its import time and the
+    modules loaded once it's imported.
+    """
+    output = subprocess.check_output([sys.executable, '-c',
+                                      PROBE.format(module=module)])
+    probe = json.loads(output)
+    return probe['time'], probe['modules']
+
+
+def loaded(modules, names):
+    """Return the names, or their submodules, found in modules"""
+    return sorted(set(name for name in names for module in modules
+                      if module == name or module.startswith(name + '.')))
+
+
+def check(module, forbidden, budget, repeat):
+    """Return the best import time of module and the budget violations"""
+    times = []
+    for _ in range(repeat):
+        duration, modules = import_time(module)
+        times.append(duration)
+    errors = ['{module} imports {name}'.format(module=module, name=name)
+              for name in loaded(modules, forbidden)]
+    if min(times) > budget:
+        errors.append('{module} takes {time:.3f}s to import, budget is '
+                      '{budget:.3f}s'.format(module=module, time=min(times),
+                                             budget=budget))
+    return min(times), errors
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description='Jocker startup budget')
+    argparser.add_argument('--budget', type=float, default=0.1,
+                           help='seconds each CLI path may take to import '
+                                '(default 0.1)')
+    argparser.add_argument('--repeat', type=int, default=5,
+                           help='imports of each path, the fastest counts')
+    args = argparser.parse_args(argv)
+
+    failed = False
+    for module, forbidden in sorted(STARTUP_PATHS.items()):
+        duration, errors = check(module, forbidden, args.budget, args.repeat)
+        print('{module:<16} {time:.3f}s'.format(module=module, time=duration))
+        for error in errors:
+            print('  ' + error, file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Synthetic bases, build contexts and Jockerfiles for the benchmarks
+"""
+import os
+
+
+# name -> (files, file size, directory depth)
+SHAPES = {
+    'small': (5000, 4 * 1024, 4),
+    'large': (4, 256 * 1024 * 1024, 1),
+    'mixed': (1000, 64 * 1024, 3),
+}
+
+
+def generate_tree(path, files, size, depth, fanout=8):
+    """
+    Generate a tree of files with size bytes each spread over nested
+    directories of the given depth, returns the bytes written.
+    """
+    os.makedirs(path, exist_ok=True)
+    block = os.urandom(min(size, 1024 * 1024))
+    written = 0
+    for index in range(files):
+        parts = []
+        value = index
+        for _ in range(depth - 1):
+            parts.append('d{number}'.format(number=value % fanout))
+            value //= fanout
+        dirname = os.path.join(path, *parts)
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, 'f{index}'.format(index=index)),
+                  'wb') as content:
+            remaining = size
+            while remaining > 0:
+                chunk = block[:remaining]
+                content.write(chunk)
+                remaining -= len(chunk)
+        written += size
+    return written
+
+
+def generate_shape(path, shape):
+    """Generate a tree of one of the predefined SHAPES"""
+    files, size, depth = SHAPES[shape]
+    return generate_tree(path, files, size, depth)
+
+
+def generate_base(base_dir, name, shape, commands=()):
+    """
+    Generate an installed base, with its Jockerfile in etc like a built
+    base has.
+    """
+    path = os.path.join(base_dir, name)
+    written = generate_shape(path, shape)
+    generate_jockerfile(os.path.join(path, 'etc', 'Jockerfile'), name,
+                        commands=commands)
+    return written
+
+
+def generate_jockerfile(path, name, base=None, commands=()):
+    """Write a Jockerfile with NAME, an optional FROM and commands"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lines = ['NAME {name}'.format(name=name)]
+    if base:
+        lines.append('FROM {base}'.format(base=base))
+    lines.extend(commands)
+    with open(path, 'w') as content:
+        content.write('\n'.join(lines) + '\n')
+    return path
+
+
+def run_commands(count, envs=10):
+    """Return count RUN commands interleaved with envs ENV commands"""
+    commands = []
+    for index in range(count):
+        if envs and index % max(count // envs, 1) == 0:
+            commands.append('ENV VAR{index} value{index}'.format(index=index))
+        commands.append('RUN true')
+    return commands
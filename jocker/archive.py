@@ -1,35 +1,785 @@
+import io
+import os
+import sys
+import time
+import errno
 import shutil
 import logging
+import tempfile
+from stat import S_IFMT, S_ISDIR, S_ISLNK, S_ISREG
+from collections import deque
 
-import dirsync
+from . import trace
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def compress(dirname):
+# tarfile, the compression modules and the thread pool are imported where
+# they are used, they are slow to import and most commands never need them
+
+
+# Size of the blocks compressed in parallel by multi-threaded codecs
+BLOCK_SIZE = 4 * 1024 * 1024
+# Buffer size used to stream archives
+BUFFER_SIZE = 1024 * 1024
+# Threads used to copy file contents
+COPY_WORKERS = int(os.environ.get('JOCKER_COPY_WORKERS', 8))
+
+# File copy modes: plain copy, share extents with the source (falling back
+# to a copy), hardlink to the source (falling back to a copy) or the
+# cheapest of them
+COPY = 'copy'
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+CLONE = 'clone'
+
+# linux ioctl to share the extents of a file on btrfs, xfs, etc
+FICLONE = 0x40049409 if fcntl and sys.platform.startswith('linux') else None
+# renameat2 of libc, looked up on first use, and its arguments to swap
+# two paths
+RENAMEAT2 = None
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+# errors meaning the kernel copy is not possible between these files
+KERNEL_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                      errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY)
+
+logger = logging.getLogger('jocker')
+
+
+class BlockWriter(io.RawIOBase):
     """
-    Compress the directory into a .tar.gz file.
+    Writable stream that splits the data in blocks and compresses them on a
+    thread pool. Each block is an independent compressed member, codecs
+    using it must support concatenated members (gzip and xz do). At most
+    twice as many blocks as threads are kept in memory.
     """
-    return dirname
+    def __init__(self, fileobj, compress, threads, block_size=BLOCK_SIZE):
+        """Init writer, compress is called with each block"""
+        self.fileobj = fileobj
+        self.compress = compress
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.max_pending = threads * 2
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Buffer data and submit every full block"""
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        """Submit block for compression, flushing finished ones in order"""
+        self.pending.append(self.executor.submit(self.compress, block))
+        while len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress remaining data and wait for every block"""
+        if self.closed:
+            return
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        super(BlockWriter, self).close()
+
+
+class Codec(object):
+    """Base compression codec"""
+    name = None
+    extension = None
+    magic = None
+
+    def available(self):
+        """Return True if the codec can be used"""
+        return True
+
+    def writer(self, fileobj, threads=None):
+        """Return a writable stream compressing into fileobj"""
+        raise NotImplementedError('Implement in subclass')
+
+    def reader(self, fileobj):
+        """Return a readable stream decompressing fileobj"""
+        raise NotImplementedError('Implement in subclass')
+
+
+class GzipCodec(Codec):
+    """gzip codec, threaded compression writes one member per block"""
+    name = 'gzip'
+    extension = '.tar.gz'
+    magic = b'\x1f\x8b'
+
+    def writer(self, fileobj, threads=None):
+        import gzip
+        if threads and threads > 1:
+            return BlockWriter(fileobj, self.compress_block, threads)
+        return gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+    def compress_block(self, block):
+        """Compress block as an independent gzip member"""
+        import zlib
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush()
+
+    def reader(self, fileobj):
+        import gzip
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class XZCodec(Codec):
+    """xz codec, threaded compression writes one stream per block"""
+    name = 'xz'
+    extension = '.tar.xz'
+    magic = b'\xfd7zXZ\x00'
+
+    def writer(self, fileobj, threads=None):
+        import lzma
+        if threads and threads > 1:
+            return BlockWriter(fileobj, lzma.compress, threads)
+        return lzma.LZMAFile(fileobj, mode='wb')
+
+    def reader(self, fileobj):
+        import lzma
+        return lzma.LZMAFile(fileobj, mode='rb')
+
+
+class ZstdCodec(Codec):
+    """zstd codec, available if the zstandard package is installed"""
+    name = 'zstd'
+    extension = '.tar.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+
+    def available(self):
+        import importlib.util
+        return importlib.util.find_spec('zstandard') is not None
+
+    def writer(self, fileobj, threads=None):
+        import zstandard
+        compressor = zstandard.ZstdCompressor(threads=threads or 0)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def reader(self, fileobj):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj,
+                                                          closefd=False)
+
+
+CODECS = {
+    codec.name: codec for codec in (GzipCodec(), XZCodec(), ZstdCodec())
+}
+
 
+def get_codec(name):
+    """Return the codec registered with name"""
+    codec = CODECS.get(name)
+    if codec is None or not codec.available():
+        raise ValueError('Unsupported compression {name}'.format(name=name))
+    return codec
 
-def decompress(filename):
+
+def detect_codec(fileobj):
+    """
+    Return the codec used in the buffered fileobj, or None if the content
+    is not compressed. Only peeks at the stream.
+    """
+    head = fileobj.peek(8)
+    for codec in CODECS.values():
+        if head.startswith(codec.magic):
+            if not codec.available():
+                raise ValueError('Unsupported compression {name}'.format(
+                    name=codec.name
+                ))
+            return codec
+    return None
+
+
+def compress(dirname, filename=None, codec='gzip', threads=None,
+             checksums=False):
     """
-    Decompress the .tar.gz into a directory.
+    Compress the directory into a tar archive, filename can be a path or a
+    binary file object. The archive is streamed, files are never loaded
+    whole in memory. If checksums is set the sha256 of the files, computed
+    while they are read, is appended to the archive.
     """
+    import tarfile
+    from .tarstream import ChecksumTarFile
+    tar_class = ChecksumTarFile if checksums else tarfile.TarFile
+    codec = get_codec(codec)
+    if filename is None:
+        filename = dirname.rstrip('/') + codec.extension
+
+    if isinstance(filename, str):
+        fileobj = open(filename, 'wb')
+    else:
+        fileobj = filename
+
+    try:
+        stream = codec.writer(fileobj, threads=threads)
+        with tar_class.open(fileobj=stream, mode='w|', bufsize=BUFFER_SIZE,
+                            format=tarfile.PAX_FORMAT) as tar:
+            tar.add(dirname, arcname='.')
+            if checksums:
+                tar.add_checksums()
+        stream.close()
+        fileobj.flush()
+    finally:
+        if fileobj is not filename:
+            fileobj.close()
     return filename
 
 
-def copy_tree(src, dest):
-    """Copy the tree structure from src to dest"""
+def decompress(filename, dirname=None, checksums=False):
+    """
+    Decompress the tar archive into a directory, filename can be a path or
+    a binary file object, dirname is then required. The compression is
+    detected from the content. If checksums is set the files are hashed
+    while they are extracted and ValueError is raised unless they match
+    the checksums of the archive.
+    """
+    import tarfile
+    from .tarstream import ChecksumTarFile
+    tar_class = ChecksumTarFile if checksums else tarfile.TarFile
+    if isinstance(filename, str):
+        fileobj = open(filename, 'rb')
+        if dirname is None:
+            dirname = filename
+            for codec in CODECS.values():
+                if dirname.endswith(codec.extension):
+                    dirname = dirname[:-len(codec.extension)]
+            if dirname.endswith('.tar'):
+                dirname = dirname[:-len('.tar')]
+    elif dirname is None:
+        raise ValueError('A directory is required to decompress a stream')
+    else:
+        fileobj = filename
+
+    try:
+        stream = fileobj
+        if not hasattr(stream, 'peek'):
+            stream = io.BufferedReader(stream, buffer_size=BUFFER_SIZE)
+        codec = detect_codec(stream)
+        if codec:
+            stream = codec.reader(stream)
+        with tar_class.open(fileobj=stream, mode='r|',
+                            bufsize=BUFFER_SIZE) as tar:
+            if checksums:
+                extract_all(tar, dirname, members=tar.extract_members())
+                tar.verify()
+            else:
+                extract_all(tar, dirname)
+    finally:
+        if fileobj is not filename:
+            fileobj.close()
+    return dirname
+
+
+def extract_all(tar, dirname, members=None):
+    """
+    Extract tar into dirname keeping permissions, owners and special bits,
+    raise ValueError on a member that would leave dirname, see
+    checked_members
+    """
+    import tarfile
+    members = checked_members(tar if members is None else members)
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        # the members are checked, the filter only keeps their modes
+        tar.extractall(dirname, members=members, filter='fully_trusted')
+    else:
+        tar.extractall(dirname, members=members)
+
+
+def checked_members(members):
+    """
+    Yield the tar members, raise ValueError on absolute names, .. in names
+    or going through a symlink of the archive, hardlinks to anything else
+    than a file of the archive and relative symlinks pointing above the
+    root. Absolute symlinks are kept, they point inside the jail the tree
+    is the root of.
+    """
+    import posixpath
+    symlinks = set()
+
+    def check_path(name, path):
+        if posixpath.isabs(path) or '..' in path.split('/'):
+            raise ValueError('Archive member {name} leaves the tree: '
+                             '{path}'.format(name=name, path=path))
+        path = posixpath.normpath(path)
+        parent = posixpath.dirname(path)
+        while parent:
+            if parent in symlinks:
+                raise ValueError('Archive member {name} goes through the '
+                                 'symlink {parent}'.format(name=name,
+                                                           parent=parent))
+            parent = posixpath.dirname(parent)
+        return path
+
+    for tarinfo in members:
+        path = check_path(tarinfo.name, tarinfo.name)
+        if tarinfo.islnk():
+            target = check_path(tarinfo.name, tarinfo.linkname)
+            if target in symlinks:
+                raise ValueError('Archive member {name} links to the '
+                                 'symlink {target}'.format(name=tarinfo.name,
+                                                           target=target))
+        if tarinfo.issym():
+            target = tarinfo.linkname
+            if not posixpath.isabs(target):
+                target = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(path), target)
+                )
+                if target == '..' or target.startswith('../'):
+                    raise ValueError('Archive member {name} points outside '
+                                     'the tree: {target}'.format(
+                                         name=tarinfo.name,
+                                         target=tarinfo.linkname))
+            symlinks.add(path)
+        else:
+            symlinks.discard(path)
+        yield tarinfo
+
+
+class CopyStats(object):
+    """Counters of a copy operation"""
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.links = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def done(self):
+        """Mark the copy as finished"""
+        self.elapsed = time.monotonic() - self.started
+        return self
+
+    def throughput(self):
+        """Return copied bytes per second"""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return ('{files} files, {dirs} dirs, {links} links, {bytes} bytes '
+                '({skipped} unchanged) in {elapsed:.2f}s '
+                '({rate:.1f} MB/s)').format(
+                    files=self.files, dirs=self.dirs, links=self.links,
+                    bytes=self.bytes, skipped=self.skipped,
+                    elapsed=self.elapsed, rate=self.throughput() / 2 ** 20
+                )
+
+
+def scan_tree(src, ignore=None):
+    """
+    Walk src once yielding (relpath, path, stat) for each entry, a
+    directory is always yielded before its content. Symlinks are not
+    followed. If ignore is given it's called with the relpath and stat of
+    each entry and returns True to leave it out, ignored directories are
+    not walked.
+    """
+    stack = ['']
+    while stack:
+        relpath = stack.pop()
+        with os.scandir(os.path.join(src, relpath)) as entries:
+            for entry in entries:
+                entry_relpath = os.path.join(relpath, entry.name)
+                stat = entry.stat(follow_symlinks=False)
+                if ignore and ignore(entry_relpath, stat):
+                    continue
+                yield entry_relpath, entry.path, stat
+                if S_ISDIR(stat.st_mode):
+                    stack.append(entry_relpath)
+
+
+def merge_trees(srcs):
+    """
+    Merge the trees in srcs, later trees win, and return the
+    (relpath, path, stat) entries of the result in walk order. Every
+    destination path appears once, entries under a directory replaced by a
+    file in a later tree are dropped.
+    """
+    index = {}
+    order = []
+    # relpath -> last tree replacing it with something else than a directory
+    replaced = {}
+    for position, src in enumerate(srcs):
+        for relpath, path, stat in scan_tree(src):
+            if relpath not in index:
+                order.append(relpath)
+            elif not S_ISDIR(stat.st_mode):
+                replaced[relpath] = position
+            index[relpath] = (position, path, stat)
+
+    entries = []
+    for relpath in order:
+        position, path, stat = index[relpath]
+        if replaced and shadowed(relpath, position, replaced):
+            continue
+        entries.append((relpath, path, stat))
+    return entries
+
+
+def shadowed(relpath, position, replaced):
+    """
+    Return True if a parent of relpath was replaced by a tree after the
+    given position.
+    """
+    parent = os.path.dirname(relpath)
+    while parent:
+        if replaced.get(parent, -1) > position:
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+def reflink(src_fd, dest_fd):
+    """Clone the content of src_fd into dest_fd sharing extents"""
+    if FICLONE is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported')
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+
+def copy_range(src_fd, dest_fd, offset, length):
+    """
+    Copy length bytes at offset from src_fd to dest_fd inside the kernel
+    when possible, falling back to userspace buffers.
+    """
+    end = offset + length
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(src_fd, dest_fd, end - offset,
+                                            offset, offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError as error:
+            if error.errno not in KERNEL_COPY_ERRORS:
+                raise
+    if sys.platform.startswith('linux'):
+        # sendfile only accepts regular output files on linux
+        try:
+            os.lseek(dest_fd, offset, os.SEEK_SET)
+            while offset < end:
+                copied = os.sendfile(dest_fd, src_fd, offset, end - offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError as error:
+            if error.errno not in KERNEL_COPY_ERRORS:
+                raise
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    while offset < end:
+        chunk = os.read(src_fd, min(BUFFER_SIZE, end - offset))
+        if not chunk:
+            break
+        os.write(dest_fd, chunk)
+        offset += len(chunk)
+
+
+def data_segments(fd, size):
+    """
+    Return (offset, length) for the data segments of a sparse file, holes
+    are skipped.
+    """
+    segments = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                # only a hole is left
+                break
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        segments.append((start, end - start))
+        offset = end
+    return segments
+
+
+def is_sparse(stat):
+    """Return True if the file allocates less blocks than its size"""
+    return hasattr(os, 'SEEK_DATA') and \
+        getattr(stat, 'st_blocks', 0) * 512 < stat.st_size
+
+
+def unlink(path):
+    """Remove path if it exists, directories are removed recursively"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def link(src, dest):
+    """Replace dest with a hardlink to src, return False if not possible"""
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        unlink(dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            return False
+    except OSError:
+        return False
+    return True
+
+
+def copy_data(src, dest, stat, mode=COPY):
+    """
+    Copy the regular file src to dest with its metadata, returns the number
+    of bytes written. dest is replaced, never written in place, so files
+    hardlinked to it are left untouched.
+    """
+    if mode in (HARDLINK, CLONE) and link(src, dest):
+        return 0
+    unlink(dest)
+
+    written = stat.st_size
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          stat.st_mode & 0o777)
+        try:
+            if mode in (REFLINK, CLONE):
+                try:
+                    reflink(src_fd, dest_fd)
+                    written = 0
+                except OSError:
+                    pass
+            if not written:
+                # cloned, or nothing to copy
+                pass
+            elif is_sparse(stat):
+                for offset, length in data_segments(src_fd, stat.st_size):
+                    copy_range(src_fd, dest_fd, offset, length)
+                os.ftruncate(dest_fd, stat.st_size)
+            else:
+                copy_range(src_fd, dest_fd, 0, stat.st_size)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    copy_metadata(src, dest, stat)
+    return written
+
+
+def copy_metadata(src, dest, stat):
+    """Copy owner, permissions, flags and times from src to dest"""
+    if os.geteuid() == 0:
+        os.chown(dest, stat.st_uid, stat.st_gid, follow_symlinks=False)
+    shutil.copystat(src, dest, follow_symlinks=False)
+
+
+def unchanged(dest, stat):
+    """Return True if dest is already a copy of the file described by stat"""
+    try:
+        dest_stat = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    return S_IFMT(dest_stat.st_mode) == S_IFMT(stat.st_mode) and \
+        dest_stat.st_size == stat.st_size and \
+        dest_stat.st_mtime_ns == stat.st_mtime_ns
+
+
+def copy_entries(entries, dest, mode=COPY, workers=None, update=True):
+    """
+    Copy the (relpath, path, stat) entries into dest. Directories are
+    created in the walking thread while file contents are copied on a
+    thread pool. Hardlinks between copied files are preserved and, if
+    update is set, files that are already up to date in dest are skipped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    with trace.span('copy', 'copy', dest=dest) as span:
+        stats = CopyStats()
+        directories = []
+        hardlinks = {}
+        linked = []
+        pending = deque()
+        workers = workers or COPY_WORKERS
+
+        os.makedirs(dest, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for relpath, path, stat in entries:
+                target = os.path.join(dest, relpath)
+                if S_ISDIR(stat.st_mode):
+                    if not os.path.isdir(target) or os.path.islink(target):
+                        unlink(target)
+                        os.mkdir(target)
+                    directories.append((path, target, stat))
+                    stats.dirs += 1
+                elif S_ISLNK(stat.st_mode):
+                    if not (update and unchanged(target, stat)):
+                        unlink(target)
+                        os.symlink(os.readlink(path), target)
+                        copy_metadata(path, target, stat)
+                    stats.links += 1
+                elif S_ISREG(stat.st_mode):
+                    if stat.st_nlink > 1:
+                        inode = (stat.st_dev, stat.st_ino)
+                        if inode in hardlinks:
+                            linked.append((hardlinks[inode], target))
+                            continue
+                        hardlinks[inode] = target
+                    stats.files += 1
+                    if update and unchanged(target, stat):
+                        stats.skipped += 1
+                        continue
+                    if mode in (HARDLINK, CLONE) and link(path, target):
+                        # a link is cheaper than handing it to the pool
+                        continue
+                    pending.append(
+                        executor.submit(copy_data, path, target, stat, mode)
+                    )
+                    while len(pending) > workers * 64:
+                        stats.bytes += pending.popleft().result()
+                else:
+                    unlink(target)
+                    os.mknod(target, stat.st_mode, stat.st_rdev)
+                    copy_metadata(path, target, stat)
+            while pending:
+                stats.bytes += pending.popleft().result()
+
+        for first, target in linked:
+            if not (os.path.exists(target) and
+                    os.path.samefile(first, target)):
+                unlink(target)
+                os.link(first, target)
+
+        # set directory metadata once their content is in place
+        for path, target, stat in reversed(directories):
+            copy_metadata(path, target, stat)
+        span.set(files=stats.files, dirs=stats.dirs, bytes=stats.bytes,
+                 skipped=stats.skipped)
+
+    logger.debug('Copied {stats}'.format(stats=stats.done()))
+    return stats
+
+
+def copy_tree(src, dest, mode=COPY, workers=None):
+    """
+    Copy the tree structure from src to dest, dest is updated in place if
+    it exists.
+    """
+    stats = copy_entries(scan_tree(src), dest, mode=mode, workers=workers)
+    copy_metadata(src, dest, os.lstat(src))
+    return stats
+
+
+def copy_file(src, dest, mode=COPY):
+    """Copy the file src to dest, dest can be a directory"""
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    stat = os.stat(src)
+    if not unchanged(dest, stat):
+        copy_data(src, dest, stat, mode)
+    return dest
+
+
+def copy_up(path):
+    """
+    Give every file under path hardlinked to other files its own copy of
+    the data, returns the number of files copied. Trees hardlinked to a
+    base use it so that writes to them don't reach the base.
+    """
+    stat = os.lstat(path)
+    if S_ISDIR(stat.st_mode):
+        entries = scan_tree(path)
+    else:
+        entries = [(os.path.basename(path), path, stat)]
+
+    copied = 0
+    for relpath, filepath, stat in list(entries):
+        if S_ISREG(stat.st_mode) and stat.st_nlink > 1:
+            tmp = '{path}.copy-up'.format(path=filepath)
+            try:
+                copy_data(filepath, tmp, stat)
+                os.rename(tmp, filepath)
+            except BaseException:
+                unlink(tmp)
+                raise
+            copied += 1
+    return copied
+
+
+def stage_dir(target):
+    """
+    Return a new empty directory next to target, on the same filesystem,
+    to build the content that will replace it.
+    """
+    parent = os.path.dirname(target.rstrip('/'))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(
+        dir=parent, prefix='.{name}.'.format(name=os.path.basename(target))
+    )
+
+
+def exchange(src, dest):
+    """
+    Atomically swap the paths src and dest, return False if the platform
+    can't, only linux has renameat2 with RENAME_EXCHANGE
+    """
+    global RENAMEAT2
+    if not sys.platform.startswith('linux') or RENAMEAT2 is False:
+        return False
+    import ctypes
+    if RENAMEAT2 is None:
+        RENAMEAT2 = getattr(ctypes.CDLL(None, use_errno=True), 'renameat2',
+                            False)
+        if not RENAMEAT2:
+            return False
+    if RENAMEAT2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dest),
+                 RENAME_EXCHANGE) != 0:
+        code = ctypes.get_errno()
+        if code in (errno.ENOSYS, errno.EINVAL):
+            # old kernel or a filesystem without exchange support
+            return False
+        raise OSError(code, os.strerror(code), dest)
+    return True
+
+
+def publish_tree(staging, target):
+    """
+    Replace target with the staging directory. Where paths can be swapped
+    atomically target is either the old or the new tree at any time.
+    Otherwise target is moved aside then staging renamed in its place,
+    target is missing between these two renames and put back if the
+    second one fails.
+    """
+    if os.path.lexists(target) and exchange(staging, target):
+        # staging now holds the old tree
+        shutil.rmtree(staging, ignore_errors=True)
+        return
+    previous = None
+    if os.path.lexists(target):
+        previous = stage_dir(target)
+        os.rename(target, os.path.join(previous, 'tree'))
     try:
-        shutil.copytree(src, dest)
-    except (shutil.Error, FileExistsError):
-        logger = logging.getLogger('dirsync')
-        status_backup = logger.disabled
-        logger.disabled = True
-        dirsync.sync(src, dest, 'sync', verbose=False)
-        logger.disabled = status_backup
-
-
-def copy_file(src, dest):
-    """Copy the file src to dest"""
-    shutil.copy2(src, dest)
+        os.rename(staging, target)
+    except OSError:
+        if previous:
+            os.rename(os.path.join(previous, 'tree'), target)
+            os.rmdir(previous)
+        raise
+    if previous:
+        shutil.rmtree(previous, ignore_errors=True)
@@ -0,0 +1,179 @@
+"""
+asyncio jail runner
+"""
+import os
+import signal
+import asyncio
+import inspect
+import contextvars
+from subprocess import PIPE, CalledProcessError
+
+from ..commands import CommandEntrypoint
+from ..utils import CONTEXT, output_stream, error_stream
+from .base import BaseRunner
+
+
+# Size of the reads of command output, longer lines are passed in pieces
+READ_SIZE = 64 * 1024
+
+
+def write_output(stream, line):
+    """
+    Default output handler, copy the line to the stdout or stderr of the
+    context, the client ones when served by the daemon
+    """
+    output = output_stream() if stream == 'stdout' else error_stream()
+    output.write(line)
+    output.flush()
+
+
+async def in_thread(func, *args):
+    """Run func in the default executor with the context of the caller"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, contextvars.copy_context().run, func, *args
+    )
+
+
+async def run_command_async(command, env=None, timeout=None,
+                            on_output=write_output):
+    """
+    Run command as an async subprocess, a list is executed directly and a
+    string through the shell. Each output line is passed to
+    on_output(stream, line) as it arrives, lines longer than READ_SIZE in
+    pieces. The process is killed if the timeout expires or the task is
+    cancelled. Raise CalledProcessError if it fails.
+    """
+    context = CONTEXT.get()
+    kwargs = dict(stdout=PIPE, stderr=PIPE,
+                  env=dict(os.environ, **(env or {})),
+                  start_new_session=True)
+    if isinstance(command, str):
+        process = await asyncio.create_subprocess_shell(command, **kwargs)
+    else:
+        process = await asyncio.create_subprocess_exec(*command, **kwargs)
+    context.spawned(process.pid)
+
+    async def pump(reader, stream):
+        pending = b''
+        while True:
+            chunk = await reader.read(READ_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                on_output(stream, line + b'\n')
+            if len(pending) >= READ_SIZE:
+                on_output(stream, pending)
+                pending = b''
+        if pending:
+            on_output(stream, pending)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(pump(process.stdout, 'stdout'),
+                           pump(process.stderr, 'stderr'),
+                           process.wait()),
+            timeout
+        )
+    except BaseException:
+        if process.returncode is None:
+            # kill the whole group, children would keep the pipes open
+            os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+        raise
+    finally:
+        interrupted = context.reaped(process.pid)
+
+    if interrupted:
+        raise KeyboardInterrupt()
+    if process.returncode:
+        raise CalledProcessError(process.returncode, command)
+    return process.returncode
+
+
+async def await_result(result):
+    """Await result if the command returned an awaitable"""
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class AsyncRunner(BaseRunner):
+    """
+    Async runner context manager, starts the jail on enter and stops it on
+    exit. Commands are run with run_command_async so many jails can be
+    driven from one event loop.
+    """
+    def __init__(self, backend, timeout=None, on_output=write_output):
+        """Init runner, timeout applies to every command"""
+        super(AsyncRunner, self).__init__(backend, backend.jailname)
+        self.timeout = timeout
+        self.on_output = on_output
+
+    async def run(self, command, timeout=None, **env):
+        """Run a host command"""
+        return await run_command_async(command, env=dict(self.env, **env),
+                                       timeout=timeout or self.timeout,
+                                       on_output=self.on_output)
+
+    async def exec(self, command, timeout=None, **env):
+        """Exec command in the jail"""
+        return await self.run(self.backend.exec_command(command),
+                              timeout=timeout, **env)
+
+    async def bootstrap(self):
+        """Run the bootstrap commands of the jail Jockerfile"""
+        jockerfile = self.backend.jockerfile
+        for command in jockerfile.commands:
+            if not isinstance(command, CommandEntrypoint):
+                await await_result(command.run(self, jockerfile))
+        await in_thread(self.mounts.apply)
+
+    async def unbootstrap(self):
+        """Roll-back the bootstrap commands of the jail Jockerfile"""
+        jockerfile = self.backend.jockerfile
+        for command in reversed(jockerfile.commands):
+            if not isinstance(command, CommandEntrypoint):
+                await await_result(command.unrun(self, jockerfile))
+        await in_thread(self.mounts.apply)
+
+    async def __aenter__(self):
+        """Start jail upon enter"""
+        try:
+            await self.run(self.backend.start_command())
+        finally:
+            self.backend.state_changed()
+        return self
+
+    async def __aexit__(self, *args):
+        """Stop jail upon leave"""
+        try:
+            await self.run(self.backend.stop_command())
+        finally:
+            self.backend.state_changed()
+
+
+async def create(backend, jockerfile, network=None, timeout=None,
+                 on_output=write_output):
+    """Async version of Backend.create"""
+    await in_thread(lambda: backend.create_jail(jockerfile, network=network))
+    async with AsyncRunner(backend, timeout=timeout,
+                           on_output=on_output) as runner:
+        try:
+            for command in jockerfile.commands:
+                await await_result(command.create(runner, jockerfile))
+        finally:
+            await runner.unbootstrap()
+
+
+async def run(backend, command=None, timeout=None, on_output=write_output):
+    """Async version of Backend.run"""
+    command = backend.entrypoint(command)
+    async with AsyncRunner(backend, timeout=timeout,
+                           on_output=on_output) as runner:
+        await runner.bootstrap()
+        try:
+            return await await_result(command.run(runner, backend.jockerfile))
+        finally:
+            await runner.unbootstrap()
@@ -2,24 +2,55 @@
 Jail wrapper backend definition
 """
 import os
-import sys
 import uuid
+import shutil
 import tempfile
 import logging
+from types import MappingProxyType
 
+from .. import trace
 from ..commands import CommandEntrypoint
 from ..parser import build_command, Jockerfile
-from ..archive import copy_tree
+from ..archive import compress, decompress, copy_tree, copy_up, \
+    copy_entries, copy_metadata, merge_trees, stage_dir, publish_tree, \
+    COPY, REFLINK, HARDLINK, CLONE
+from ..cache import LayerCache
+from ..manifest import BUILD_META_DIR
+from ..store import ContentStore
+from ..mounts import MountManager
+from ..versions import BaseVersions, VERSIONS_DIR
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger('jocker')
-logger.setLevel(logging.DEBUG)
 
 
 class Backend(object):
     """Base backend definition"""
     BASE_DIR = os.environ.get('JOCKER_BASE_DIR', '/usr/jails/')
     JAILS_DIR = BASE_DIR
+    CACHE_DIR = os.environ.get('JOCKER_CACHE_DIR', '/var/cache/jocker/')
+    # how FROM bases are copied: copy, reflink, hardlink or clone
+    FROM_COPY_MODE = os.environ.get('JOCKER_FROM_COPY_MODE', 'copy')
+    # compare ADD sources by content too, not only by size and mtime
+    ADD_CONTENT_HASH = os.environ.get('JOCKER_ADD_CONTENT_HASH') == '1'
+    # run create commands in one shell session instead of a shell each,
+    # their stdin is then /dev/null since the session reads its commands
+    # from its own
+    PERSISTENT_EXEC = os.environ.get('JOCKER_PERSISTENT_EXEC') == '1'
+    # how jail roots are copied from their base: copy, reflink or
+    # hardlink, clone is reflink since jails write their files in place,
+    # unset lets the backend create them its own way
+    CREATE_COPY_MODE = os.environ.get('JOCKER_CREATE_COPY_MODE')
+    # directories of a jail hardlinked to its base that get their own copy,
+    # files elsewhere are shared with the base, its versions and the
+    # content store, a change made in place reaches all of them
+    CREATE_COPY_UP = os.environ.get('JOCKER_CREATE_COPY_UP',
+                                    'etc var root').split()
+    # jail roots are mounted read only outside CREATE_COPY_UP, required by
+    # hardlink copies so the jails can't write the shared files
+    CREATE_READ_ONLY = os.environ.get('JOCKER_CREATE_READ_ONLY') == '1'
+    # store installed bases files once in this content store, it must be
+    # on the BASE_DIR filesystem
+    STORE_DIR = os.environ.get('JOCKER_STORE_DIR')
 
     def __init__(self, jailname, base=None):
         """Backend initialization"""
@@ -49,12 +80,48 @@ class Backend(object):
         """Create jail"""
         raise NotImplementedError('Implement in subclass')
 
+    def template_dirs(self):
+        """Return the trees jail roots are made of below their base"""
+        return []
+
+    def clone_base(self, base, mode=None):
+        """
+        Create the jail root from the template trees and the installed base
+        with the given copy mode, CREATE_COPY_MODE by default. With
+        reflinks the jail shares the base data until it writes it, where
+        they aren't supported the files are copied. Hardlinks need
+        CREATE_READ_ONLY jails, only their CREATE_COPY_UP directories are
+        copied, see copy_up.
+        """
+        mode = mode or self.CREATE_COPY_MODE or COPY
+        if mode == CLONE:
+            mode = REFLINK
+        if mode == HARDLINK and not self.CREATE_READ_ONLY:
+            raise ValueError(
+                'Hardlinked jails share their files with base {base}, '
+                'they need JOCKER_CREATE_READ_ONLY=1 jails'.format(base=base)
+            )
+        jaildir = self.jaildir()
+        dirs = self.template_dirs() + [os.path.join(self.BASE_DIR, base)]
+        with trace.span('clone_base', 'create', base=base, mode=mode) as span:
+            stats = copy_entries(merge_trees(dirs), jaildir, mode=mode)
+            copy_metadata(dirs[-1], jaildir, os.lstat(dirs[-1]))
+            if mode == HARDLINK:
+                for path in self.CREATE_COPY_UP:
+                    path = os.path.join(jaildir, path.strip('/'))
+                    if os.path.lexists(path):
+                        copy_up(path)
+            span.set(files=stats.files, bytes=stats.bytes)
+        return stats
+
     def create(self, jockerfile, base=None, network=None):
         """Create jail and run create commands to bootstrap on it"""
         self.create_jail(jockerfile, base=base, network=network)
         with self.runner(create=True) as runner:
             for command in jockerfile.commands:
-                command.create(runner, jockerfile)
+                with trace.span(command.command_name(), 'create',
+                                command=command):
+                    command.create(runner, jockerfile)
 
     def start(self):
         """Start jail"""
@@ -68,62 +135,250 @@ class Backend(object):
         """Exec command in jail"""
         raise NotImplementedError('Implement in subclass')
 
-    def build(self, jockerfile, build=None, install=False):
+    def start_command(self):
+        """Return the command starting the jail"""
+        raise NotImplementedError('Implement in subclass')
+
+    def stop_command(self):
+        """Return the command stopping the jail"""
+        raise NotImplementedError('Implement in subclass')
+
+    def exec_command(self, command):
+        """Return the command running command in the jail"""
+        raise NotImplementedError('Implement in subclass')
+
+    def running(self):
+        """Return True if the jail is started"""
+        raise NotImplementedError('Implement in subclass')
+
+    def state_changed(self):
+        """Called once the jail was started or stopped"""
+        pass
+
+    def session(self):
+        """Return a persistent exec session in the started jail"""
+        raise NotImplementedError('Implement in subclass')
+
+    def store(self):
+        """Return the content store of installed bases, None if unset"""
+        if self.STORE_DIR:
+            return ContentStore(self.STORE_DIR)
+        return None
+
+    def build(self, jockerfile, build=None, install=False, cache=True):
         name = jockerfile.name()
 
         self.logger.info('Building jail base: {name}'.format(name=name))
 
-        commands = [
-            # ensure the Jockerfile is copied into the new jail
+        # ensure the Jockerfile is copied into the new jail, last so that
+        # FROM bases don't replace it and editing it keeps the layers of
+        # the unchanged commands
+        commands = jockerfile.commands + [
             build_command('ADD {path} /etc/'.format(path=jockerfile.path))
-        ] + jockerfile.commands
-
-        with tempfile.TemporaryDirectory() as tmp:
-            for command in commands:
-                command.build(self, tmp)
-            if build:
-                destpath = os.path.join(build, name)
-                copy_tree(tmp, destpath)
-                os.chmod(destpath, 0o755)
+        ]
+
+        keys = None
+        if cache:
+            keys = LayerCache(self.CACHE_DIR).keys(self, commands)
+            # an installed base built from the same layers is up to date
+            if install and not build and \
+                    self.installed_key(name) == keys[1][-1]:
+                self.logger.info('Jail base is up to date: {name}'.format(
+                    name=name
+                ))
+                return os.path.join(self.BASE_DIR, name)
+
+        targets = []
+        if install:
+            targets.append(os.path.join(self.BASE_DIR, name))
+        if build:
+            targets.append(os.path.join(build, name))
+        if not targets:
+            with tempfile.TemporaryDirectory() as tmp:
+                self.build_commands(commands, tmp, cache=cache, keys=keys)
+            return None
+
+        # stage on the filesystem of the first target so it can be
+        # published with a rename
+        staging = stage_dir(targets[0])
+        try:
+            key = self.build_commands(commands, staging, cache=cache,
+                                      keys=keys)
+            shutil.rmtree(os.path.join(staging, BUILD_META_DIR),
+                          ignore_errors=True)
+            os.chmod(staging, 0o755)
+            for target in targets[1:]:
+                clone = stage_dir(target)
+                try:
+                    # a real copy unless extents can be shared, hardlinks
+                    # would make the installed base change with it
+                    copy_tree(staging, clone, mode=REFLINK)
+                    publish_tree(clone, target)
+                except BaseException:
+                    shutil.rmtree(clone, ignore_errors=True)
+                    raise
             if install:
-                destpath = os.path.join(self.BASE_DIR, name)
-                copy_tree(tmp, destpath)
-                os.chmod(destpath, 0o755)
-            return tmp
-
-    def bootstrap_jail(self, runner):
+                self.install_base(staging, name, jockerfile.version())
+                if key:
+                    self.save_installed_key(name, key)
+            else:
+                publish_tree(staging, targets[0])
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return targets[0]
+
+    def installed_key_path(self, name):
+        """Return the path recording the layer key base name was built from"""
+        return os.path.join(self.CACHE_DIR, 'installed', name)
+
+    def installed_key(self, name):
+        """
+        Return the key of the last layer the installed base name was built
+        from, None if unknown or if the base was replaced since
+        """
+        try:
+            with open(self.installed_key_path(name), 'r') as content:
+                key, inode = content.read().split()
+            basedir = os.path.join(self.BASE_DIR, name)
+            if os.stat(basedir).st_ino == int(inode):
+                return key
+        except (FileNotFoundError, ValueError):
+            pass
+        return None
+
+    def save_installed_key(self, name, key):
+        """Record the key of the last layer of the installed base name"""
+        path = self.installed_key_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        inode = os.stat(os.path.join(self.BASE_DIR, name)).st_ino
+        with open(path + '.tmp', 'w') as content:
+            content.write('{key} {inode}'.format(key=key, inode=inode))
+        os.rename(path + '.tmp', path)
+
+    def versions(self, name):
+        """Return the stored versions of base name"""
+        return BaseVersions(os.path.join(self.BASE_DIR, VERSIONS_DIR, name))
+
+    def install_base(self, staging, name, version=None):
+        """
+        Replace the installed base name with the staging directory, it
+        must be on the BASE_DIR filesystem. If version is given the tree
+        is stored as that version of the base too.
+        """
+        # build directories keep their own copy, only the installed base
+        # is linked to the store
+        if self.STORE_DIR:
+            self.store().dedup(staging)
+        if version:
+            self.logger.info('Storing {name} version {version}'.format(
+                name=name, version=version
+            ))
+            self.versions(name).add(version, staging)
+        target = os.path.join(self.BASE_DIR, name)
+        publish_tree(staging, target)
+        return target
+
+    def export_base(self, name, fileobj, codec='gzip', threads=None):
+        """
+        Stream the installed base name as a compressed tar archive with
+        checksums into fileobj
+        """
+        self.logger.info('Exporting jail base: {name}'.format(name=name))
+        basedir = os.path.join(self.BASE_DIR, name)
+        if not os.path.isdir(basedir):
+            raise ValueError('No base {name} installed'.format(name=name))
+        with trace.span('export', 'archive', base=name):
+            compress(basedir, fileobj, codec=codec, threads=threads,
+                     checksums=True)
+
+    def import_base(self, fileobj, name=None):
+        """
+        Install the base streamed as an archive from fileobj, its files
+        are checked against the archive checksums while extracted. The
+        base is named after its Jockerfile unless name is given.
+        """
+        staging = stage_dir(os.path.join(self.BASE_DIR, name or 'import'))
+        try:
+            with trace.span('import', 'archive', base=name):
+                decompress(fileobj, staging, checksums=True)
+            path = os.path.join(staging, 'etc', 'Jockerfile')
+            version = None
+            if not name or os.path.exists(path):
+                jockerfile = Jockerfile(path)
+                name = name or jockerfile.name()
+                version = jockerfile.version()
+            self.logger.info('Importing jail base: {name}'.format(name=name))
+            return self.install_base(staging, name, version)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def build_commands(self, commands, destdir, cache=True, keys=None):
+        """
+        Build commands into destdir, return the key of the last layer if
+        cached
+        """
+        if cache:
+            return LayerCache(self.CACHE_DIR).build(self, commands, destdir,
+                                                    keys=keys)
+        for command in commands:
+            with trace.span(command.command_name(), 'build',
+                            command=command):
+                command.build(self, destdir)
+        return None
+
+    def bootstrap_commands(self, persistent=None):
+        """
+        Return the commands bootstraping the jail, only the persistent or
+        non persistent ones if persistent is set.
+        """
+        return [command for command in self.jockerfile.commands
+                if not isinstance(command, CommandEntrypoint) and
+                (persistent is None or command.persistent == persistent)]
+
+    def bootstrap_jail(self, runner, persistent=None):
         """Run any bootstraping command needed to run the jail"""
-        commands = [command for command in self.jockerfile.commands
-                    if not isinstance(command, CommandEntrypoint)]
+        commands = self.bootstrap_commands(persistent)
         returncode = 0
 
         for command in commands:
             if returncode:
                 break
-            returncode = command.run(runner, self.jockerfile)
+            with trace.span(command.command_name(), 'run', command=command):
+                returncode = command.run(runner, self.jockerfile)
+        runner.mounts.apply()
 
-    def unbootstrap_jail(self, runner):
+    def unbootstrap_jail(self, runner, persistent=None):
         """Roll-back any bootstraping command needed to run the jail"""
-        commands = [command for command in self.jockerfile.commands
-                    if not isinstance(command, CommandEntrypoint)]
+        commands = self.bootstrap_commands(persistent)
         returncode = 0
 
         for command in reversed(commands):
             if returncode:
                 break
-            returncode = command.unrun(runner, self.jockerfile)
-
-    def run(self, command=None):
-        """Run default commands or given one in started jail"""
+            with trace.span(command.command_name(), 'unrun',
+                            command=command):
+                returncode = command.unrun(runner, self.jockerfile)
+        runner.mounts.apply()
+
+    def run(self, command=None, runner=None):
+        """
+        Run default commands or given one in started jail, runner defaults
+        to one starting and stopping the jail
+        """
+        command = self.entrypoint(command)
+        with runner or self.runner() as runner:
+            with trace.span(command.command_name(), 'run', command=command):
+                command.run(runner, self.jockerfile)
+
+    def entrypoint(self, command=None):
+        """Return the given command as an ENTRYPOINT, or the default one"""
         if command:
-            command = build_command(
+            return build_command(
                 'ENTRYPOINT {command}'.format(command=command)
             )
-        else:
-            command = self.jockerfile.entrypoint()
-
-        with self.runner() as runner:
-            command.run(runner, self.jockerfile)
+        return self.jockerfile.entrypoint()
 
     def runner(self, create=False):
         """Return context runner"""
@@ -139,10 +394,29 @@ class BaseRunner(object):
         """Initialize context manager, jailname is needed"""
         self.jailname = jailname
         self.backend = backend
+        self.session = None
+        # environment of the commands run by this runner, it's never
+        # modified in place so it can be shared safely
+        self.env = MappingProxyType({})
+        # volumes mounted in the jail
+        self.mounts = MountManager(jailname)
+
+    def set_env(self, name, value):
+        """Set name in the runner environment"""
+        self.env = MappingProxyType(dict(self.env, **{name: value}))
+
+    def unset_env(self, name):
+        """Remove name from the runner environment"""
+        env = dict(self.env)
+        env.pop(name, None)
+        self.env = MappingProxyType(env)
 
     def exec(self, command, **kwargs):
         """Exec given command on current jail context"""
-        return self.backend.exec(command, **kwargs)
+        env = dict(self.env, **kwargs)
+        if self.session:
+            return self.session.exec(command, **env)
+        return self.backend.exec(command, **env)
 
     def __enter__(self):
         """Start jail upon enter"""
@@ -170,7 +444,17 @@ class RunRunner(BaseRunner):
 
 class CreateRunner(BaseRunner):
     """Creation runner context manager"""
+    def __enter__(self):
+        """Start jail and its exec session upon enter"""
+        super(CreateRunner, self).__enter__()
+        if self.backend.PERSISTENT_EXEC:
+            self.session = self.backend.session().start()
+        return self
+
     def __exit__(self, *args):
         """Stop jail upon leave"""
+        if self.session:
+            self.session.close()
+            self.session = None
         self.backend.unbootstrap_jail(self)
         super(CreateRunner, self).__exit__()
@@ -12,34 +12,59 @@ class EZJailBackend(JailBackend):
     JAILS_DIR = os.environ.get('JOCKER_JAILS_BASE_DIR', '/usr/jails/')
     BASE_DIR = os.environ.get('JOCKER_BASE_DIR', '/usr/jails/flavours/')
     DEFAULT_NETWORK = os.environ.get('JOCKER_DEFAULT_NETWORK', 'lo1|127.1.1.5')
+    # template every ezjail jail starts from, flavours are copied over it
+    NEWJAIL_DIR = os.environ.get('JOCKER_NEWJAIL_DIR',
+                                 os.path.join(JAILS_DIR, 'newjail'))
 
     def create_jail(self, jockerfile, base=None, network=None):
-        """Run ezjail create"""
+        """
+        Run ezjail create, with CREATE_COPY_MODE set the jail root is
+        cloned from the newjail template and the base first, as ezjail
+        does with a flavour, and ezjail only registers it
+        """
         base = base or jockerfile.name()
-        self.ezjail(
-            'create',
-            args='-f {base} {jailname} \'{network}\''.format(
-                base=base,
-                jailname=self.jailname,
-                network=network or self.DEFAULT_NETWORK
-            )
-        )
+        network = network or self.DEFAULT_NETWORK
+        if self.CREATE_COPY_MODE:
+            self.clone_base(base)
+            self.ezjail('create', args=['-x', self.jailname, network])
+        else:
+            self.ezjail('create', args=['-f', base, self.jailname, network])
         self.logger.info('Created jail: {name}'.format(name=self.jailname))
 
+    def template_dirs(self):
+        """Return the newjail template"""
+        return [self.NEWJAIL_DIR]
+
+    def start_command(self):
+        """Return the command starting the jail"""
+        return self.ezjail_command('start', args=[self.jailname])
+
+    def stop_command(self):
+        """Return the command stopping the jail"""
+        return self.ezjail_command('stop', args=[self.jailname])
+
     def start(self):
         """Start jail"""
-        return self.ezjail('start', args=self.jailname)
+        try:
+            return run_command(self.start_command())
+        finally:
+            self.state_changed()
 
     def stop(self):
         """Stop jail"""
-        return self.ezjail('stop', args=self.jailname)
+        try:
+            return run_command(self.stop_command())
+        finally:
+            self.state_changed()
+
+    def ezjail_command(self, command, args=None):
+        """
+        Return ezjail-admin command with args as an argument list
+        """
+        return ['ezjail-admin', command] + list(args or [])
 
     def ezjail(self, command, args=None, env=None):
         """
         Run ezjail-admin command with args
         """
-        return run_command(
-            'ezjail-admin {command}'.format(command=command),
-            args=args,
-            env=env
-        )
+        return run_command(self.ezjail_command(command, args=args), env=env)
@@ -4,35 +4,41 @@ jail wrapper
 import os
 
 from .base import Backend
+from .registry import registry
+from .session import ExecSession
 from ..utils import run_command
 
 
 class JailBackend(Backend):
     """Jail backend"""
     JAILS_DIR = os.environ.get('JOCKER_JAILS_BASE_DIR', '/usr/jails/')
+    registry = registry
+
+    def exec_command(self, command):
+        """Return the command running command in the jail"""
+        return ['jexec', self.jid(), 'sh', '-c', command]
 
     def exec(self, command, **kwargs):
         """Exec the given command in the jail"""
-        return self.jail(
-            'jexec {jid} sh -c \'{command}\''.format(
-                jid=self.jid(),
-                command=command
-            ),
-            env=kwargs
-        )
+        return self.jail(self.exec_command(command), env=kwargs)
+
+    def state_changed(self):
+        """Drop cached jail state"""
+        self.registry.invalidate()
+
+    def running(self):
+        """Return True if the jail is started"""
+        return self.registry.state(self.jailname) == 'running'
+
+    def session(self):
+        """Return a persistent exec session in the jail"""
+        return ExecSession(['jexec', self.jid(), '/bin/sh'])
 
     def jid(self):
         """
         Return jail JID for current jail
         """
-        cmd = '/usr/sbin/jls -j {jailname}'.format(jailname=self.jailname)
-        stdout = run_command(cmd, check=True)
-        line = stdout.split('\n')[1]
-        if not line:
-            raise ValueError(
-                'No jail {jailname} present'.format(jailname=self.jailname)
-            )
-        return line.strip().split(' ', 1)[0]
+        return self.registry.jid(self.jailname)
 
     def jail(self, command, args=None, env=None):
         """
@@ -0,0 +1,136 @@
+"""
+Local stand-in backend, for hosts without jails
+"""
+import os
+import sys
+import glob
+import signal
+import tempfile
+from subprocess import Popen, DEVNULL
+
+from ..utils import run_command
+from .jail import JailBackend
+from .registry import JailRegistry
+from .session import ExecSession
+
+
+LOCAL_DIR = os.path.join(tempfile.gettempdir(), 'jocker')
+
+# registries by jails directory
+REGISTRIES = {}
+
+
+class LocalBackend(JailBackend):
+    """
+    Local backend, a jail is a directory under JAILS_DIR that is running
+    while a placeholder process started for it is alive. Starting,
+    stopping, listing and exec'ing go through local processes so their
+    overhead is close to the real backends, but commands run on the host.
+    """
+    JAILS_DIR = os.environ.get('JOCKER_LOCAL_JAILS_DIR',
+                               os.path.join(LOCAL_DIR, 'jails'))
+    BASE_DIR = os.environ.get('JOCKER_LOCAL_BASE_DIR',
+                              os.path.join(LOCAL_DIR, 'bases'))
+
+    @property
+    def registry(self):
+        """Return the registry of the jails in JAILS_DIR"""
+        if self.JAILS_DIR not in REGISTRIES:
+            REGISTRIES[self.JAILS_DIR] = JailRegistry(
+                jls=self.local_command('jls')
+            )
+        return REGISTRIES[self.JAILS_DIR]
+
+    def local_command(self, action, *args):
+        """Return the command running action of this module"""
+        return [sys.executable, '-m', __name__, action, self.JAILS_DIR] + \
+            list(args)
+
+    def create_jail(self, jockerfile, base=None, network=None):
+        """Copy the base into the jail directory"""
+        self.clone_base(base or jockerfile.name())
+        self.logger.info('Created jail: {name}'.format(name=self.jailname))
+
+    def start_command(self):
+        """Return the command starting the jail"""
+        return self.local_command('start', self.jailname)
+
+    def stop_command(self):
+        """Return the command stopping the jail"""
+        return self.local_command('stop', self.jailname)
+
+    def start(self):
+        """Start jail"""
+        try:
+            return run_command(self.start_command())
+        finally:
+            self.state_changed()
+
+    def stop(self):
+        """Stop jail"""
+        try:
+            return run_command(self.stop_command())
+        finally:
+            self.state_changed()
+
+    def exec_command(self, command):
+        """Return the command running command, the jail must be running"""
+        self.jid()
+        return ['sh', '-c', command]
+
+    def session(self):
+        """Return a persistent exec session"""
+        self.jid()
+        return ExecSession(['/bin/sh'])
+
+
+def pidfile(jailsdir, name):
+    """Return the path of the placeholder process pid of jail name"""
+    return os.path.join(jailsdir, '.{name}.pid'.format(name=name))
+
+
+def running(path):
+    """Return the pid stored in path if that process is alive"""
+    try:
+        with open(path, 'r') as content:
+            pid = int(content.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+def jls(jailsdir, *params):
+    """Print the jid and name of running jails, like jls jid name"""
+    for path in glob.glob(pidfile(jailsdir, '*')):
+        pid = running(path)
+        if pid:
+            name = os.path.basename(path)[1:-len('.pid')]
+            print('{jid} {name}'.format(jid=pid, name=name))
+
+
+def start(jailsdir, name):
+    """Start the placeholder process of jail name"""
+    path = pidfile(jailsdir, name)
+    if running(path):
+        return
+    os.makedirs(jailsdir, exist_ok=True)
+    process = Popen(['sleep', '2147483647'], stdin=DEVNULL, stdout=DEVNULL,
+                    stderr=DEVNULL, start_new_session=True)
+    with open(path, 'w') as content:
+        content.write(str(process.pid))
+
+
+def stop(jailsdir, name):
+    """Stop the placeholder process of jail name"""
+    path = pidfile(jailsdir, name)
+    pid = running(path)
+    if pid:
+        os.kill(pid, signal.SIGTERM)
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    actions = {'jls': jls, 'start': start, 'stop': stop}
+    actions[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,75 @@
+"""
+Running jails registry
+"""
+import os
+import threading
+from subprocess import check_output
+
+
+class JailRegistry(object):
+    """
+    Name to JID map of the running jails. It's loaded with a single jls
+    call and kept until invalidated, backends invalidate it when they
+    start or stop a jail.
+    """
+    JLS = os.environ.get('JOCKER_JLS', '/usr/sbin/jls')
+
+    def __init__(self, jls=None):
+        """
+        Init registry, jls is the path to the jls command or a list of
+        arguments running an equivalent
+        """
+        self.jls = jls or self.JLS
+        self.lock = threading.Lock()
+        self._jails = None
+
+    def load(self):
+        """
+        Return name to JID map of running jails as listed by jls, raise
+        CalledProcessError if jls fails
+        """
+        jls = list(self.jls) if isinstance(self.jls, (list, tuple)) \
+            else [self.jls]
+        # run_command keeps only the tail of the output, merged with
+        # stderr, and doesn't check the status of captured commands, a
+        # failed jls would list no jail at all
+        stdout = check_output(jls + ['jid', 'name'],
+                              universal_newlines=True)
+        jails = {}
+        for line in stdout.splitlines():
+            values = line.split()
+            if len(values) == 2:
+                jid, name = values
+                jails[name] = jid
+        return jails
+
+    def jails(self):
+        """Return cached name to JID map of running jails"""
+        with self.lock:
+            if self._jails is None:
+                self._jails = self.load()
+            return self._jails
+
+    def invalidate(self):
+        """Drop cached state, it's loaded again on next access"""
+        with self.lock:
+            self._jails = None
+
+    def jid(self, name):
+        """Return the JID of the running jail name"""
+        jid = self.jails().get(name)
+        if jid is None:
+            # it might have been started by somebody else
+            self.invalidate()
+            jid = self.jails().get(name)
+        if jid is None:
+            raise ValueError('No jail {name} present'.format(name=name))
+        return jid
+
+    def state(self, name):
+        """Return the state of jail name, running or stopped"""
+        return 'running' if name in self.jails() else 'stopped'
+
+
+# registry shared by every backend and runner of this process
+registry = JailRegistry()
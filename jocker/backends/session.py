@@ -0,0 +1,125 @@
+"""
+Persistent exec sessions
+"""
+import os
+import uuid
+import shlex
+import threading
+from subprocess import Popen, PIPE, STDOUT, CalledProcessError, \
+    CompletedProcess
+
+from .. import trace
+from ..utils import output_stream
+
+
+# Size of the reads of the session output
+READ_SIZE = 64 * 1024
+
+
+class ExecSession(object):
+    """
+    Long lived shell that runs the commands sent over its stdin, saving a
+    process start per command. Each command runs in a subshell with its
+    own environment and a /dev/null stdin, its output is framed by a
+    marker line carrying the exit status. The marker is new for each
+    command, so output repeating an earlier one isn't taken for the end.
+    """
+    def __init__(self, argv, output=None):
+        """Init session, argv starts the shell that reads commands"""
+        self.argv = argv
+        self.output = output or output_stream()
+        self.marker = None
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the shell"""
+        self.process = Popen(self.argv, stdin=PIPE, stdout=PIPE,
+                             stderr=STDOUT, bufsize=0)
+        return self
+
+    def script(self, command, env):
+        """Return the shell script that runs command with env"""
+        exports = ''.join(
+            'export {name}={value}; '.format(name=name,
+                                             value=shlex.quote(str(value)))
+            for name, value in env.items()
+        )
+        return '( {exports}eval {command} ) </dev/null 2>&1; ' \
+               'echo "{marker} $?"\n'.format(
+                   exports=exports,
+                   command=shlex.quote(command),
+                   marker=self.marker.decode()
+               )
+
+    def exec(self, command, **env):
+        """
+        Run command in the session streaming its output, raise
+        CalledProcessError if it fails
+        """
+        with self.lock, trace.span('session_exec', 'command',
+                                   command=command):
+            if self.process is None or self.process.poll() is not None:
+                raise RuntimeError('Exec session is not running')
+            self.marker = 'JOCKER-{uuid}'.format(
+                uuid=uuid.uuid4().hex
+            ).encode()
+            self.process.stdin.write(self.script(command, env).encode())
+            returncode = self.read_output()
+        if returncode:
+            raise CalledProcessError(returncode, command)
+        return CompletedProcess(command, returncode)
+
+    def read_output(self):
+        """
+        Copy command output until the marker, return the status following
+        it. The output is read in chunks and forwarded as it comes, only
+        what could be the start of the marker is held back.
+        """
+        fd = self.process.stdout.fileno()
+        keep = len(self.marker) - 1
+        buffer = b''
+        while True:
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                raise RuntimeError('Exec session closed unexpectedly')
+            buffer += chunk
+            index = buffer.find(self.marker)
+            if index >= 0:
+                break
+            self.write(buffer[:-keep])
+            buffer = buffer[-keep:]
+
+        self.write(buffer[:index])
+        status = buffer[index + len(self.marker):]
+        while b'\n' not in status:
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                raise RuntimeError('Exec session closed unexpectedly')
+            status += chunk
+        return int(status.split(b'\n', 1)[0].strip())
+
+    def write(self, data):
+        """Write command output"""
+        if data:
+            self.output.write(data)
+            self.output.flush()
+
+    def close(self):
+        """Stop the shell"""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b'exit\n')
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,12 +1,20 @@
 """Jail backend utilities"""
+import os
+
 from .ezjail import EZJailBackend
+from .local import LocalBackend
 
 
 BACKENDS = {
-    'ezjail': EZJailBackend
+    'ezjail': EZJailBackend,
+    'local': LocalBackend
 }
 
 
-def get_backend(backend='ezjail', jailname=None):
-    """Return an instance of a given backend"""
+def get_backend(backend=None, jailname=None):
+    """
+    Return an instance of a given backend, JOCKER_BACKEND sets the default
+    one
+    """
+    backend = backend or os.environ.get('JOCKER_BACKEND', 'ezjail')
     return BACKENDS[backend](jailname)
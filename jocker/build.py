@@ -1,14 +1,124 @@
 """
 Build the given Jail base
 """
+import logging
+import contextvars
+
 from .parser import Jockerfile
+from .commands import CommandFrom, split_version
 from .backends.utils import get_backend
 
 
-def build(jockerfile='Jockerfile', build=None, install=False):
+logger = logging.getLogger('jocker')
+
+
+def build(jockerfile='Jockerfile', build=None, install=False, cache=True):
     """
     Build the base from the given Jockerfile.
     """
     jail_backend = get_backend()
     jockerfile = Jockerfile(jockerfile)
-    jail_backend.build(jockerfile, build=build, install=install)
+    jail_backend.build(jockerfile, build=build, install=install, cache=cache)
+
+
+def build_graph(jockerfiles):
+    """
+    Return a base name to (Jockerfile, parents) map of the bases defined by
+    jockerfiles, parents are the bases of the set named by its FROM
+    commands. Raise ValueError if a base is defined twice or if bases
+    depend on each other.
+    """
+    graph = {}
+    for path in jockerfiles:
+        jockerfile = Jockerfile(path)
+        name = jockerfile.name()
+        if name in graph:
+            raise ValueError('Base {name} defined by {first} and {second}'
+                             .format(name=name, first=graph[name][0].path,
+                                     second=path))
+        parents = set()
+        for command in jockerfile.filter_commands(CommandFrom):
+            parents.update(split_version(base)[0]
+                           for base in command.get_value())
+        graph[name] = (jockerfile, parents)
+
+    for name, (_, parents) in graph.items():
+        parents.intersection_update(graph)
+        parents.discard(name)
+
+    # walk the graph removing bases whose parents are all removed, what's
+    # left depends on itself
+    pending = {name: set(parents) for name, (_, parents) in graph.items()}
+    while pending:
+        ready = [name for name, parents in pending.items() if not parents]
+        if not ready:
+            raise ValueError('Dependency cycle between bases: {names}'
+                             .format(names=', '.join(sorted(pending))))
+        for name in ready:
+            del pending[name]
+        for parents in pending.values():
+            parents.difference_update(ready)
+    return graph
+
+
+def build_many(jockerfiles, build=None, install=False, cache=True, jobs=4):
+    """
+    Build the bases of jockerfiles in dependency order, a base is built
+    once the bases of the set it's FROM are installed and independent
+    bases are built in parallel, at most jobs at once. Bases whose inputs
+    didn't change since they were installed are skipped. A failed base
+    doesn't stop the bases that don't depend on it, returns a base name to
+    exception map of the failures, bases depending on a failed base fail
+    too.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, \
+        FIRST_COMPLETED
+
+    graph = build_graph(jockerfiles)
+    if not install and any(parents for _, parents in graph.values()):
+        raise ValueError('Bases are built FROM installed bases, building '
+                         'dependent bases needs install')
+
+    def build_base(name):
+        get_backend().build(graph[name][0], build=build, install=install,
+                            cache=cache)
+
+    waiting = {name: set(parents) for name, (_, parents) in graph.items()}
+    failures = {}
+
+    def fail(name, error):
+        """Record the failure of name and of the bases waiting for it"""
+        failures[name] = error
+        logger.error('Failed base: {name}: {error}'.format(name=name,
+                                                           error=error))
+        for child, parents in list(waiting.items()):
+            if name in parents and child in waiting:
+                del waiting[child]
+                fail(child, RuntimeError('Parent base {name} failed'.format(
+                    name=name
+                )))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while waiting or running:
+            for name in [name for name, parents in waiting.items()
+                         if not parents]:
+                del waiting[name]
+                # builds run with the context of the caller
+                running[executor.submit(contextvars.copy_context().run,
+                                        build_base, name)] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    fail(name, error)
+                else:
+                    for parents in waiting.values():
+                        parents.discard(name)
+                done = len(graph) - len(waiting) - len(running)
+                logger.info('Finished {done}/{total} bases, {failed} '
+                            'failed'.format(done=done, total=len(graph),
+                                            failed=len(failures)))
+    return failures
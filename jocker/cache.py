@@ -0,0 +1,360 @@
+"""
+Build layer cache
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+from stat import S_IFMT, S_ISDIR, S_ISREG
+
+from . import trace
+from .archive import scan_tree, copy_entries, copy_metadata, unlink, REFLINK
+
+
+logger = logging.getLogger('jocker')
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_path(path, digest=None, content=True, ignore=None):
+    """
+    Update digest with the content of path, directories are walked in a
+    stable order so the result only depends on names, modes and content.
+    If content is False, file sizes and mtimes are hashed instead of their
+    content. ignore leaves entries out as in scan_tree.
+    """
+    digest = digest or hashlib.sha256()
+    hasher = hash_file if content else hash_stat
+    if os.path.isfile(path):
+        hasher(path, digest)
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            if ignore:
+                relroot = os.path.relpath(root, path)
+                dirs[:] = kept_names(ignore, root, relroot, dirs)
+                files = kept_names(ignore, root, relroot, files)
+            dirs.sort()
+            for name in dirs:
+                dirpath = os.path.join(root, name)
+                if os.path.islink(dirpath):
+                    # symlinks to directories aren't walked, their target
+                    # is what they hold
+                    digest.update(os.path.relpath(dirpath, path).encode())
+                    digest.update(os.readlink(dirpath).encode())
+            for name in sorted(files):
+                filepath = os.path.join(root, name)
+                digest.update(os.path.relpath(filepath, path).encode())
+                if os.path.islink(filepath):
+                    digest.update(os.readlink(filepath).encode())
+                else:
+                    hasher(filepath, digest)
+    return digest
+
+
+def kept_names(ignore, root, relroot, names):
+    """Return the names of the root directory not ignored"""
+    return [name for name in names
+            if not ignore(os.path.normpath(os.path.join(relroot, name)),
+                          os.lstat(os.path.join(root, name)))]
+
+
+def hash_file(path, digest):
+    """Update digest with the mode and content of file at path"""
+    digest.update(str(os.stat(path).st_mode).encode())
+    with open(path, 'rb') as content:
+        for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def hash_stat(path, digest):
+    """Update digest with the mode, size and mtime of file at path"""
+    stat = os.stat(path)
+    digest.update('{mode} {size} {mtime}'.format(
+        mode=stat.st_mode, size=stat.st_size, mtime=stat.st_mtime_ns
+    ).encode())
+    return digest
+
+
+class LayerCache(object):
+    """
+    Cache the result of each build command as a layer, keyed on the command
+    text, its inputs and the key of the previous layer. A layer stores the
+    manifest of its whole tree but only the entries that changed since its
+    parent layer, so a build doesn't copy its whole tree at each layer.
+    """
+    # bytes the layers may take, the least recently used are removed first
+    MAX_SIZE = int(os.environ.get('JOCKER_CACHE_MAX_SIZE',
+                                  10 * 1024 * 1024 * 1024))
+
+    def __init__(self, cachedir):
+        """Init cache rooted at cachedir"""
+        self.cachedir = os.path.join(cachedir, 'layers')
+
+    def partial_key(self, command, previous=''):
+        """
+        Return the key of command on top of previous key, without its
+        inputs. Layers of different inputs share the partial key.
+        """
+        digest = hashlib.sha256()
+        digest.update(previous.encode())
+        digest.update(str(command).encode())
+        return digest.hexdigest()
+
+    def key(self, backend, command, previous=''):
+        """Return the cache key for command on top of previous key"""
+        digest = hashlib.sha256()
+        digest.update(self.partial_key(command, previous).encode())
+        for value in command.cache_inputs(backend):
+            digest.update(b'\0')
+            digest.update(value.encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        """Return the layer directory for key"""
+        return os.path.join(self.cachedir, key)
+
+    def has(self, key):
+        """Return True if a layer is stored for key"""
+        return os.path.exists(os.path.join(self.path(key), 'manifest.json'))
+
+    def latest(self, partial):
+        """Return the key of the last layer stored for partial key"""
+        try:
+            with open(self.path(partial) + '.latest', 'r') as latest:
+                key = latest.read().strip()
+        except FileNotFoundError:
+            return None
+        return key if self.has(key) else None
+
+    def manifest(self, key):
+        """
+        Return the relpath to (owner, type, mode, uid, gid, size, mtime)
+        records of the layer for key, owner is the layer storing the entry
+        """
+        with open(os.path.join(self.path(key), 'manifest.json'), 'r') \
+                as content:
+            return json.load(content)
+
+    def lock(self, operation):
+        """
+        Return the cache lock file taken with the flock operation, builds
+        share it while gc takes it exclusively
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        lockfile = open(os.path.join(self.cachedir, '.lock'), 'a')
+        try:
+            fcntl.flock(lockfile.fileno(), operation)
+        except BaseException:
+            lockfile.close()
+            raise
+        return lockfile
+
+    def store(self, key, srcdir, partial=None, parent=None):
+        """
+        Store the content of srcdir as the layer for key, and as the latest
+        layer for partial key. Only the directories and the entries that
+        differ from the parent layer are copied, the others are read from
+        the layers already storing them.
+        """
+        base = self.manifest(parent) if parent and self.has(parent) else {}
+        manifest = {}
+        stored = []
+        size = 0
+        for relpath, path, stat in scan_tree(srcdir):
+            record = [key, S_IFMT(stat.st_mode), stat.st_mode, stat.st_uid,
+                      stat.st_gid, stat.st_size, stat.st_mtime_ns]
+            current = base.get(relpath)
+            if not S_ISDIR(stat.st_mode) and current and \
+                    current[1:] == record[1:]:
+                manifest[relpath] = current
+                continue
+            manifest[relpath] = record
+            stored.append((relpath, path, stat))
+            if S_ISREG(stat.st_mode):
+                size += stat.st_size
+
+        os.makedirs(self.cachedir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.cachedir, prefix='.tmp-')
+        try:
+            layer = os.path.join(tmp, 'layer')
+            datadir = os.path.join(layer, 'data')
+            with trace.span('store', 'cache', key=key, bytes=size):
+                copy_entries(stored, datadir, mode=REFLINK, update=False)
+                copy_metadata(srcdir, datadir, os.lstat(srcdir))
+            with open(os.path.join(layer, 'meta.json'), 'w') as content:
+                json.dump({'parent': parent, 'size': size}, content)
+            with open(os.path.join(layer, 'manifest.json'), 'w') as content:
+                json.dump(manifest, content)
+            os.rename(layer, self.path(key))
+        except OSError:
+            # another build stored the same layer first
+            if not self.has(key):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if partial:
+            latest = self.path(partial) + '.latest'
+            with open(latest + '.tmp', 'w') as content:
+                content.write(key)
+            os.rename(latest + '.tmp', latest)
+
+    def restore(self, key, destdir):
+        """Restore the layer for key into destdir"""
+        with trace.span('restore', 'cache', key=key):
+            entries = []
+            for relpath, record in sorted(self.manifest(key).items()):
+                path = os.path.join(self.path(record[0]), 'data', relpath)
+                entries.append((relpath, path, os.lstat(path)))
+            copy_entries(entries, destdir, mode=REFLINK)
+            datadir = os.path.join(self.path(key), 'data')
+            copy_metadata(datadir, destdir, os.lstat(datadir))
+        # the layer was used, gc keeps the recently used layers
+        os.utime(self.path(key))
+
+    def gc(self, max_size=None):
+        """
+        Remove the least recently used layers, together with the layers
+        reading entries from them, until the layers take at most max_size
+        bytes, MAX_SIZE by default. Skipped if a build is running. Returns
+        the number of removed layers.
+        """
+        max_size = self.MAX_SIZE if max_size is None else max_size
+        if not os.path.isdir(self.cachedir):
+            return 0
+        try:
+            lockfile = self.lock(fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+
+        with lockfile:
+            layers = {}
+            for name in os.listdir(self.cachedir):
+                path = self.path(name)
+                if name.startswith('.tmp-'):
+                    # leftover of an interrupted store
+                    shutil.rmtree(path, ignore_errors=True)
+                elif name.startswith('.') or name.endswith('.latest'):
+                    continue
+                else:
+                    try:
+                        with open(os.path.join(path, 'meta.json'), 'r') \
+                                as content:
+                            meta = json.load(content)
+                    except (FileNotFoundError, NotADirectoryError,
+                            ValueError):
+                        # a layer of an older cache format
+                        shutil.rmtree(path, ignore_errors=True)
+                        continue
+                    layers[name] = (meta['parent'], meta['size'],
+                                    os.stat(path).st_mtime)
+
+            children = {}
+            for key, (parent, _, _) in layers.items():
+                children.setdefault(parent, []).append(key)
+
+            def subtree(key):
+                keys = [key]
+                for key in keys:
+                    keys.extend(children.get(key, []))
+                return keys
+
+            # a layer is in use as long as a layer reading from it is
+            used = {key: max(layers[child][2] for child in subtree(key))
+                    for key in layers}
+            total = sum(size for _, size, _ in layers.values())
+            removed = set()
+            for key in sorted(layers, key=used.get):
+                if total <= max_size:
+                    break
+                if key in removed:
+                    continue
+                for child in subtree(key):
+                    if child not in removed:
+                        removed.add(child)
+                        total -= layers[child][1]
+                        shutil.rmtree(self.path(child), ignore_errors=True)
+
+            for name in os.listdir(self.cachedir):
+                if name.endswith('.latest') and \
+                        self.latest(name[:-len('.latest')]) is None:
+                    unlink(self.path(name))
+
+        if removed:
+            logger.info('Removed {count} cache layers'.format(
+                count=len(removed)
+            ))
+        return len(removed)
+
+    def keys(self, backend, commands):
+        """Return the (partial keys, keys) of the layers of commands"""
+        keys = []
+        partials = []
+        key = ''
+        for command in commands:
+            partials.append(self.partial_key(command, key))
+            key = self.key(backend, command, key)
+            keys.append(key)
+        return partials, keys
+
+    def build(self, backend, commands, destdir, keys=None):
+        """
+        Build commands into destdir, restoring the last cached layer and
+        running only the commands after it. keys are the (partial keys,
+        keys) of the commands if already computed.
+        """
+        partials, keys = keys or self.keys(backend, commands)
+        # gc doesn't remove layers while they are used
+        with self.lock(fcntl.LOCK_SH):
+            self.build_layers(backend, commands, destdir, partials, keys)
+        self.gc()
+        return keys[-1] if keys else None
+
+    def build_layers(self, backend, commands, destdir, partials, keys):
+        """Build commands into destdir with the given layer keys"""
+        restored = -1
+        for index, command in enumerate(commands):
+            if command.layer and self.has(keys[index]):
+                restored = index
+
+        # an incremental command can start from its own stale output
+        # instead of the previous layer, and update it
+        stale = None
+        for index in range(restored + 1, len(commands)):
+            if commands[index].layer:
+                if commands[index].incremental:
+                    stale = self.latest(partials[index])
+                break
+
+        # layers are stored as changes to the tree they were built on
+        parent = None
+        if stale:
+            parent = stale
+            logger.info('Cache stale layer: {command}'.format(
+                command=commands[index]
+            ))
+            self.restore(stale, destdir)
+        elif restored >= 0:
+            parent = keys[restored]
+            self.restore(parent, destdir)
+
+        for index, command in enumerate(commands):
+            if index <= restored:
+                logger.info('Cache hit: {command}'.format(command=command))
+                if not command.layer:
+                    # replay commands without output for their side effects
+                    with trace.span(command.command_name(), 'build',
+                                    command=command, cached=True):
+                        command.build(backend, destdir)
+                continue
+            logger.info('Cache miss: {command}'.format(command=command))
+            with trace.span(command.command_name(), 'build',
+                            command=command):
+                command.build(backend, destdir)
+            if command.layer:
+                self.store(keys[index], destdir, partial=partials[index],
+                           parent=parent)
+                parent = keys[index]
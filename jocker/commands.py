@@ -4,30 +4,61 @@ Jockerfile commands
 
 import os
 import shutil
+import hashlib
+import logging
 
-from jinja2 import Environment, PackageLoader, select_autoescape
+from .archive import copy_file, copy_entries, copy_metadata, merge_trees
+from .cache import hash_path
+from .manifest import sync_tree, BUILD_META_DIR
+from .ignore import IgnoreRules
+from .utils import abspath
 
-from .archive import copy_tree, copy_file
-from .utils import run_command
 
+logger = logging.getLogger('jocker')
 
-JINJA_ENV = Environment(
-    loader=PackageLoader('jocker', 'templates'),
-    autoescape=select_autoescape(['sh'])
-)
+# Jinja2 environment of the script templates, created on first use since
+# importing jinja2 is slow
+JINJA_ENV = None
+
+
+def jinja_env():
+    """Return the Jinja2 environment of the script templates"""
+    global JINJA_ENV
+    if JINJA_ENV is None:
+        from jinja2 import Environment, PackageLoader, select_autoescape
+        JINJA_ENV = Environment(
+            loader=PackageLoader('jocker', 'templates'),
+            autoescape=select_autoescape(['sh'])
+        )
+    return JINJA_ENV
+
+
+def split_version(base):
+    """Split a name:version base reference, version is None if not given"""
+    if ':' in base:
+        return tuple(base.split(':', 1))
+    return base, None
 
 
 def base_name(commands):
     """Return base name defined by the NAME command"""
     commands = [command for command in commands
                 if isinstance(command, CommandName)]
-    return commands[0].get_value()
+    return split_version(commands[0].get_value())[0]
 
 
 class CommandBase(object):
     """
     Base class for commands that can be executed from a Jockerfile.
     """
+    # True if build() changes the files of the base being built
+    layer = False
+    # True if build() can update a stale copy of its own previous output
+    incremental = False
+    # True if run() changes the started jail itself rather than the runner,
+    # the change lasts until unrun() or the jail is stopped
+    persistent = False
+
     def __init__(self, value):
         """
         Init method, value is the whole content without the command.
@@ -64,6 +95,13 @@ class CommandBase(object):
         """
         return self.value
 
+    def cache_inputs(self, backend):
+        """
+        Return the values, besides the command text, that the build of this
+        command depends on.
+        """
+        return []
+
     def command_name(self):
         """
         Command name, this is derived from the class name, override if needed.
@@ -100,29 +138,60 @@ class CommandName(CommandNop):
     pass
 
 
+class CommandVersion(CommandNop):
+    """
+    VERSION command class.
+    """
+    pass
+
+
 class CommandFrom(CommandBase):
     """
     FROM command class.
     """
+    layer = True
+
     def get_value(self):
         """
         Split values since many bases can be specified.
         """
         return super(CommandFrom, self).get_value().split()
 
-    def base_dir(self, backend, name):
-        """Return an absolute path to an installed base"""
+    def base_dir(self, backend, name, version=None):
+        """
+        Return an absolute path to an installed base, or to the given
+        version of it, latest is the installed base
+        """
+        if version and version != 'latest':
+            return backend.versions(name).materialize(version)
         return os.path.join(backend.BASE_DIR, name)
 
+    def cache_inputs(self, backend):
+        """
+        Bases are identified by the mode, size and mtime of each of their
+        files, so a file changed in place invalidates the layer too.
+        """
+        inputs = []
+        for base_dir in self.base_dirs(backend):
+            inputs.append('{base} {digest}'.format(
+                base=base_dir,
+                digest=hash_path(base_dir, content=False).hexdigest()
+            ))
+        return inputs
+
+    def base_dirs(self, backend):
+        """Return the installed directories of the listed bases"""
+        return [self.base_dir(backend, *split_version(base))
+                for base in self.get_value()]
+
     def build(self, backend, destdir):
         """
-        Copy the content of the different bases into destdir
+        Copy the merged content of the different bases into destdir, each
+        file is written once from the last base defining it
         """
-        for base in self.get_value():
-            if ':' in base:
-                # TODO: deal with base versioning
-                base, version = base.split(':', 1)
-            copy_tree(self.base_dir(backend, base), destdir)
+        dirs = self.base_dirs(backend)
+        copy_entries(merge_trees(dirs), destdir, mode=backend.FROM_COPY_MODE)
+        copy_metadata(dirs[-1], destdir, os.lstat(dirs[-1]))
 
 
 class CommandEnv(CommandBase):
@@ -137,46 +206,23 @@ class CommandEnv(CommandBase):
 
     def run(self, runner, jockerfile):
         """
-        Run Env command
+        Run Env command, the value is set in the runner environment
         """
-        # TODO: return values instead of loading them in the os.environ
-        self.load_value()
+        name, value = self.get_value()
+        runner.set_env(name, value)
 
     def unrun(self, runner, jockerfile):
         """
-        Undo the env values load
-        """
-        # TODO: return values instead of loading them in the os.environ
-        self.unload_value()
-
-    def build(self, backend, destdir):
-        """
-        Build Env command
+        Undo the env value set
         """
-        # TODO: return values instead of loading them in the os.environ
-        self.load_value()
+        name, _ = self.get_value()
+        runner.unset_env(name)
 
     def create(self, runner, jockerfile):
         """
         Create Env command
         """
-        # TODO: return values instead of loading them in the os.environ
-        self.load_value()
-
-    def load_value(self):
-        """
-        Load value and set it in the environment
-        """
-        name, value = self.get_value()
-        os.environ[name] = value
-
-    def unload_value(self):
-        """
-        Unload value from the environment.
-        """
-        name, value = self.get_value()
-        if name in os.environ:
-            os.environ.pop(name)
+        self.run(runner, jockerfile)
 
 
 class CommandRun(CommandBase):
@@ -187,31 +233,66 @@ class CommandRun(CommandBase):
         """
         Run the command in the jail being created
         """
-        runner.exec(self.get_value(),
-                    **jockerfile.env(jockerfile.index_of(self)))
+        return runner.exec(self.get_value(),
+                           **jockerfile.env(jockerfile.index_of(self)))
 
 
 class CommandAdd(CommandBase):
     """
     ADD command class.
     """
+    layer = True
+    incremental = True
+
     def get_value(self):
         """
         Return stored value, splits value in src and dest pair.
         """
         return super(CommandAdd, self).get_value().split(' ', 2)
 
+    def cache_inputs(self, backend):
+        """
+        Hash of the content being added, or of its sizes and mtimes, and
+        the ignore patterns.
+        """
+        orig, _ = self.get_value()
+        orig = abspath(orig)
+        rules = IgnoreRules.load(orig)
+        inputs = [hash_path(orig, content=backend.ADD_CONTENT_HASH,
+                            ignore=rules and rules.ignore).hexdigest()]
+        if rules:
+            inputs.extend(rules.patterns)
+        return inputs
+
     def build(self, backend, destdir):
         """
-        Copy the content from value into dest inside the jail
+        Copy the content from value into dest inside the jail, leaving out
+        the entries of a directory matched by its .jockerignore
         """
         orig, dest = self.get_value()
         dest = self.ensure_dir(destdir, dest)
-        orig = os.path.abspath(orig)
+        orig = abspath(orig)
         if os.path.isfile(orig):
             copy_file(orig, dest)
         elif os.path.isdir(orig):
-            copy_tree(orig, dest)
+            rules = IgnoreRules.load(orig)
+            sync_tree(orig, dest, self.manifest_path(destdir, orig, dest),
+                      content_hash=backend.ADD_CONTENT_HASH,
+                      ignore=rules and rules.ignore)
+            if rules:
+                logger.info('ADD {orig}: {rules}'.format(orig=orig,
+                                                         rules=rules))
+
+    def manifest_path(self, destdir, orig, dest):
+        """
+        Return the path of the manifest of the last copy from orig into
+        dest, it's kept in the tree being built so it follows its layers.
+        """
+        name = hashlib.sha1('{orig}\0{dest}'.format(
+            orig=orig, dest=os.path.relpath(dest, destdir)
+        ).encode()).hexdigest()
+        return os.path.join(destdir, BUILD_META_DIR, 'manifests',
+                            name + '.json')
 
 
 class CommandEntrypoint(CommandBase):
@@ -222,14 +303,16 @@ class CommandEntrypoint(CommandBase):
         """
         Run the command in the started jail
         """
-        runner.exec(self.get_value(),
-                    **jockerfile.env(jockerfile.index_of(self)))
+        return runner.exec(self.get_value(),
+                           **jockerfile.env(jockerfile.index_of(self)))
 
 
 class CommandVolume(CommandBase):
     """
     VOLUME command class.
     """
+    persistent = True
+
     def get_value(self, runner=None):
         """
         Return stored value, splits value in src and dest pair.
@@ -237,45 +320,47 @@ class CommandVolume(CommandBase):
         orig, dest = super(CommandVolume, self).get_value().split(' ', 2)
         if runner:
             # Build absolute paths
-            orig = os.path.abspath(orig)
+            orig = abspath(orig)
             dest = os.path.join(runner.backend.jaildir(), dest.strip('/'))
         return (orig, dest)
 
     def run(self, runner, jockerfile):
         """
-        Mount volume on dest mountpoint
+        Want volume mounted on dest mountpoint, the runner mounts are
+        applied at once after the bootstrap
         """
-        self.mount(runner, jockerfile)
+        orig, dest = self.get_value(runner=runner)
+        runner.mounts.add(orig, dest)
 
     def unrun(self, runner, jockerfile):
         """
-        Umount volume on dest mountpoint
+        Don't want volume mounted anymore, the runner mounts are applied
+        at once after the unbootstrap
         """
-        self.umount(runner, jockerfile)
+        _, dest = self.get_value(runner=runner)
+        runner.mounts.remove(dest)
 
     def create(self, runner, jockerfile):
         """
-        Mount volume on dest mountpoint
+        Mount volume on dest mountpoint, later commands might use it
         """
         self.mount(runner, jockerfile)
 
     def mount(self, runner, jockerfile):
         """Volume mount"""
-        orig, dest = self.get_value(runner=runner)
-        return run_command(
-            'mount_nullfs {orig} {dest}'.format(orig=orig, dest=dest)
-        )
+        self.run(runner, jockerfile)
+        runner.mounts.apply()
 
     def umount(self, runner, jockerfile):
         """Volume umount"""
-        _, dest = self.get_value(runner=runner)
-        return run_command('umount {dest}'.format(dest=dest))
+        self.unrun(runner, jockerfile)
+        runner.mounts.apply()
 
 
 COMMANDS = {
     'author': CommandNop,
     'name': CommandName,
-    'version': CommandNop,
+    'version': CommandVersion,
     'from': CommandFrom,
     'env': CommandEnv,
     'run': CommandRun,
@@ -1,10 +1,17 @@
 """
 Create a jail from the given base
 """
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from .parser import parse, Jockerfile
 from .backends.utils import get_backend
 
 
+logger = logging.getLogger('jocker')
+
+
 def create_from_base(base, name=None, network=None):
     """
     Build a Jail from the given base.
@@ -21,3 +28,97 @@ def create_from_jockerfile(jockerfile, name=None, network=None):
     jockerfile = Jockerfile(jockerfile)
     jail_backend = get_backend(jailname=name)
     jail_backend.create(jockerfile, network=network)
+
+
+def batch(count, base=None, jockerfile=None, name=None, network=None):
+    """
+    Return the Jockerfile shared by a batch of count jails and the jail
+    name to network map of the batch
+    """
+    if base:
+        jockerfile = get_backend().base_jockerfile(base)
+    else:
+        jockerfile = Jockerfile(jockerfile or 'Jockerfile')
+    name = name or jockerfile.name()
+
+    jails = {}
+    for index in range(1, count + 1):
+        jailname = '{name}-{index}'.format(name=name, index=index)
+        jails[jailname] = network.format(index=index) if network else None
+    return jockerfile, jails
+
+
+def finished(jailname, error, done, count, failures):
+    """Record the end of the creation of jailname and log the progress"""
+    if error is not None:
+        failures[jailname] = error
+        logger.error('Failed jail: {name}: {error}'.format(name=jailname,
+                                                           error=error))
+    logger.info('Finished {done}/{total} jails, {failed} failed'.format(
+        done=done, total=count, failed=len(failures)
+    ))
+
+
+def create_many(count, base=None, jockerfile=None, name=None, network=None,
+                concurrency=4):
+    """
+    Create count jails from the given base or Jockerfile, running at most
+    concurrency creations at once. Jails are named <name>-<index>, and
+    {index} in network is replaced by the jail index. A failed jail
+    doesn't stop the others, returns a jailname to exception map of the
+    failures.
+    """
+    jockerfile, jails = batch(count, base=base, jockerfile=jockerfile,
+                              name=name, network=network)
+
+    def create(jailname):
+        logger.info('Creating jail: {name}'.format(name=jailname))
+        get_backend(jailname=jailname).create(jockerfile,
+                                              network=jails[jailname])
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # creations run with the context of the caller
+        futures = {executor.submit(contextvars.copy_context().run, create,
+                                   jailname): jailname
+                   for jailname in jails}
+        for done, future in enumerate(as_completed(futures), 1):
+            finished(futures[future], future.exception(), done, count,
+                     failures)
+    return failures
+
+
+def create_many_async(count, base=None, jockerfile=None, name=None,
+                      network=None, concurrency=4, timeout=None):
+    """
+    Like create_many, but the jails are driven from one event loop, their
+    commands run as async subprocesses streaming their output, each one
+    killed if it runs longer than timeout seconds.
+    """
+    import asyncio
+    from .backends import aio
+    jockerfile, jails = batch(count, base=base, jockerfile=jockerfile,
+                              name=name, network=network)
+
+    async def create_all():
+        slots = asyncio.Semaphore(concurrency)
+
+        async def create(jailname):
+            async with slots:
+                logger.info('Creating jail: {name}'.format(name=jailname))
+                try:
+                    await aio.create(get_backend(jailname=jailname),
+                                     jockerfile, network=jails[jailname],
+                                     timeout=timeout)
+                except Exception as error:
+                    return jailname, error
+                return jailname, None
+
+        failures = {}
+        tasks = [create(jailname) for jailname in jails]
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            jailname, error = await task
+            finished(jailname, error, done, count, failures)
+        return failures
+
+    return asyncio.run(create_all())
@@ -0,0 +1,239 @@
+"""
+Jocker daemon, serves the command line over a Unix socket so parsed
+Jockerfiles, jail state and imported modules are kept between calls.
+
+A client sends one JSON line with its argv and working directory, along
+with its stdin, stdout and stderr file descriptors, and gets back a JSON
+line with the exit status once the command finished. Commands write to
+the client streams directly. Settings come from the daemon environment.
+A client closing the connection, on Ctrl-C, interrupts its command.
+"""
+import os
+import sys
+import json
+import socket
+import logging
+
+
+SOCKET = os.environ.get('JOCKER_SOCKET', '/var/run/jocker/jocker.sock')
+# bytes read at most for a request line
+MAX_REQUEST = 64 * 1024
+# command line arguments that are paths relative to the client directory,
+# - stands for a client stream
+PATH_ARGS = ('jockerfile', 'build', 'output', 'archives')
+
+logger = logging.getLogger('jocker')
+
+
+def forward(argv, path=None):
+    """
+    Run argv in the daemon listening on path, return its exit status or
+    None if no daemon is running or it can't be reached.
+    """
+    path = path or SOCKET
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+    except PermissionError:
+        client.close()
+        sys.stderr.write('Cannot connect to the jocker daemon at {path}: '
+                         'permission denied, running without it\n'.format(
+                             path=path))
+        return None
+
+    with client:
+        try:
+            request = json.dumps({'argv': argv, 'cwd': os.getcwd()})
+            socket.send_fds(client, [request.encode() + b'\n'], [0, 1, 2])
+            with client.makefile('rb') as response:
+                line = response.readline()
+        except KeyboardInterrupt:
+            # closing the connection interrupts the command in the daemon
+            return 130
+    if not line:
+        raise RuntimeError('Jocker daemon closed the connection')
+    return json.loads(line)['status']
+
+
+class ContextHandler(logging.Handler):
+    """Log handler writing to the log stream of the request being served"""
+    def emit(self, record):
+        from .utils import CONTEXT
+        log = CONTEXT.get().log
+        if log is not None:
+            try:
+                os.write(log, (self.format(record) + '\n').encode())
+            except OSError:
+                pass
+
+
+def client_path(cwd, path):
+    """Return path relative to the client directory cwd as absolute"""
+    return path if path == '-' else os.path.join(cwd, path)
+
+
+def watch_client(client, context):
+    """
+    Cancel context once the client closes its connection, it sends nothing
+    after its request. Return a function ending the watch.
+    """
+    import select
+    import threading
+    wakeup, done = os.pipe()
+
+    def watch():
+        poller = select.poll()
+        poller.register(client, select.POLLIN)
+        poller.register(wakeup, select.POLLIN)
+        if wakeup not in [fd for fd, event in poller.poll()]:
+            logger.info('Client left, interrupting its command')
+            context.cancel()
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+
+    def stop():
+        os.write(done, b'\0')
+        thread.join()
+        os.close(wakeup)
+        os.close(done)
+    return stop
+
+
+def execute_request(request, fds, parser, client=None):
+    """
+    Run the command line of request with the client working directory and
+    streams, return its exit status. The command is interrupted if the
+    client socket is given and gets closed.
+    """
+    import traceback
+    from .utils import CONTEXT, Context
+
+    cwd = request['cwd']
+    args = parser.parse_args(request['argv'])
+    for name in PATH_ARGS:
+        value = getattr(args, name, None)
+        if isinstance(value, list):
+            setattr(args, name, [client_path(cwd, path) for path in value])
+        elif value:
+            setattr(args, name, client_path(cwd, value))
+
+    stdin, stdout, stderr = fds
+    log = stderr if getattr(args, 'log_stderr', False) else stdout
+    context = Context(cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr,
+                      log=log, cancellable=True)
+    token = CONTEXT.set(context)
+    stop = watch_client(client, context) if client else None
+    try:
+        args.func(args)
+        return 0
+    except SystemExit as error:
+        if error.code is None or isinstance(error.code, int):
+            return error.code or 0
+        os.write(stderr, '{message}\n'.format(message=error.code).encode())
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    except Exception:
+        os.write(stderr, traceback.format_exc().encode())
+        return 1
+    finally:
+        if stop:
+            stop()
+        CONTEXT.reset(token)
+
+
+def listening(path):
+    """Return True if a daemon is listening on path"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+
+def serve(parser, path=None, concurrency=4):
+    """
+    Serve the command line parsed by parser on the Unix socket path,
+    running at most concurrency commands at once, the others wait.
+    """
+    import signal
+    import threading
+    import socketserver
+
+    path = path or SOCKET
+    slots = threading.BoundedSemaphore(concurrency)
+
+    class RequestHandler(socketserver.BaseRequestHandler):
+        """Serve a client request"""
+        def handle(self):
+            data, fds, _, _ = socket.recv_fds(self.request, MAX_REQUEST, 3)
+            status = 1
+            try:
+                while not data.endswith(b'\n'):
+                    chunk = self.request.recv(MAX_REQUEST)
+                    if not chunk:
+                        return
+                    data += chunk
+                request = json.loads(data)
+                if len(fds) != 3:
+                    raise ValueError('Expected stdin, stdout and stderr')
+                logger.info('Request: {argv}'.format(argv=request['argv']))
+                with slots:
+                    status = execute_request(request, fds, parser,
+                                             client=self.request)
+            except Exception as error:
+                logger.error('Failed request: {error}'.format(error=error))
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            try:
+                self.request.sendall(
+                    json.dumps({'status': status}).encode() + b'\n'
+                )
+            except BrokenPipeError:
+                # the client left
+                pass
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    if os.path.exists(path):
+        if listening(path):
+            raise RuntimeError('A jocker daemon is already listening on '
+                               '{path}'.format(path=path))
+        os.unlink(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    handler = ContextHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logger.addHandler(handler)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+    # the socket is created with the umask, only the owner may connect
+    # from the start
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, RequestHandler)
+    finally:
+        os.umask(umask)
+    logger.info('Listening on {path}'.format(path=path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        logger.removeHandler(handler)
+
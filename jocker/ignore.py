@@ -0,0 +1,146 @@
+"""
+.jockerignore patterns for ADD
+"""
+import os
+import re
+from stat import S_ISDIR, S_ISREG
+
+
+# file listing the patterns of the entries ADD leaves out of a directory
+IGNORE_FILE = '.jockerignore'
+
+
+def translate(pattern):
+    """
+    Return the regular expression of a gitignore glob: * and ? don't match
+    /, ** matches any number of directories and [...] is a character class
+    """
+    index, size = 0, len(pattern)
+    regex = []
+    while index < size:
+        char = pattern[index]
+        if pattern.startswith('**/', index):
+            regex.append('(?:.*/)?')
+            index += 3
+            continue
+        elif pattern.startswith('**', index):
+            regex.append('.*')
+            index += 2
+            continue
+        elif char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '\\' and index + 1 < size:
+            index += 1
+            regex.append(re.escape(pattern[index]))
+        elif char == '[':
+            end = index + 1
+            if end < size and pattern[end] in '!^':
+                end += 1
+            if end < size and pattern[end] == ']':
+                end += 1
+            end = pattern.find(']', end)
+            if end < 0:
+                regex.append(re.escape(char))
+            else:
+                chars = pattern[index + 1:end].replace('\\', '\\\\')
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                regex.append('[{chars}]'.format(chars=chars))
+                index = end
+        else:
+            regex.append(re.escape(char))
+        index += 1
+    return ''.join(regex)
+
+
+class IgnoreRules(object):
+    """
+    Gitignore style patterns matched against paths relative to the
+    directory they apply to. A pattern with a / other than a trailing one
+    is anchored to that directory, otherwise it matches at any depth, a
+    trailing / only matches directories and ! re-includes what an earlier
+    pattern excluded. The last matching pattern wins.
+
+    The patterns are compiled once, a path matching none of the excluding
+    patterns, which is most of them, is rejected by a single combined
+    regular expression. The entries ignored are counted.
+    """
+    def __init__(self, patterns):
+        """Init rules from the lines of an ignore file"""
+        self.patterns = []
+        self.rules = []
+        for line in patterns:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            self.patterns.append(line)
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if not line:
+                continue
+            regex = '{prefix}{pattern}$'.format(
+                prefix='' if anchored else '(?:.*/)?',
+                pattern=translate(line)
+            )
+            self.rules.append((negated, dir_only, regex))
+
+        def combined(rules):
+            regexes = ['(?:{regex})'.format(regex=regex)
+                       for negated, _, regex in rules if not negated]
+            return re.compile('|'.join(regexes) if regexes else '(?!)')
+
+        self.files = combined([rule for rule in self.rules if not rule[1]])
+        self.dirs = combined(self.rules)
+        self.rules = [(negated, dir_only, re.compile(regex))
+                      for negated, dir_only, regex in self.rules]
+        self.ignored_files = 0
+        self.ignored_dirs = 0
+        self.ignored_bytes = 0
+
+    @classmethod
+    def load(cls, srcdir):
+        """Return the rules of the ignore file of srcdir, None if unset"""
+        try:
+            with open(os.path.join(srcdir, IGNORE_FILE), 'r') as content:
+                return cls(content.read().splitlines())
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def match(self, relpath, is_dir=False):
+        """Return True if relpath is ignored"""
+        if not (self.dirs if is_dir else self.files).match(relpath):
+            return False
+        for negated, dir_only, regex in reversed(self.rules):
+            if (is_dir or not dir_only) and regex.match(relpath):
+                return not negated
+        return False
+
+    def ignore(self, relpath, stat):
+        """
+        Return True if the entry at relpath described by stat is ignored,
+        counting it, the content of ignored directories isn't walked so
+        it's not counted.
+        """
+        is_dir = S_ISDIR(stat.st_mode)
+        if not self.match(relpath, is_dir):
+            return False
+        if is_dir:
+            self.ignored_dirs += 1
+        else:
+            self.ignored_files += 1
+            if S_ISREG(stat.st_mode):
+                self.ignored_bytes += stat.st_size
+        return True
+
+    def __str__(self):
+        return '{files} files ({bytes} bytes) and {dirs} whole ' \
+               'directories ignored'.format(dirs=self.ignored_dirs,
+                                            files=self.ignored_files,
+                                            bytes=self.ignored_bytes)
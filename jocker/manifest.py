@@ -0,0 +1,186 @@
+"""
+Source tree manifests for incremental copies
+"""
+import os
+import json
+import hashlib
+from stat import S_IFMT, S_ISDIR, S_ISREG
+
+from .archive import scan_tree, copy_entries, copy_metadata, unlink, \
+    REFLINK
+from .cache import hash_file
+
+
+# Build metadata kept inside the tree being built, never published
+BUILD_META_DIR = '.jocker'
+
+
+class Manifest(object):
+    """
+    Path, type, mode, size, mtime and optionally content hash of every
+    entry of a tree.
+    """
+    def __init__(self, entries=None):
+        """Init manifest, entries maps relpath to its attributes"""
+        self.entries = entries or {}
+
+    @classmethod
+    def scan(cls, src, content_hash=False, ignore=None):
+        """
+        Walk src and return the manifest of its content together with the
+        walked (relpath, path, stat) entries, see scan_tree for ignore.
+        """
+        entries = {}
+        walked = []
+        for relpath, path, stat in scan_tree(src, ignore=ignore):
+            digest = None
+            if content_hash and S_ISREG(stat.st_mode):
+                digest = hash_file(path, hashlib.sha256()).hexdigest()
+            entries[relpath] = [S_IFMT(stat.st_mode), stat.st_mode,
+                                stat.st_size, stat.st_mtime_ns, digest]
+            walked.append((relpath, path, stat))
+        return cls(entries), walked
+
+    @classmethod
+    def load(cls, path):
+        """Load manifest stored at path, None if there is none"""
+        try:
+            with open(path, 'r') as content:
+                return cls(json.load(content))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, path):
+        """Store manifest at path"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{path}.tmp'.format(path=path)
+        with open(tmp, 'w') as content:
+            json.dump(self.entries, content)
+        os.rename(tmp, path)
+
+    def changed(self, relpath, entry):
+        """Return True if entry differs from the one stored for relpath"""
+        current = self.entries.get(relpath)
+        if current is None:
+            return True
+        if current[:4] == entry[:4]:
+            return False
+        # same content under a new mtime, as after a fresh checkout
+        return not (entry[4] and current[4] == entry[4] and
+                    current[:3] == entry[:3])
+
+    def diff(self, other):
+        """
+        Return (changed, removed) relpaths to turn a tree described by this
+        manifest into the tree described by other.
+        """
+        changed = [relpath for relpath, entry in other.entries.items()
+                   if self.changed(relpath, entry)]
+        removed = [relpath for relpath in self.entries
+                   if relpath not in other.entries]
+        return changed, removed
+
+
+class Shadowed(object):
+    """
+    Entries of dest a sync replaced, kept to be put back once the sync
+    doesn't provide them anymore. A directory replaced by a directory is
+    kept empty, for its metadata, since its content is tracked entry by
+    entry, anything else is kept with its whole content.
+    """
+    def __init__(self, path):
+        """Init the entries kept at path, listed in path.json"""
+        self.path = path
+        self.index_path = '{path}.json'.format(path=path)
+        try:
+            with open(self.index_path, 'r') as content:
+                self.relpaths = set(json.load(content))
+        except (FileNotFoundError, ValueError):
+            self.relpaths = set()
+
+    def save(self):
+        """Store the list of kept entries"""
+        tmp = '{path}.tmp'.format(path=self.index_path)
+        with open(tmp, 'w') as content:
+            json.dump(sorted(self.relpaths), content)
+        os.rename(tmp, self.index_path)
+
+    def keep(self, dest, relpath, replacement):
+        """
+        Keep the entry of dest at relpath, if any, before it's replaced by
+        an entry described by the replacement stat
+        """
+        if relpath in self.relpaths:
+            return
+        target = os.path.join(dest, relpath)
+        try:
+            stat = os.lstat(target)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        entries = [(relpath, target, stat)]
+        if S_ISDIR(stat.st_mode) and not S_ISDIR(replacement.st_mode):
+            entries.extend((os.path.join(relpath, subpath), path, substat)
+                           for subpath, path, substat in scan_tree(target))
+        os.makedirs(os.path.dirname(os.path.join(self.path, relpath)),
+                    exist_ok=True)
+        copy_entries(entries, self.path, mode=REFLINK, update=False)
+        self.relpaths.add(relpath)
+
+    def remove(self, dest, relpath):
+        """
+        Remove the entry of dest at relpath, putting back the one it
+        replaced if it was kept
+        """
+        target = os.path.join(dest, relpath)
+        if relpath not in self.relpaths:
+            unlink(target)
+            return
+        kept = os.path.join(self.path, relpath)
+        stat = os.lstat(kept)
+        if S_ISDIR(stat.st_mode) and os.path.isdir(target) and \
+                not os.path.islink(target):
+            copy_metadata(kept, target, stat)
+        else:
+            unlink(target)
+            entries = [(relpath, kept, stat)]
+            if S_ISDIR(stat.st_mode):
+                entries.extend(
+                    (os.path.join(relpath, subpath), path, substat)
+                    for subpath, path, substat in scan_tree(kept)
+                )
+            copy_entries(entries, dest, mode=REFLINK, update=False)
+        unlink(kept)
+        self.relpaths.discard(relpath)
+
+
+def sync_tree(src, dest, manifest_path, content_hash=False, ignore=None):
+    """
+    Make dest a copy of src, if the manifest of the last sync exists only
+    new or changed entries are copied and removed ones deleted. Entries
+    ignored, see scan_tree, are left out as if removed. The entries of
+    dest a sync replaces are kept next to the manifest and put back when
+    src stops providing them, so an incremental sync gives the same tree
+    as a sync over the original dest.
+    """
+    previous = Manifest.load(manifest_path)
+    current, walked = Manifest.scan(src, content_hash=content_hash,
+                                    ignore=ignore)
+    shadowed = Shadowed(os.path.splitext(manifest_path)[0] + '.shadowed')
+
+    update = previous is None
+    if update:
+        previous = Manifest()
+    changed, removed = previous.diff(current)
+    for relpath in sorted(removed, reverse=True):
+        shadowed.remove(dest, relpath)
+    changed = set(changed)
+    entries = [entry for entry in walked if entry[0] in changed]
+    for relpath, _, stat in entries:
+        if relpath not in previous.entries:
+            shadowed.keep(dest, relpath, stat)
+    stats = copy_entries(entries, dest, update=update)
+    copy_metadata(src, dest, os.lstat(src))
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    shadowed.save()
+    current.save(manifest_path)
+    return stats
@@ -0,0 +1,168 @@
+"""
+Jail volume mounts
+"""
+import os
+import re
+import json
+import shlex
+import logging
+
+from .utils import run_command
+
+
+logger = logging.getLogger('jocker')
+
+# octal escapes used by the mount tables for spaces and tabs in paths
+ESCAPES = re.compile(r'\\([0-7]{3})')
+
+
+def unescape(path):
+    """Decode the octal escapes of a mount table path"""
+    return ESCAPES.sub(lambda match: chr(int(match.group(1), 8)), path)
+
+
+def mount_table():
+    """
+    Return the (source, mountpoint, fstype) mounts of the system in mount
+    order, read from /proc/self/mounts or mount -p.
+    """
+    if os.path.exists('/proc/self/mounts'):
+        with open('/proc/self/mounts', 'r') as content:
+            lines = content.read().splitlines()
+    else:
+        lines = run_command(['mount', '-p'], check=True).splitlines()
+
+    mounts = []
+    for line in lines:
+        values = line.split()
+        if len(values) >= 3:
+            mounts.append((unescape(values[0]), unescape(values[1]),
+                           values[2]))
+    return mounts
+
+
+class MountManager(object):
+    """
+    Volumes mounted in a jail. VOLUME commands add and remove the volumes
+    wanted and apply() reconciles them with the mount table at once, only
+    the missing mounts are made and the unwanted ones removed. The
+    mountpoints managed are kept in a journal, so mounts left by a run
+    that died are removed on the next apply while the mounts done by
+    others in the jail (devfs, basejail) are never touched.
+    """
+    MOUNT = os.environ.get('JOCKER_MOUNT', 'mount_nullfs').split()
+    UMOUNT = os.environ.get('JOCKER_UMOUNT', 'umount').split()
+    MOUNTS_DIR = os.environ.get('JOCKER_MOUNTS_DIR',
+                                '/var/run/jocker/mounts/')
+
+    def __init__(self, jailname):
+        """Init the mounts of jailname"""
+        self.jailname = jailname
+        self.volumes = {}
+        self.changed = False
+
+    def add(self, orig, dest):
+        """Want orig mounted on dest"""
+        self.volumes[os.path.realpath(dest)] = os.path.realpath(orig)
+        self.changed = True
+
+    def remove(self, dest):
+        """Don't want anything mounted on dest anymore"""
+        self.volumes.pop(os.path.realpath(dest), None)
+        self.changed = True
+
+    def journal_path(self):
+        """Return the path of the journal of managed mountpoints"""
+        return os.path.join(self.MOUNTS_DIR,
+                            '{name}.json'.format(name=self.jailname))
+
+    def load_journal(self):
+        """Return the managed mountpoints"""
+        try:
+            with open(self.journal_path(), 'r') as content:
+                return set(json.load(content))
+        except (FileNotFoundError, ValueError):
+            return set()
+
+    def save_journal(self, mountpoints):
+        """Store the managed mountpoints"""
+        path = self.journal_path()
+        if not mountpoints:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        os.makedirs(self.MOUNTS_DIR, exist_ok=True)
+        tmp = '{path}.tmp'.format(path=path)
+        with open(tmp, 'w') as content:
+            json.dump(sorted(mountpoints), content)
+        os.rename(tmp, path)
+
+    def plan(self, table, managed):
+        """
+        Return the (umounts, mounts) needed to go from the mount table to
+        the wanted volumes, umounts lists a mountpoint once per mount to
+        remove, deepest first, and mounts lists (orig, dest) parents first.
+        """
+        mounted = {}
+        for source, mountpoint, fstype in table:
+            if mountpoint in managed:
+                # only nullfs lists the mounted directory as source, bind
+                # mounts list the device
+                mounted.setdefault(mountpoint, []).append(
+                    source if fstype == 'nullfs' else None
+                )
+
+        def kept(dest):
+            """A volume is kept if it's mounted once from its source"""
+            sources = mounted.get(dest, [])
+            return dest in self.volumes and len(sources) == 1 and \
+                sources[0] in (self.volumes[dest], None)
+
+        # a kept mount below a changed one would keep its parent busy or
+        # be hidden by the new one, it's umounted first and mounted again
+        changed = [dest for dest in set(mounted) | set(self.volumes)
+                   if not kept(dest)]
+
+        def nested(dest):
+            return any(dest.startswith(parent.rstrip('/') + '/')
+                       for parent in changed)
+
+        umounts = []
+        mounts = []
+        for mountpoint, sources in mounted.items():
+            if not kept(mountpoint) or nested(mountpoint):
+                umounts.extend([mountpoint] * len(sources))
+        for dest, orig in self.volumes.items():
+            if not kept(dest) or nested(dest):
+                mounts.append((orig, dest))
+        return sorted(umounts, reverse=True), sorted(mounts,
+                                                     key=lambda m: m[1])
+
+    def apply(self):
+        """
+        Mount and umount what's needed to match the wanted volumes, the
+        commands run in a single shell. Mounts left in the journal are
+        removed even if no volume changed.
+        """
+        journal = self.load_journal()
+        if not self.changed and not journal:
+            return
+        managed = journal | set(self.volumes)
+        umounts, mounts = self.plan(mount_table(), managed)
+        if umounts or mounts:
+            # record the mountpoints first, a crash leaves them managed
+            self.save_journal(managed)
+            script = ['set -e']
+            script.extend(' '.join(shlex.quote(arg) for arg in
+                                   self.UMOUNT + [mountpoint])
+                          for mountpoint in umounts)
+            script.extend(' '.join(shlex.quote(arg) for arg in
+                                   self.MOUNT + [orig, dest])
+                          for orig, dest in mounts)
+            logger.info('Volumes of {name}: {mounts} to mount, {umounts} '
+                        'to umount'.format(name=self.jailname,
+                                           mounts=len(mounts),
+                                           umounts=len(umounts)))
+            run_command(['sh', '-c', '\n'.join(script)])
+        self.save_journal(set(self.volumes))
+        self.changed = False
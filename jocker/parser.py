@@ -1,14 +1,29 @@
 """
 Jockerfile file format parser
 """
+import os
 import re
+import json
+import hashlib
+from types import MappingProxyType
 
-from .commands import COMMANDS, CommandEnv, CommandName, CommandEntrypoint
+from .commands import COMMANDS, CommandEnv, CommandName, \
+    CommandVersion, CommandEntrypoint, split_version
 
 
 # Join lines split by \
 LINE_SPLITS = re.compile(r'\\\n')
 
+# Parsed commands by absolute path, with the mtime and size they were
+# parsed at
+PARSE_CACHE = {}
+# Jockerfile lines kept between runs, by the hash of their absolute path
+PARSE_CACHE_DIR = os.environ.get(
+    'JOCKER_PARSE_CACHE_DIR',
+    os.path.join(os.environ.get('JOCKER_CACHE_DIR', '/var/cache/jocker/'),
+                 'parsed')
+)
+
 
 def clean_lines(content):
     """
@@ -20,12 +35,25 @@ def clean_lines(content):
     ).split('\n')
 
 
+def split_command(line):
+    """
+    Split a line in its lowercase command name and the rest.
+    """
+    command, rest = line.split(' ', 1)
+    return command.lower(), rest
+
+
 def build_command(line):
     """
     Take a line and build the corresponding command class.
     """
-    command, rest = line.split(' ', 1)
-    command = command.lower()
+    return make_command(*split_command(line))
+
+
+def make_command(command, rest):
+    """
+    Build the command class of the lowercase command name with its value.
+    """
     command_class = COMMANDS.get(command)
     if not command_class:
         raise RuntimeError('Invalid command {command}'.format(command=command))
@@ -37,9 +65,74 @@ def parse(path='Jockerfile'):
     Parse the content and outputs an array for the parsed commands.
     """
     # TODO: validate Jockerfile, like unique name entry, unique author, etc
+    return [build_command(line) for line in read_lines(path)]
+
+
+def read_lines(path):
+    """Return the cleaned command lines of the Jockerfile at path"""
     with open(path, 'r') as jockerfile:
-        lines = clean_lines(jockerfile.read().strip())
-        return [build_command(line) for line in lines]
+        return clean_lines(jockerfile.read().strip())
+
+
+def parsed_path(key):
+    """Return the path keeping the parsed Jockerfile at key"""
+    return os.path.join(PARSE_CACHE_DIR, '{digest}.json'.format(
+        digest=hashlib.sha256(key.encode()).hexdigest()
+    ))
+
+
+def load_parsed(key, version):
+    """
+    Return the (command, value) pairs kept for the Jockerfile at key, None
+    if there are none or the file changed since
+    """
+    try:
+        with open(parsed_path(key), 'r') as content:
+            parsed = json.load(content)
+    except (OSError, ValueError):
+        return None
+    if parsed.get('path') != key or parsed.get('version') != version:
+        return None
+    return parsed['commands']
+
+
+def save_parsed(key, version, commands):
+    """
+    Keep the (command, value) pairs of the Jockerfile at key, unless the
+    cache isn't writable
+    """
+    path = parsed_path(key)
+    tmp = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    try:
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        with open(tmp, 'w') as content:
+            json.dump({'path': key, 'version': version,
+                       'commands': commands}, content)
+        os.rename(tmp, path)
+    except OSError:
+        pass
+
+
+def parse_cached(path='Jockerfile'):
+    """
+    Parse the Jockerfile at path unless it was already parsed and hasn't
+    changed since. The parsed commands are kept in PARSE_CACHE_DIR, so
+    later runs skip reading, joining and splitting the lines, and in
+    memory, so a long running process skips building them too.
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    version = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+    cached = PARSE_CACHE.get(key)
+    if cached is None or cached[0] != version:
+        pairs = load_parsed(key, version)
+        if pairs is None:
+            pairs = [split_command(line) for line in read_lines(path)]
+            save_parsed(key, version, pairs)
+        cached = (version, tuple(make_command(command, rest)
+                                 for command, rest in pairs))
+        PARSE_CACHE[key] = cached
+    return list(cached[1])
 
 
 class Jockerfile(object):
@@ -48,13 +141,43 @@ class Jockerfile(object):
         Init parsed Jockerfile
         """
         self.path = jockerfile
-        self.commands = parse(jockerfile)
+        self.commands = parse_cached(jockerfile)
+        self.compile()
+
+    def compile(self):
+        """
+        Index commands by position and type, and build the env snapshot
+        seen at each position.
+        """
+        self.positions = {}
+        self.types = {}
+        self.envs = []
+        env = MappingProxyType({})
+        for index, command in enumerate(self.commands):
+            self.positions.setdefault(command, index)
+            self.envs.append(env)
+            if isinstance(command, CommandEnv):
+                name, value = command.get_value()
+                env = MappingProxyType(dict(env, **{name: value}))
+        self.envs.append(env)
 
     def name(self):
         """
         Return base name defined by the NAME command
         """
-        return self.filter_commands(CommandName)[0].get_value()
+        value = self.filter_commands(CommandName)[0].get_value()
+        return split_version(value)[0]
+
+    def version(self):
+        """
+        Return base version defined by the VERSION command, or by the NAME
+        command as name:version, None if not versioned
+        """
+        versions = self.filter_commands(CommandVersion)
+        if versions:
+            return versions[0].get_value()
+        value = self.filter_commands(CommandName)[0].get_value()
+        return split_version(value)[1]
 
     def entrypoint(self):
         """
@@ -66,23 +189,29 @@ class Jockerfile(object):
         """
         Return index of command in the commands list
         """
-        try:
-            return self.commands.index(command)
-        except ValueError:
-            return None
+        return self.positions.get(command)
 
     def env(self, index=None):
         """
         Return base env values defined by the ENV command that are
-        before the given index
+        before the given index, the mapping is read only
         """
-        return dict([command.get_value()
-                     for command in self.filter_commands(CommandEnv, index)])
+        if index is None:
+            return self.envs[-1]
+        return self.envs[min(index, len(self.commands))]
 
     def filter_commands(self, command_type, index=None):
         """Return commands of the given type and max index"""
-        return [command for command in self.commands[:index]
-                if isinstance(command, command_type)]
+        if command_type not in self.types:
+            self.types[command_type] = [
+                command for command in self.commands
+                if isinstance(command, command_type)
+            ]
+        commands = self.types[command_type]
+        if index is None:
+            return list(commands)
+        return [command for command in commands
+                if self.positions[command] < index]
 
     def __iter__(self):
         """Iterate over commands"""
@@ -0,0 +1,197 @@
+"""
+Pools of started jails kept ready to run commands
+"""
+import os
+import glob
+import fcntl
+import random
+import logging
+
+from .backends.base import BaseRunner
+from .backends.utils import get_backend
+
+
+logger = logging.getLogger('jocker')
+
+
+class PooledRunner(BaseRunner):
+    """
+    Runner of a pool jail, the jail is already started and its persistent
+    bootstrap commands run, so only the commands keeping their state in
+    the runner are run on enter and rolled back on exit.
+    """
+    def __enter__(self):
+        """Bootstrap the runner state upon enter"""
+        self.backend.bootstrap_jail(self, persistent=False)
+        return self
+
+    def __exit__(self, *args):
+        """Roll-back the runner state upon leave"""
+        self.backend.unbootstrap_jail(self, persistent=False)
+
+
+class PoolSlot(object):
+    """
+    Jail of a pool and its lock file, holding the lock marks the jail as
+    busy and the file stores the number of runs the jail served.
+    """
+    def __init__(self, pool, index):
+        """Init slot index of pool"""
+        self.pool = pool
+        self.jailname = '{base}-pool-{index}'.format(base=pool.base,
+                                                     index=index)
+        self.path = os.path.join(pool.POOL_DIR,
+                                 '{name}.lock'.format(name=self.jailname))
+        self.backend = get_backend(pool.backend, jailname=self.jailname)
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        """Lock the slot, return False if it's busy and not blocking"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking
+                        else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        """Unlock the slot"""
+        os.close(self.fd)
+        self.fd = None
+
+    def uses(self):
+        """Return the number of runs served since the jail was started"""
+        value = os.pread(self.fd, 32, 0).strip()
+        return int(value) if value else 0
+
+    def set_uses(self, uses):
+        """Store the number of runs served since the jail was started"""
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, str(uses).encode(), 0)
+
+    def warm(self):
+        """
+        Create the jail if needed, start it and run its persistent
+        bootstrap commands
+        """
+        backend = self.backend
+        if not os.path.isdir(backend.jaildir()):
+            backend.create(backend.base_jockerfile(self.pool.base))
+        if not backend.running():
+            logger.info('Starting pool jail: {name}'.format(
+                name=self.jailname
+            ))
+            backend.start()
+            backend.bootstrap_jail(BaseRunner(backend, self.jailname),
+                                   persistent=True)
+            self.set_uses(0)
+
+    def cool(self):
+        """Roll-back the persistent bootstrap commands and stop the jail"""
+        backend = self.backend
+        if backend.running():
+            logger.info('Stopping pool jail: {name}'.format(
+                name=self.jailname
+            ))
+            try:
+                backend.unbootstrap_jail(BaseRunner(backend, self.jailname),
+                                         persistent=True)
+            finally:
+                backend.stop()
+
+    def recycle(self):
+        """Restart the jail"""
+        self.cool()
+        self.warm()
+
+
+class JailPool(object):
+    """
+    Jails of a base, named <base>-pool-<N>, kept started and bootstrapped
+    so runs don't pay for the jail start and stop. A jail is restarted
+    after serving MAX_USES runs.
+    """
+    POOL_DIR = os.environ.get('JOCKER_POOL_DIR', '/var/run/jocker/pool/')
+    MAX_USES = int(os.environ.get('JOCKER_POOL_MAX_USES', 100))
+
+    def __init__(self, base, size=None, backend=None):
+        """
+        Init pool of base, if size isn't given it's the size of the pool
+        last filled
+        """
+        self.base = base
+        self.size = size
+        self.backend = backend
+
+    def slots(self):
+        """Return the slots of the pool"""
+        if self.size is not None:
+            indexes = range(self.size)
+        else:
+            pattern = os.path.join(self.POOL_DIR, '{base}-pool-*.lock'.format(
+                base=glob.escape(self.base)
+            ))
+            prefix = '{base}-pool-'.format(base=self.base)
+            indexes = sorted(
+                int(os.path.basename(path)[len(prefix):-len('.lock')])
+                for path in glob.glob(pattern)
+            )
+        return [PoolSlot(self, index) for index in indexes]
+
+    def fill(self):
+        """Create and start every jail of the pool"""
+        os.makedirs(self.POOL_DIR, exist_ok=True)
+        for slot in self.slots():
+            slot.acquire()
+            try:
+                slot.warm()
+            finally:
+                slot.release()
+
+    def drain(self):
+        """Stop every jail of the pool"""
+        for slot in self.slots():
+            slot.acquire()
+            try:
+                slot.cool()
+                os.unlink(slot.path)
+            finally:
+                slot.release()
+
+    def acquire(self):
+        """
+        Return a locked slot, a free one if any, otherwise wait for a
+        random one
+        """
+        slots = self.slots()
+        if not slots:
+            raise ValueError('No pool for base {base}'.format(base=self.base))
+        # start at a random slot to spread concurrent runs
+        start = random.randrange(len(slots))
+        for slot in slots[start:] + slots[:start]:
+            if slot.acquire(blocking=False):
+                return slot
+        slot = slots[start]
+        slot.acquire()
+        return slot
+
+    def run(self, command=None):
+        """Run default commands or given one in a jail of the pool"""
+        slot = self.acquire()
+        try:
+            # the jail might have been stopped or failed
+            slot.warm()
+            slot.backend.run(command, runner=PooledRunner(slot.backend,
+                                                          slot.jailname))
+        finally:
+            try:
+                uses = slot.uses() + 1
+                if uses >= self.MAX_USES:
+                    slot.recycle()
+                    uses = 0
+                slot.set_uses(uses)
+            finally:
+                slot.release()
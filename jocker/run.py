@@ -1,35 +1,156 @@
 import os
 import sys
+import logging
 import argparse
 
-from .build import build
-from .create import create_from_jockerfile, create_from_base
-from .runner import run
+# subcommands import what they need when they run, so the CLI starts fast
+# and --help or a run don't pay for the build machinery
 
 
 def do_build(args):
     """Run build"""
-    build(args.jockerfile, build=args.build, install=args.install)
+    from .build import build, build_many
+    jockerfiles = args.jockerfile
+    if len(jockerfiles) == 1:
+        build(jockerfiles[0], build=args.build, install=args.install,
+              cache=not args.no_cache)
+    else:
+        try:
+            failures = build_many(jockerfiles, build=args.build,
+                                  install=args.install,
+                                  cache=not args.no_cache, jobs=args.jobs)
+        except ValueError as error:
+            sys.exit(str(error))
+        if failures:
+            sys.exit(1)
 
 
 def do_create(args):
     """Run create"""
-    if args.base:
-        create_from_base(args.base,
-                         name=args.name,
-                         network=args.net)
-    else:
-        create_from_jockerfile(args.jockerfile,
+    from .create import create_from_jockerfile, create_from_base, \
+        create_many, create_many_async
+    if args.count and args.async_:
+        failures = create_many_async(args.count,
+                                     base=args.base,
+                                     jockerfile=args.jockerfile,
+                                     name=args.name,
+                                     network=args.net,
+                                     concurrency=args.concurrency,
+                                     timeout=args.timeout)
+        if failures:
+            sys.exit(1)
+    elif args.count:
+        failures = create_many(args.count,
+                               base=args.base,
+                               jockerfile=args.jockerfile,
                                name=args.name,
-                               network=args.net)
+                               network=args.net,
+                               concurrency=args.concurrency)
+        if failures:
+            sys.exit(1)
+    else:
+        try:
+            if args.base:
+                create_from_base(args.base,
+                                 name=args.name,
+                                 network=args.net)
+            else:
+                create_from_jockerfile(args.jockerfile,
+                                       name=args.name,
+                                       network=args.net)
+        except ValueError as error:
+            sys.exit(str(error))
 
 
 def do_import(args):
-    print('IMPORT:', args)
+    """Import jail bases from archives, - reads stdin"""
+    from .utils import input_stream
+    from .backends.utils import get_backend
+    backend = get_backend()
+    if args.name and len(args.archives) > 1:
+        sys.exit('--name needs a single archive')
+    for archive in args.archives:
+        try:
+            backend.import_base(input_stream() if archive == '-'
+                                else archive, name=args.name)
+        except ValueError as error:
+            sys.exit(str(error))
+
+
+def do_export(args):
+    """Export a jail base to an archive, - writes stdout"""
+    from .utils import output_stream
+    from .backends.utils import get_backend
+    output = output_stream() if args.output == '-' else args.output
+    try:
+        get_backend().export_base(args.base, output, codec=args.compression,
+                                  threads=args.threads)
+    except ValueError as error:
+        sys.exit(str(error))
 
 
 def do_run(args):
-    run(args.name, command=args.command, args=args.args)
+    from .runner import run
+    run(args.name, command=args.command, args=args.args, pool=args.pool)
+
+
+def do_pool(args):
+    """Fill or drain a jail pool"""
+    from .pool import JailPool
+    if args.drain:
+        JailPool(args.base).drain()
+    else:
+        JailPool(args.base, size=args.size).fill()
+
+
+def do_store(args):
+    """Run content store maintenance"""
+    from .backends.utils import get_backend
+    store = get_backend().store()
+    if store is None:
+        sys.exit('No content store configured, set JOCKER_STORE_DIR')
+    if args.action == 'verify':
+        if store.verify():
+            sys.exit(1)
+    else:
+        store.gc()
+
+
+def do_daemon(args):
+    """Serve the command line over a Unix socket"""
+    from .daemon import serve
+    serve(parser, path=args.socket, concurrency=args.concurrency)
+
+
+def setup_logging(stream=None):
+    """Log jocker messages to stream, stdout by default"""
+    logging.basicConfig(stream=stream or sys.stdout, level=logging.DEBUG)
+    logging.getLogger('jocker').setLevel(logging.DEBUG)
+
+
+def do_profile(func, args):
+    """Run func tracing it, write the trace to args.profile"""
+    from . import trace
+    tracer = trace.enable()
+    try:
+        func(args)
+    finally:
+        trace.disable()
+        tracer.write(args.profile)
+        print(tracer.summary(), file=sys.stderr)
+
+
+class AppendOverDefault(argparse.Action):
+    """
+    Append action whose values replace the default list instead of being
+    added to it, the default stays on the parser so the daemon sees it
+    like a given value
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        items = getattr(namespace, self.dest)
+        if items is self.default:
+            items = []
+        setattr(namespace, self.dest, items + [values])
 
 
 parser = argparse.ArgumentParser(
@@ -41,12 +162,21 @@ build_parser = subparsers.add_parser(
     'build',
     description='Build a jail base'
 )
-build_parser.add_argument('--jockerfile',
-                          default='Jockerfile',
-                          help='specify the Jockerfile (default ./Jockerfile)')
+build_parser.add_argument('--jockerfile', action=AppendOverDefault,
+                          default=['Jockerfile'],
+                          help='specify the Jockerfile (default '
+                               './Jockerfile), repeat it to build many '
+                               'bases in the order of their FROM')
+build_parser.add_argument('--jobs', type=int, default=4,
+                          help='bases built at once with many --jockerfile '
+                               '(default 4)')
 build_parser.add_argument('--build', help='build directory')
 build_parser.add_argument('--install', action='store_true',
                           help='install the built jail base')
+build_parser.add_argument('--no-cache', action='store_true',
+                          help='do not use cached build layers')
+build_parser.add_argument('--profile', metavar='TRACE',
+                          help='write a Chrome trace of the command to TRACE')
 build_parser.set_defaults(func=do_build)
 
 create_parser = subparsers.add_parser(
@@ -58,28 +188,116 @@ create_parser.add_argument('--jockerfile',
 create_parser.add_argument('--base', help='base jail')
 create_parser.add_argument('--name', help='jail name')
 create_parser.add_argument('--net', help='jail network')
+create_parser.add_argument('--count', type=int,
+                           help='create this many jails, named <name>-<N>; '
+                                '{index} in --net is replaced by N')
+create_parser.add_argument('--concurrency', type=int, default=4,
+                           help='jails created at once with --count '
+                                '(default 4)')
+create_parser.add_argument('--async', dest='async_', action='store_true',
+                           help='with --count, drive the jails from one '
+                                'event loop instead of a thread each')
+create_parser.add_argument('--timeout', type=float,
+                           help='seconds each command may run with --async')
+create_parser.add_argument('--profile', metavar='TRACE',
+                           help='write a Chrome trace of the command to TRACE')
 create_parser.set_defaults(func=do_create)
 
 import_parser = subparsers.add_parser(
     'import',
-    description='Import the named jail base'
+    description='Import jail bases from archives made by export'
 )
-import_parser.add_argument('names', nargs='*', help='jail bases to import')
+import_parser.add_argument('archives', nargs='+',
+                           help='archives to import, - reads stdin')
+import_parser.add_argument('--name',
+                           help='base name (default from its Jockerfile)')
 import_parser.set_defaults(func=do_import)
 
+export_parser = subparsers.add_parser(
+    'export',
+    description='Export a jail base to an archive'
+)
+export_parser.add_argument('base', help='jail base to export')
+export_parser.add_argument('--output', default='-',
+                           help='archive path, - writes stdout (default)')
+export_parser.add_argument('--compression', default='gzip',
+                           choices=['gzip', 'xz', 'zstd'],
+                           help='archive compression (default gzip)')
+export_parser.add_argument('--threads', type=int,
+                           help='compression threads')
+# the archive goes to stdout, log messages to stderr
+export_parser.set_defaults(func=do_export, log_stderr=True)
+
 run_parser = subparsers.add_parser(
     'run',
     description='Run a command in the given jail'
 )
 run_parser.add_argument('--name', help='jail to run the command on')
 run_parser.add_argument('--command', nargs='?', help='command to run')
+run_parser.add_argument('--pool', metavar='BASE',
+                        help='run in a started jail of the BASE pool')
 run_parser.add_argument('args', nargs=argparse.REMAINDER,
                         help='command arguments to run')
+run_parser.add_argument('--profile', metavar='TRACE',
+                        help='write a Chrome trace of the command to TRACE')
 run_parser.set_defaults(func=do_run)
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    if len(sys.argv) > 1:
-        args.func(args)
+pool_parser = subparsers.add_parser(
+    'pool',
+    description='Keep started jails of a base ready for run --pool'
+)
+pool_parser.add_argument('--base', required=True, help='base jail')
+pool_parser.add_argument('--size', type=int, default=1,
+                         help='jails kept started (default 1)')
+pool_parser.add_argument('--drain', action='store_true',
+                         help='stop the jails of the pool')
+pool_parser.set_defaults(func=do_pool)
+
+store_parser = subparsers.add_parser(
+    'store',
+    description='Maintain the content store of installed bases'
+)
+store_parser.add_argument('action', choices=['verify', 'gc'],
+                          help='verify the stored objects or remove the '
+                               'unused ones')
+store_parser.set_defaults(func=do_store)
+
+daemon_parser = subparsers.add_parser(
+    'daemon',
+    description='Serve jocker commands to the command line over a socket'
+)
+daemon_parser.add_argument('--socket',
+                           help='Unix socket path (default JOCKER_SOCKET or '
+                                '/var/run/jocker/jocker.sock)')
+daemon_parser.add_argument('--concurrency', type=int, default=4,
+                           help='commands run at once (default 4)')
+daemon_parser.set_defaults(func=do_daemon)
+
+
+def main(argv=None):
+    """
+    Run the command line, in the jocker daemon if one is running unless
+    JOCKER_NO_DAEMON is set or the command is profiled
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+    if argv:
+        if args.func is not do_daemon and \
+                not getattr(args, 'profile', None) and \
+                not os.environ.get('JOCKER_NO_DAEMON'):
+            from .daemon import forward
+            status = forward(argv)
+            if status is not None:
+                sys.exit(status)
+        setup_logging(sys.stderr if getattr(args, 'log_stderr', False)
+                      else None)
+        if getattr(args, 'profile', None):
+            do_profile(args.func, args)
+        else:
+            args.func(args)
     else:
         parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,16 @@ Run the a command in a jail
 from .backends.utils import get_backend
 
 
-def run(name, command=None, args=None):
+def run(name, command=None, args=None, pool=None):
     """
-    Run the given command or the default ENTRYPOINT call in the jail
+    Run the given command or the default ENTRYPOINT call in the jail, or
+    in a started jail of the pool of the given base
     """
-    jail_backend = get_backend(jailname=name)
-
     if command and args:
         command = '{command} {args}'.format(command=command,
                                             args=' '.join(args))
-    jail_backend.run(command)
+    if pool:
+        from .pool import JailPool
+        JailPool(pool).run(command)
+    else:
+        get_backend(jailname=name).run(command)
@@ -0,0 +1,200 @@
+"""
+Content addressed store for installed bases
+"""
+import os
+import uuid
+import errno
+import hashlib
+import logging
+from stat import S_IMODE, S_ISREG
+
+from . import trace
+from .archive import scan_tree, copy_data, unlink, CLONE, COPY_WORKERS
+from .cache import CHUNK_SIZE
+
+
+logger = logging.getLogger('jocker')
+
+
+class StoreStats(object):
+    """Counters of a store operation"""
+    def __init__(self):
+        self.files = 0
+        self.stored = 0
+        self.shared = 0
+        self.bytes = 0
+        self.shared_bytes = 0
+        self.unlinked = 0
+
+    def __str__(self):
+        return ('{files} files, {stored} stored ({bytes} bytes), {shared} '
+                'shared ({shared_bytes} bytes), {unlinked} not linked'
+                ).format(files=self.files, stored=self.stored,
+                         bytes=self.bytes, shared=self.shared,
+                         shared_bytes=self.shared_bytes,
+                         unlinked=self.unlinked)
+
+
+class ContentStore(object):
+    """
+    Store files once under objects/<ab>/<key>, the key covers the content,
+    mode, owner and mtime of the file since hardlinks share them, files
+    with the same content but another mtime are stored apart. Bases are
+    materialized as hardlink farms to the objects, so the link count of an
+    object minus one is the number of files using it.
+    """
+    def __init__(self, storedir):
+        """Init store rooted at storedir"""
+        self.storedir = storedir
+        self.objectsdir = os.path.join(storedir, 'objects')
+
+    def object_key(self, path, stat):
+        """Return the key of the file at path described by stat"""
+        digest = hashlib.sha256()
+        digest.update('{mode} {uid} {gid} {mtime}\0'.format(
+            mode=S_IMODE(stat.st_mode), uid=stat.st_uid, gid=stat.st_gid,
+            mtime=stat.st_mtime_ns
+        ).encode())
+        with open(path, 'rb') as content:
+            for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, key):
+        """Return the path of the object stored as key"""
+        return os.path.join(self.objectsdir, key[:2], key)
+
+    def objects(self):
+        """Yield (key, path, stat) for every stored object"""
+        if not os.path.isdir(self.objectsdir):
+            return
+        for relpath, path, stat in scan_tree(self.objectsdir):
+            if S_ISREG(stat.st_mode):
+                yield os.path.basename(relpath), path, stat
+
+    def inodes(self):
+        """Return a (device, inode) to key map of the stored objects"""
+        return {(stat.st_dev, stat.st_ino): key
+                for key, path, stat in self.objects()}
+
+    def refcount(self, key):
+        """Return the number of files linked to the object stored as key"""
+        try:
+            return os.stat(self.path(key)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def add(self, path, stat):
+        """
+        Store the file at path unless an object with the same key exists,
+        return (key, stored).
+        """
+        key = self.object_key(path, stat)
+        target = self.path(key)
+        if os.path.exists(target):
+            return key, False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # objects appear complete, concurrent adds of the same content
+        # replace each other with identical files
+        tmp = '{target}.{id}.tmp'.format(target=target, id=uuid.uuid4().hex)
+        try:
+            copy_data(path, tmp, stat, mode=CLONE)
+            os.rename(tmp, target)
+        except BaseException:
+            unlink(tmp)
+            raise
+        return key, True
+
+    def link(self, key, path):
+        """Replace path with a hardlink to the object stored as key"""
+        tmp = '{path}.{id}.tmp'.format(path=path, id=uuid.uuid4().hex)
+        os.link(self.path(key), tmp)
+        try:
+            os.rename(tmp, path)
+        except BaseException:
+            unlink(tmp)
+            raise
+
+    def dedup(self, tree, workers=None):
+        """
+        Move every regular file of tree into the store and replace it with
+        a hardlink to its object. Files already linked to an object are not
+        hashed again.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        with trace.span('dedup', 'store', tree=tree) as span:
+            stats = StoreStats()
+            inodes = self.inodes()
+
+            def dedup_file(entry):
+                relpath, path, stat = entry
+                key = inodes.get((stat.st_dev, stat.st_ino))
+                if key is not None:
+                    return False, stat.st_size, True
+                key, stored = self.add(path, stat)
+                target = os.lstat(self.path(key))
+                if (target.st_dev, target.st_ino) == \
+                        (stat.st_dev, stat.st_ino):
+                    return stored, stat.st_size, True
+                try:
+                    self.link(key, path)
+                except OSError as error:
+                    if error.errno not in (errno.EMLINK, errno.EXDEV):
+                        raise
+                    # the object can't take more links, keep the copy
+                    return stored, stat.st_size, False
+                return stored, stat.st_size, True
+
+            files = [entry for entry in scan_tree(tree)
+                     if S_ISREG(entry[2].st_mode)]
+            with ThreadPoolExecutor(max_workers=workers or COPY_WORKERS) \
+                    as executor:
+                for stored, size, linked in executor.map(dedup_file, files):
+                    stats.files += 1
+                    if not linked:
+                        stats.unlinked += 1
+                    elif stored:
+                        stats.stored += 1
+                        stats.bytes += size
+                    else:
+                        stats.shared += 1
+                        stats.shared_bytes += size
+            span.set(files=stats.files, bytes=stats.bytes,
+                     shared=stats.shared_bytes)
+
+        logger.debug('Stored {stats}'.format(stats=stats))
+        return stats
+
+    def verify(self):
+        """
+        Hash every stored object again, return the keys of the objects
+        whose content, mode, owner or mtime don't match their key anymore.
+        """
+        with trace.span('verify', 'store') as span:
+            corrupted = []
+            count = 0
+            for key, path, stat in self.objects():
+                if key.endswith('.tmp'):
+                    continue
+                count += 1
+                if self.object_key(path, stat) != key:
+                    logger.error('Corrupted object: {key}'.format(key=key))
+                    corrupted.append(key)
+            span.set(files=count, corrupted=len(corrupted))
+        return corrupted
+
+    def gc(self):
+        """
+        Remove the objects no file links to anymore and leftovers of
+        interrupted adds, return the number of removed files and bytes.
+        """
+        removed = freed = 0
+        for key, path, stat in list(self.objects()):
+            if stat.st_nlink == 1 or key.endswith('.tmp'):
+                unlink(path)
+                removed += 1
+                freed += stat.st_size
+        logger.debug('Removed {removed} objects, {freed} bytes'.format(
+            removed=removed, freed=freed
+        ))
+        return removed, freed
@@ -0,0 +1,95 @@
+"""
+Tar streams carrying the checksums of their files
+"""
+import io
+import json
+import hashlib
+import tarfile
+
+
+# member appended to the stream with the sha256 of every regular file
+CHECKSUMS_MEMBER = './.jocker/checksums.json'
+# size of the reads while extracting files
+COPY_SIZE = 1024 * 1024
+
+
+class HashingReader(object):
+    """File object wrapper hashing the data read through it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+class ChecksumTarFile(tarfile.TarFile):
+    """
+    Tar file hashing the regular files while they are added or extracted,
+    the checksums are written as the last member of the stream and checked
+    against the extracted files once the stream is read, so nothing is read
+    twice.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ChecksumTarFile, self).__init__(*args, **kwargs)
+        self.checksums = {}
+        self.expected = None
+
+    def addfile(self, tarinfo, fileobj=None):
+        """Add tarinfo hashing the content read from fileobj"""
+        if fileobj is None:
+            return super(ChecksumTarFile, self).addfile(tarinfo)
+        reader = HashingReader(fileobj)
+        super(ChecksumTarFile, self).addfile(tarinfo, reader)
+        self.checksums[tarinfo.name] = reader.digest.hexdigest()
+
+    def add_checksums(self):
+        """Append the checksums member"""
+        data = json.dumps(self.checksums, sort_keys=True).encode()
+        tarinfo = tarfile.TarInfo(CHECKSUMS_MEMBER)
+        tarinfo.size = len(data)
+        super(ChecksumTarFile, self).addfile(tarinfo, io.BytesIO(data))
+
+    def makefile(self, tarinfo, targetpath):
+        """Extract the file at targetpath hashing its content"""
+        digest = hashlib.sha256()
+        if tarinfo.sparse is not None:
+            super(ChecksumTarFile, self).makefile(tarinfo, targetpath)
+            with open(targetpath, 'rb') as content:
+                for chunk in iter(lambda: content.read(COPY_SIZE), b''):
+                    digest.update(chunk)
+        else:
+            self.fileobj.seek(tarinfo.offset_data)
+            remaining = tarinfo.size
+            with open(targetpath, 'wb') as target:
+                while remaining:
+                    chunk = self.fileobj.read(min(COPY_SIZE, remaining))
+                    if not chunk:
+                        raise tarfile.ReadError('unexpected end of data')
+                    digest.update(chunk)
+                    target.write(chunk)
+                    remaining -= len(chunk)
+        self.checksums[tarinfo.name] = digest.hexdigest()
+
+    def extract_members(self):
+        """Yield the members to extract, the checksums member is kept"""
+        for tarinfo in self:
+            if tarinfo.name == CHECKSUMS_MEMBER:
+                self.expected = json.load(self.extractfile(tarinfo))
+            else:
+                yield tarinfo
+
+    def verify(self):
+        """Raise ValueError unless the extracted files match the checksums"""
+        if self.expected is None:
+            raise ValueError('Archive has no checksums')
+        if self.expected != self.checksums:
+            corrupted = sorted(
+                name for name in set(self.expected) | set(self.checksums)
+                if self.expected.get(name) != self.checksums.get(name)
+            )
+            raise ValueError('Checksum mismatch: {names}'.format(
+                names=', '.join(corrupted[:10])
+            ))
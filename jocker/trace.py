@@ -0,0 +1,141 @@
+"""
+Build, create and run tracing
+"""
+import os
+import json
+import time
+import threading
+
+
+class NullSpan(object):
+    """Span used while tracing is disabled, it does nothing"""
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """Timed section of the trace"""
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started = None
+
+    def set(self, **args):
+        """Add values to the span arguments"""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.add(self, time.perf_counter() - self.started)
+
+
+class Tracer(object):
+    """Collect spans and export them as a Chrome trace"""
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def span(self, name, category='jocker', **args):
+        """Return a new span"""
+        return Span(self, name, category, args)
+
+    def add(self, span, duration):
+        """Record a finished span"""
+        event = {
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': (span.started - self.origin) * 1e6,
+            'dur': duration * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': span.args
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def chrome_trace(self):
+        """Return the trace in Chrome/Perfetto JSON format"""
+        return {'traceEvents': [
+            dict(event, args={key: value if isinstance(value, (int, float))
+                              else str(value)
+                              for key, value in event['args'].items()})
+            for event in self.events
+        ]}
+
+    def write(self, path):
+        """Write the Chrome trace to path"""
+        with open(path, 'w') as output:
+            json.dump(self.chrome_trace(), output)
+
+    def summary(self):
+        """Return a text summary of spans by name, slowest first"""
+        totals = {}
+        for event in self.events:
+            name = '{cat}:{name}'.format(cat=event['cat'], name=event['name'])
+            total = totals.setdefault(name, {'count': 0, 'dur': 0.0,
+                                             'max': 0.0, 'bytes': 0,
+                                             'files': 0})
+            total['count'] += 1
+            total['dur'] += event['dur']
+            total['max'] = max(total['max'], event['dur'])
+            total['bytes'] += event['args'].get('bytes', 0)
+            total['files'] += event['args'].get('files', 0)
+
+        lines = ['{name:<30} {count:>6} {total:>10} {max:>10} {files:>8} '
+                 '{bytes:>14}'.format(name='span', count='count',
+                                      total='total ms', max='max ms',
+                                      files='files', bytes='bytes')]
+        for name, total in sorted(totals.items(),
+                                  key=lambda item: -item[1]['dur']):
+            lines.append(
+                '{name:<30} {count:>6} {total:>10.1f} {max:>10.1f} '
+                '{files:>8} {bytes:>14}'.format(
+                    name=name, count=total['count'],
+                    total=total['dur'] / 1000, max=total['max'] / 1000,
+                    files=total['files'], bytes=total['bytes']
+                )
+            )
+        return '\n'.join(lines)
+
+
+# active tracer, None while tracing is disabled
+tracer = None
+
+
+def enable():
+    """Start tracing and return the tracer"""
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+
+def disable():
+    """Stop tracing"""
+    global tracer
+    tracer = None
+
+
+def span(name, category='jocker', **args):
+    """
+    Return a span context manager, arguments are only converted to text
+    on export so the call is cheap and a no-op while disabled.
+    """
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, category, **args)
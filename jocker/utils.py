@@ -1,19 +1,220 @@
 import os
-from subprocess import PIPE, STDOUT, run
+import sys
+import time
+import signal
+import threading
+import contextvars
+from collections import deque
+from subprocess import PIPE, STDOUT, Popen, CalledProcessError
+
+from . import trace
+
+
+# Bytes of output kept from captured commands
+TAIL_SIZE = 1024 * 1024
+# Size of the reads from captured commands output
+READ_SIZE = 64 * 1024
+
+
+class Context(object):
+    """
+    Working directory and standard streams file descriptors that commands
+    run with, None stands for the ones of this process. The commands of a
+    cancellable context run in their own process group so cancel() can
+    interrupt them.
+    """
+    def __init__(self, cwd=None, stdin=None, stdout=None, stderr=None,
+                 log=None, cancellable=False):
+        self.cwd = cwd
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        # where log records go, stdout unless it carries data
+        self.log = stdout if log is None else log
+        self.cancellable = cancellable
+        self.lock = threading.Lock()
+        # process groups of the running and of the interrupted commands
+        self.groups = set()
+        self.interrupted = set()
+
+    def spawned(self, pid):
+        """Track the process group of the command pid"""
+        with self.lock:
+            self.groups.add(pid)
+
+    def reaped(self, pid):
+        """
+        Stop tracking the process group of the command pid, return True if
+        it was interrupted
+        """
+        with self.lock:
+            self.groups.discard(pid)
+            if pid in self.interrupted:
+                self.interrupted.discard(pid)
+                return True
+        return False
+
+    def cancel(self):
+        """
+        Send SIGINT to the running commands, like a Ctrl-C would, the
+        commands started later, to clean up, run normally
+        """
+        with self.lock:
+            groups = list(self.groups)
+            self.interrupted.update(groups)
+        for pid in groups:
+            try:
+                os.killpg(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+
+# context of the request being served, the daemon sets one per request
+CONTEXT = contextvars.ContextVar('jocker_context', default=Context())
+
+
+def abspath(path):
+    """Return path made absolute from the context working directory"""
+    cwd = CONTEXT.get().cwd
+    if cwd is None:
+        return os.path.abspath(path)
+    return os.path.normpath(os.path.join(cwd, path))
+
+
+def input_stream():
+    """Return a binary stream reading from the context stdin"""
+    stdin = CONTEXT.get().stdin
+    if stdin is None:
+        return sys.stdin.buffer
+    return open(stdin, 'rb', closefd=False)
+
+
+def output_stream():
+    """Return a binary stream writing to the context stdout"""
+    stdout = CONTEXT.get().stdout
+    if stdout is None:
+        return sys.stdout.buffer
+    return open(stdout, 'wb', buffering=0, closefd=False)
+
+
+def error_stream():
+    """Return a binary stream writing to the context stderr"""
+    stderr = CONTEXT.get().stderr
+    if stderr is None:
+        return sys.stderr.buffer
+    return open(stderr, 'wb', buffering=0, closefd=False)
+
+
+class OutputTail(object):
+    """Ring buffer keeping the last max_size bytes written to it"""
+    def __init__(self, max_size=TAIL_SIZE):
+        self.max_size = max_size
+        self.chunks = deque()
+        self.size = 0
+        self.truncated = False
+
+    def write(self, data):
+        """Append data, dropping the oldest bytes beyond max_size"""
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            extra = self.size - self.max_size
+            chunk = self.chunks.popleft()
+            if len(chunk) > extra:
+                self.chunks.appendleft(chunk[extra:])
+            self.size -= min(len(chunk), extra)
+            self.truncated = True
+
+    def getvalue(self):
+        """Return the kept bytes"""
+        return b''.join(self.chunks)
+
+
+class CommandResult(object):
+    """Exit code, duration and output tail of a finished command"""
+    def __init__(self, command, returncode, duration, tail=b'',
+                 truncated=False):
+        self.command = command
+        self.returncode = returncode
+        self.duration = duration
+        self.tail = tail
+        self.truncated = truncated
+
+    @property
+    def output(self):
+        """Decoded output tail"""
+        return self.tail.decode(errors='replace')
+
+    def check(self):
+        """Raise CalledProcessError if the command failed"""
+        if self.returncode:
+            raise CalledProcessError(self.returncode, self.command,
+                                     output=self.tail)
+        return self
+
+
+def execute(command, env=None, capture=False, on_output=None,
+            tail_size=TAIL_SIZE):
+    """
+    Run command, a list is executed directly and a string through the
+    shell. If capture is set or on_output given, stdout and stderr are read
+    through a pipe, passed to on_output chunk by chunk and only the last
+    tail_size bytes are kept, otherwise they are inherited.
+    """
+    started = time.monotonic()
+    shell = isinstance(command, str)
+    tail = OutputTail(tail_size)
+    context = CONTEXT.get()
+
+    with trace.span('run_command', 'command', command=command) as span:
+        if capture or on_output:
+            process = Popen(command, shell=shell, env=env, cwd=context.cwd,
+                            stdin=context.stdin, stdout=PIPE, stderr=STDOUT,
+                            start_new_session=context.cancellable)
+        else:
+            process = Popen(command, shell=shell, env=env, cwd=context.cwd,
+                            stdin=context.stdin, stdout=context.stdout,
+                            stderr=context.stderr,
+                            start_new_session=context.cancellable)
+        context.spawned(process.pid)
+        try:
+            if capture or on_output:
+                with process.stdout:
+                    for chunk in iter(
+                        lambda: process.stdout.read1(READ_SIZE), b''
+                    ):
+                        tail.write(chunk)
+                        if on_output:
+                            on_output(chunk)
+            process.wait()
+        finally:
+            interrupted = context.reaped(process.pid)
+        span.set(returncode=process.returncode)
+    if interrupted:
+        raise KeyboardInterrupt()
+
+    return CommandResult(command, process.returncode,
+                         time.monotonic() - started,
+                         tail=tail.getvalue(), truncated=tail.truncated)
 
 
 def run_command(command, args=None, env=None, check=False):
     """
-    Exec command with Popen
+    Exec command, if check is set the output is captured and returned,
+    otherwise it's inherited and a failure raises CalledProcessError.
     """
     if args:
-        command = '{command} {args}'.format(command=command, args=args)
+        if isinstance(command, str):
+            command = '{command} {args}'.format(command=command, args=args)
+        else:
+            command = list(command) + list(args)
 
-    os.environ.update(env or {})
+    # the environment is passed to the process only, os.environ is shared
+    # by every thread
+    if env:
+        env = dict(os.environ, **env)
 
     if check:
-        return run(
-            command, shell=True, stdout=PIPE, stderr=STDOUT
-        ).stdout.decode()
+        return execute(command, env=env, capture=True).output
     else:
-        return run(command, shell=True, check=True)
+        return execute(command, env=env).check()
@@ -0,0 +1,224 @@
+"""
+Versioned bases stored as file level deltas
+"""
+import os
+import json
+import errno
+import shutil
+import hashlib
+import logging
+from stat import S_IFMT, S_ISDIR, S_ISLNK, S_ISREG
+
+from . import trace
+from .archive import scan_tree, copy_entries, copy_metadata, stage_dir, \
+    publish_tree, CLONE, HARDLINK, COPY_WORKERS
+from .cache import CHUNK_SIZE
+
+
+logger = logging.getLogger('jocker')
+
+# directory of BASE_DIR keeping the versions of every base
+VERSIONS_DIR = '.versions'
+
+
+def file_digest(path):
+    """Return the sha256 of the content of the file at path"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as content:
+        for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_record(version, path, stat):
+    """
+    Return the manifest record of an entry: the version storing it, its
+    type, mode, owner, size, mtime and digest. The digest is the content
+    hash of a file, the target of a symlink or the device of a node.
+    """
+    digest = None
+    if S_ISLNK(stat.st_mode):
+        digest = os.readlink(path)
+    elif not S_ISREG(stat.st_mode) and not S_ISDIR(stat.st_mode):
+        digest = str(stat.st_rdev)
+    return [version, S_IFMT(stat.st_mode), stat.st_mode, stat.st_uid,
+            stat.st_gid, stat.st_size, stat.st_mtime_ns, digest]
+
+
+def same_entry(current, record):
+    """
+    Return True if the manifest records describe the same type, mode,
+    owner and content, whatever their mtime
+    """
+    return current is not None and current[1:5] == record[1:5] and \
+        current[7] == record[7]
+
+
+class BaseVersions(object):
+    """
+    Versions of a base, oldest first. Each version is stored under
+    <version>/ as a manifest of its whole tree and a data directory with
+    every directory of the tree but only the files added or changed since
+    the previous version, the manifest tells which version stores each
+    file. A version is materialized on demand under <version>/tree as
+    hardlinks to the data, so it costs directories only.
+    """
+    def __init__(self, versionsdir):
+        """Init versions stored at versionsdir"""
+        self.versionsdir = versionsdir
+
+    def index_path(self):
+        """Return the path of the list of versions"""
+        return os.path.join(self.versionsdir, 'versions.json')
+
+    def versions(self):
+        """Return the stored versions, oldest first"""
+        try:
+            with open(self.index_path(), 'r') as content:
+                return json.load(content)
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def save_versions(self, versions):
+        """Store the list of versions"""
+        path = self.index_path()
+        tmp = '{path}.tmp'.format(path=path)
+        with open(tmp, 'w') as content:
+            json.dump(versions, content)
+        os.rename(tmp, path)
+
+    def version_dir(self, version):
+        """Return the directory storing version"""
+        if not version or '/' in version or version.startswith('.'):
+            raise ValueError('Invalid version {version}'.format(
+                version=version
+            ))
+        return os.path.join(self.versionsdir, version)
+
+    def manifest(self, version):
+        """Return the manifest of version, mapping relpaths to records"""
+        path = os.path.join(self.version_dir(version), 'manifest.json')
+        try:
+            with open(path, 'r') as content:
+                return json.load(content)
+        except FileNotFoundError:
+            raise ValueError('No version {version} stored in {path}'.format(
+                version=version, path=self.versionsdir
+            ))
+
+    def add(self, version, src, mode=CLONE, workers=None):
+        """
+        Store the tree at src as version, after the current versions. The
+        latest version can be replaced, older ones can't since later
+        versions depend on them.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        versions = self.versions()
+        if version in versions[:-1]:
+            raise ValueError('Version {version} is not the latest, it '
+                             'cannot be replaced'.format(version=version))
+        previous = [known for known in versions if known != version]
+        base = self.manifest(previous[-1]) if previous else {}
+
+        with trace.span('version', 'versions', version=version) as span:
+            manifest = {}
+            stored = []
+            # files whose size or mtime changed, their content decides
+            unsure = []
+            for relpath, path, stat in scan_tree(src):
+                record = entry_record(version, path, stat)
+                current = base.get(relpath)
+                manifest[relpath] = record
+                if S_ISDIR(stat.st_mode):
+                    stored.append((relpath, path, stat))
+                elif S_ISREG(stat.st_mode):
+                    if current and current[1:7] == record[1:7]:
+                        manifest[relpath] = current
+                    else:
+                        unsure.append((relpath, path, stat))
+                elif same_entry(current, record):
+                    manifest[relpath] = current
+                else:
+                    stored.append((relpath, path, stat))
+
+            with ThreadPoolExecutor(max_workers=workers or COPY_WORKERS) \
+                    as executor:
+                digests = executor.map(file_digest,
+                                       [path for _, path, _ in unsure])
+                for (relpath, path, stat), digest in zip(unsure, digests):
+                    record = manifest[relpath]
+                    record[7] = digest
+                    current = base.get(relpath)
+                    if same_entry(current, record):
+                        # same content under a new mtime, as after a fresh
+                        # checkout, the stored file is kept
+                        manifest[relpath] = current
+                    else:
+                        stored.append((relpath, path, stat))
+
+            # parents are created before their content
+            stored.sort(key=lambda entry: entry[0])
+            target = self.version_dir(version)
+            staging = stage_dir(target)
+            try:
+                datadir = os.path.join(staging, 'data')
+                stats = copy_entries(stored, datadir, mode=mode,
+                                     update=False)
+                copy_metadata(src, datadir, os.lstat(src))
+                manifest_path = os.path.join(staging, 'manifest.json')
+                with open(manifest_path, 'w') as content:
+                    json.dump(manifest, content)
+                publish_tree(staging, target)
+            except BaseException:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+            self.save_versions(previous + [version])
+            span.set(files=stats.files, bytes=stats.bytes)
+
+        logger.debug('Stored version {version}: {files} of {total} entries '
+                     'changed'.format(version=version, files=stats.files,
+                                      total=len(manifest)))
+        return stats
+
+    def entries(self, version):
+        """
+        Return the (relpath, path, stat) entries of version in walk order,
+        the paths point to the data of the versions storing them
+        """
+        entries = []
+        for relpath, record in sorted(self.manifest(version).items()):
+            path = os.path.join(self.versionsdir, record[0], 'data', relpath)
+            entries.append((relpath, path, os.lstat(path)))
+        return entries
+
+    def materialize(self, version, dest=None, mode=HARDLINK):
+        """
+        Return a directory with the tree of version, dest if given else
+        the tree kept with the version, made with hardlinks to the data
+        on first use
+        """
+        datadir = os.path.join(self.version_dir(version), 'data')
+        if dest:
+            copy_entries(self.entries(version), dest, mode=mode)
+            copy_metadata(datadir, dest, os.lstat(datadir))
+            return dest
+
+        tree = os.path.join(self.version_dir(version), 'tree')
+        if os.path.isdir(tree):
+            return tree
+        with trace.span('materialize', 'versions', version=version):
+            staging = stage_dir(tree)
+            try:
+                copy_entries(self.entries(version), staging, mode=mode,
+                             update=False)
+                copy_metadata(datadir, staging, os.lstat(datadir))
+                os.rename(staging, tree)
+            except OSError as error:
+                shutil.rmtree(staging, ignore_errors=True)
+                # materialized meanwhile by someone else
+                if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+            except BaseException:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+        return tree
@@ -0,0 +1,24 @@
+"""
+Shared fixtures, every test runs against temporary directories
+"""
+import pytest
+
+from jocker import parser
+from jocker.backends.local import LocalBackend
+
+
+@pytest.fixture(autouse=True)
+def parse_cache(tmp_path, monkeypatch):
+    """Keep parsed Jockerfiles of the test to itself"""
+    monkeypatch.setattr(parser, 'PARSE_CACHE_DIR', str(tmp_path / 'parsed'))
+    monkeypatch.setattr(parser, 'PARSE_CACHE', {})
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    """Local backend with its jails, bases and cache in tmp_path"""
+    monkeypatch.setattr(LocalBackend, 'JAILS_DIR', str(tmp_path / 'jails'))
+    monkeypatch.setattr(LocalBackend, 'BASE_DIR', str(tmp_path / 'bases'))
+    monkeypatch.setattr(LocalBackend, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(LocalBackend, 'STORE_DIR', None)
+    return LocalBackend(None)
@@ -0,0 +1,52 @@
+"""
+asyncio command runner
+"""
+import time
+import asyncio
+from subprocess import CalledProcessError
+
+import pytest
+
+from jocker.backends.aio import run_command_async, READ_SIZE
+
+
+def run(command, **kwargs):
+    lines = []
+    asyncio.run(run_command_async(
+        command, on_output=lambda stream, line: lines.append((stream, line)),
+        **kwargs
+    ))
+    return lines
+
+
+def test_streams_lines_of_stdout_and_stderr():
+    lines = run('echo one; echo two >&2; printf three')
+    assert sorted(lines) == [('stderr', b'two\n'), ('stdout', b'one\n'),
+                             ('stdout', b'three')]
+
+
+def test_long_lines_are_passed_in_pieces():
+    lines = run(['sh', '-c', 'head -c {size} /dev/zero; echo'.format(
+        size=READ_SIZE * 3
+    )])
+    assert b''.join(line for _, line in lines) == b'\0' * READ_SIZE * 3 + \
+        b'\n'
+    assert max(len(line) for _, line in lines) < 2 * READ_SIZE
+
+
+def test_environment():
+    assert run('echo "$NAME"', env={'NAME': 'jail'}) == [('stdout',
+                                                         b'jail\n')]
+
+
+def test_failure():
+    with pytest.raises(CalledProcessError) as error:
+        run('exit 4')
+    assert error.value.returncode == 4
+
+
+def test_timeout_kills_the_command_and_its_children():
+    started = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        run('sleep 10 | cat', timeout=0.2)
+    assert time.monotonic() - started < 5
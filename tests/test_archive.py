@@ -0,0 +1,219 @@
+"""
+Copy engine and tar archives
+"""
+import io
+import os
+import tarfile
+
+import pytest
+
+from jocker.archive import copy_tree, compress, decompress, extract_all, \
+    COPY, HARDLINK
+
+
+def write(path, content=b'data', mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as target:
+        target.write(content)
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+    return path
+
+
+def read(path):
+    with open(path, 'rb') as content:
+        return content.read()
+
+
+def inode(path):
+    stat = os.lstat(path)
+    return stat.st_dev, stat.st_ino
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / 'src'
+    write(str(path / 'etc' / 'rc.conf'), b'sshd_enable="YES"\n')
+    write(str(path / 'bin' / 'sh'), os.urandom(64 * 1024))
+    os.link(str(path / 'bin' / 'sh'), str(path / 'bin' / 'ksh'))
+    os.symlink('sh', str(path / 'bin' / 'bash'))
+    os.makedirs(str(path / 'var' / 'empty'))
+    return str(path)
+
+
+def test_copy_keeps_content_links_and_symlinks(tmp_path, src):
+    dest = str(tmp_path / 'dest')
+    stats = copy_tree(src, dest)
+    assert read(os.path.join(dest, 'etc', 'rc.conf')) == \
+        read(os.path.join(src, 'etc', 'rc.conf'))
+    assert read(os.path.join(dest, 'bin', 'sh')) == \
+        read(os.path.join(src, 'bin', 'sh'))
+    assert os.readlink(os.path.join(dest, 'bin', 'bash')) == 'sh'
+    assert os.path.isdir(os.path.join(dest, 'var', 'empty'))
+    assert stats.files == 2
+    assert stats.links == 1
+
+
+def test_copy_keeps_hardlinks_within_the_tree(tmp_path, src):
+    dest = str(tmp_path / 'dest')
+    copy_tree(src, dest)
+    assert inode(os.path.join(dest, 'bin', 'sh')) == \
+        inode(os.path.join(dest, 'bin', 'ksh'))
+    assert inode(os.path.join(dest, 'bin', 'sh')) != \
+        inode(os.path.join(src, 'bin', 'sh'))
+
+
+def test_hardlink_mode_shares_inodes(tmp_path, src):
+    dest = str(tmp_path / 'dest')
+    copy_tree(src, dest, mode=HARDLINK)
+    assert inode(os.path.join(dest, 'etc', 'rc.conf')) == \
+        inode(os.path.join(src, 'etc', 'rc.conf'))
+
+
+def test_copy_mode_never_shares_inodes(tmp_path, src):
+    dest = str(tmp_path / 'dest')
+    copy_tree(src, dest, mode=COPY)
+    with open(os.path.join(dest, 'etc', 'rc.conf'), 'ab') as target:
+        target.write(b'changed\n')
+    assert read(os.path.join(src, 'etc', 'rc.conf')) == \
+        b'sshd_enable="YES"\n'
+
+
+def test_sparse_file_stays_sparse(tmp_path):
+    size = 64 * 1024 * 1024
+    path = str(tmp_path / 'src' / 'disk.img')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as target:
+        target.write(b'head')
+        target.seek(size - 4)
+        target.write(b'tail')
+    if os.stat(path).st_blocks * 512 >= size:
+        pytest.skip('filesystem without sparse files')
+    dest = str(tmp_path / 'dest')
+    copy_tree(str(tmp_path / 'src'), dest)
+    copied = os.path.join(dest, 'disk.img')
+    assert os.stat(copied).st_size == size
+    assert os.stat(copied).st_blocks * 512 < size
+    with open(copied, 'rb') as content:
+        assert content.read(4) == b'head'
+        content.seek(size - 4)
+        assert content.read() == b'tail'
+
+
+def test_incremental_copy_skips_unchanged_files(tmp_path, src):
+    dest = str(tmp_path / 'dest')
+    copy_tree(src, dest)
+    stats = copy_tree(src, dest)
+    assert stats.skipped == stats.files
+    assert stats.bytes == 0
+
+
+def test_incremental_copy_recopies_changed_files(tmp_path, src):
+    dest = str(tmp_path / 'dest')
+    copy_tree(src, dest)
+    write(os.path.join(src, 'etc', 'rc.conf'), b'sshd_enable="NO"\n',
+          mtime=10 ** 18)
+    stats = copy_tree(src, dest)
+    assert stats.skipped == stats.files - 1
+    assert read(os.path.join(dest, 'etc', 'rc.conf')) == \
+        b'sshd_enable="NO"\n'
+
+
+def test_archive_roundtrip_with_checksums(tmp_path, src):
+    archive = io.BytesIO()
+    compress(src, archive, checksums=True)
+    archive.seek(0)
+    dest = str(tmp_path / 'dest')
+    decompress(archive, dest, checksums=True)
+    assert read(os.path.join(dest, 'bin', 'sh')) == \
+        read(os.path.join(src, 'bin', 'sh'))
+    assert os.readlink(os.path.join(dest, 'bin', 'bash')) == 'sh'
+
+
+def test_decompress_stream_needs_a_directory(src):
+    archive = io.BytesIO()
+    compress(src, archive)
+    archive.seek(0)
+    with pytest.raises(ValueError):
+        decompress(archive)
+
+
+def tampered(archive, name, content):
+    """Return a copy of the archive with the content of name replaced"""
+    archive.seek(0)
+    copy = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='r:gz') as source, \
+            tarfile.open(fileobj=copy, mode='w:gz',
+                         format=tarfile.PAX_FORMAT) as target:
+        for member in source:
+            data = source.extractfile(member) if member.isreg() else None
+            if member.name == name:
+                member.size = len(content)
+                data = io.BytesIO(content)
+            target.addfile(member, data)
+    copy.seek(0)
+    return copy
+
+
+def test_changed_file_fails_the_checksums(tmp_path, src):
+    archive = io.BytesIO()
+    compress(src, archive, checksums=True)
+    archive = tampered(archive, './etc/rc.conf', b'sshd_enable="NO"\n')
+    with pytest.raises(ValueError):
+        decompress(archive, str(tmp_path / 'dest'), checksums=True)
+
+
+def test_missing_checksums_fail(tmp_path, src):
+    archive = io.BytesIO()
+    compress(src, archive)
+    archive.seek(0)
+    with pytest.raises(ValueError):
+        decompress(archive, str(tmp_path / 'dest'), checksums=True)
+
+
+def member(name, type=tarfile.REGTYPE, linkname='', content=b''):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.type = type
+    tarinfo.linkname = linkname
+    tarinfo.size = len(content) if type == tarfile.REGTYPE else 0
+    return tarinfo, io.BytesIO(content) if content else None
+
+
+def archive_of(*members):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for tarinfo, content in members:
+            tar.addfile(tarinfo, content)
+    archive.seek(0)
+    return archive
+
+
+@pytest.mark.parametrize('members', [
+    [member('../escaped', content=b'x')],
+    [member('./a/../../escaped', content=b'x')],
+    [member('/tmp/escaped', content=b'x')],
+    [member('out', tarfile.SYMTYPE, linkname='..'),
+     member('out/escaped', content=b'x')],
+    [member('up', tarfile.SYMTYPE, linkname='../..')],
+    [member('passwd', tarfile.LNKTYPE, linkname='../etc/passwd')],
+    [member('link', tarfile.SYMTYPE, linkname='/etc/passwd'),
+     member('passwd', tarfile.LNKTYPE, linkname='link')],
+], ids=['parent', 'nested-parent', 'absolute', 'through-symlink',
+        'symlink-above', 'hardlink-out', 'hardlink-to-symlink'])
+def test_members_leaving_the_tree_are_rejected(tmp_path, members):
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    with tarfile.open(fileobj=archive_of(*members), mode='r') as tar:
+        with pytest.raises(ValueError):
+            extract_all(tar, str(dest))
+    assert not (tmp_path / 'escaped').exists()
+
+
+def test_absolute_symlinks_are_kept(tmp_path):
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    archive = archive_of(member('localtime', tarfile.SYMTYPE,
+                                linkname='/usr/share/zoneinfo/UTC'))
+    with tarfile.open(fileobj=archive, mode='r') as tar:
+        extract_all(tar, str(dest))
+    assert os.readlink(str(dest / 'localtime')) == '/usr/share/zoneinfo/UTC'
@@ -0,0 +1,107 @@
+"""
+Layer cache, incremental builds must match full ones
+"""
+import os
+import stat
+import logging
+import shutil
+
+import pytest
+
+from jocker.parser import Jockerfile
+
+
+def write(path, content=b'data', mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as target:
+        target.write(content)
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+    return path
+
+
+def snapshot(root):
+    """Return relpath -> (type and mode, content) of the tree at root"""
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            info = os.lstat(path)
+            if stat.S_ISLNK(info.st_mode):
+                content = os.readlink(path)
+            elif stat.S_ISREG(info.st_mode):
+                with open(path, 'rb') as data:
+                    content = data.read()
+            else:
+                content = None
+            tree[os.path.relpath(path, root)] = (info.st_mode, content)
+    return tree
+
+
+@pytest.fixture
+def project(tmp_path, backend):
+    """Installed base os and a Jockerfile adding a context on top of it"""
+    base = os.path.join(backend.BASE_DIR, 'os')
+    write(os.path.join(base, 'etc', 'rc.conf'), b'base\n')
+    write(os.path.join(base, 'bin', 'sh'), b'shell\n')
+    write(os.path.join(base, 'etc', 'Jockerfile'), b'NAME os\n')
+    context = str(tmp_path / 'context')
+    write(os.path.join(context, 'etc', 'rc.conf'), b'app\n')
+    write(os.path.join(context, 'app', 'main.py'), b'main\n')
+    write(os.path.join(context, 'app', 'lib', 'util.py'), b'util\n')
+    os.symlink('main.py', os.path.join(context, 'app', 'run'))
+    path = write(str(tmp_path / 'Jockerfile'),
+                 'NAME app\nFROM os\nADD {context} /\n'.format(
+                     context=context).encode())
+    return context, path
+
+
+def build(backend, path, outdir, cache=True):
+    backend.build(Jockerfile(path), build=str(outdir), cache=cache)
+    return snapshot(os.path.join(str(outdir), 'app'))
+
+
+def test_cached_build_matches_full_build(tmp_path, backend, project):
+    context, path = project
+    first = build(backend, path, tmp_path / 'first')
+    assert first['etc/rc.conf'][1] == b'app\n'
+    assert build(backend, path, tmp_path / 'cached') == first
+    assert build(backend, path, tmp_path / 'full', cache=False) == first
+
+
+def test_stale_incremental_build_matches_full_build(tmp_path, backend,
+                                                    project, caplog):
+    caplog.set_level(logging.INFO, logger='jocker')
+    context, path = project
+    build(backend, path, tmp_path / 'first')
+
+    # changed, removed, added and a file that hid one of the base removed
+    write(os.path.join(context, 'app', 'main.py'), b'main v2\n',
+          mtime=10 ** 18)
+    os.remove(os.path.join(context, 'app', 'lib', 'util.py'))
+    write(os.path.join(context, 'app', 'new.py'), b'new\n')
+    os.remove(os.path.join(context, 'etc', 'rc.conf'))
+    os.utime(context, ns=(10 ** 18, 10 ** 18))
+
+    incremental = build(backend, path, tmp_path / 'incremental')
+    assert 'Cache stale layer' in caplog.text
+    full = build(backend, path, tmp_path / 'full', cache=False)
+    assert incremental == full
+    assert incremental['etc/rc.conf'][1] == b'base\n'
+    assert incremental['app/main.py'][1] == b'main v2\n'
+    assert 'app/lib/util.py' not in incremental
+
+
+def test_replaced_directory_matches_full_build(tmp_path, backend, project):
+    context, path = project
+    build(backend, path, tmp_path / 'first')
+
+    shutil.rmtree(os.path.join(context, 'app', 'lib'))
+    write(os.path.join(context, 'app', 'lib'), b'now a file\n')
+    os.remove(os.path.join(context, 'app', 'run'))
+    os.symlink('new.py', os.path.join(context, 'app', 'run'))
+
+    incremental = build(backend, path, tmp_path / 'incremental')
+    full = build(backend, path, tmp_path / 'full', cache=False)
+    assert incremental == full
+    assert incremental['app/lib'][1] == b'now a file\n'
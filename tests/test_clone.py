@@ -0,0 +1,63 @@
+"""
+Jail roots cloned from their base
+"""
+import os
+
+import pytest
+
+from jocker.archive import CLONE, COPY, HARDLINK, REFLINK
+
+
+def write(path, content=b'data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as target:
+        target.write(content)
+    return path
+
+
+def read(path):
+    with open(path, 'rb') as content:
+        return content.read()
+
+
+def inode(path):
+    stat = os.lstat(path)
+    return stat.st_dev, stat.st_ino
+
+
+@pytest.fixture
+def base(backend):
+    path = os.path.join(backend.BASE_DIR, 'os')
+    write(os.path.join(path, 'etc', 'rc.conf'), b'base\n')
+    write(os.path.join(path, 'bin', 'sh'), b'shell\n')
+    return path
+
+
+@pytest.mark.parametrize('mode', [COPY, REFLINK, CLONE])
+def test_writes_never_reach_the_base(backend, base, mode):
+    backend.clone_base('os', mode=mode)
+    jaildir = backend.jaildir()
+    for relpath in ('etc/rc.conf', 'bin/sh'):
+        assert inode(os.path.join(jaildir, relpath)) != \
+            inode(os.path.join(base, relpath))
+        with open(os.path.join(jaildir, relpath), 'r+b') as target:
+            target.write(b'JAIL')
+    assert read(os.path.join(base, 'etc', 'rc.conf')) == b'base\n'
+    assert read(os.path.join(base, 'bin', 'sh')) == b'shell\n'
+
+
+def test_hardlinks_need_read_only_jails(backend, base):
+    with pytest.raises(ValueError):
+        backend.clone_base('os', mode=HARDLINK)
+    assert not os.path.exists(backend.jaildir())
+
+
+def test_hardlinks_copy_up_writable_dirs(backend, base, monkeypatch):
+    monkeypatch.setattr(backend, 'CREATE_READ_ONLY', True)
+    backend.clone_base('os', mode=HARDLINK)
+    jaildir = backend.jaildir()
+    assert inode(os.path.join(jaildir, 'bin', 'sh')) == \
+        inode(os.path.join(base, 'bin', 'sh'))
+    assert inode(os.path.join(jaildir, 'etc', 'rc.conf')) != \
+        inode(os.path.join(base, 'etc', 'rc.conf'))
+    assert read(os.path.join(jaildir, 'etc', 'rc.conf')) == b'base\n'
@@ -0,0 +1,101 @@
+"""
+Jocker daemon requests
+"""
+import os
+import sys
+import stat
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+import pytest
+
+from jocker import daemon
+from jocker.utils import run_command
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.01)
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+@pytest.fixture
+def fds():
+    fds = [os.open(os.devnull, os.O_RDWR) for _ in range(3)]
+    yield fds
+    for fd in fds:
+        os.close(fd)
+
+
+def sleeper(tmp_path):
+    """Parser whose command records its pid and sleeps"""
+    pidfile = str(tmp_path / 'pid')
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(func=lambda args: run_command(
+        ['sh', '-c', 'echo $$ > {pidfile}; exec sleep 30'.format(
+            pidfile=pidfile)]
+    ))
+    return parser, pidfile
+
+
+def test_closed_client_interrupts_the_command(tmp_path, fds):
+    parser, pidfile = sleeper(tmp_path)
+    server, client = socket.socketpair()
+    with server:
+        started = time.monotonic()
+        with client:
+            statuses = []
+            thread = threading.Thread(target=lambda: statuses.append(
+                daemon.execute_request({'argv': [], 'cwd': str(tmp_path)},
+                                       fds, parser, client=server)
+            ))
+            thread.start()
+            wait_for(lambda: os.path.exists(pidfile) and
+                     os.path.getsize(pidfile))
+            with open(pidfile) as content:
+                pid = int(content.read())
+        thread.join(10)
+    assert statuses == [130]
+    assert time.monotonic() - started < 10
+    wait_for(lambda: not alive(pid))
+
+
+def test_connected_client_lets_the_command_finish(tmp_path, fds):
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(func=lambda args: run_command(['true']))
+    server, client = socket.socketpair()
+    with server, client:
+        status = daemon.execute_request({'argv': [], 'cwd': str(tmp_path)},
+                                        fds, parser, client=server)
+    assert status == 0
+
+
+def test_socket_is_private_from_the_start(tmp_path):
+    path = str(tmp_path / 'jocker.sock')
+    process = subprocess.Popen([
+        sys.executable, '-c',
+        'from jocker.run import parser\n'
+        'from jocker.daemon import serve\n'
+        'serve(parser, path={path!r})\n'.format(path=path)
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(lambda: os.path.exists(path))
+        mode = os.stat(path).st_mode
+        assert stat.S_ISSOCK(mode)
+        assert stat.S_IMODE(mode) == 0o600
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,108 @@
+"""
+Jail volume mounts
+"""
+import os
+
+import pytest
+
+from jocker import mounts
+from jocker.mounts import MountManager
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    """Mounts of jail web recording the mount commands to a file"""
+    calls = str(tmp_path / 'calls')
+    monkeypatch.setattr(MountManager, 'MOUNTS_DIR', str(tmp_path / 'journal'))
+    monkeypatch.setattr(MountManager, 'MOUNT',
+                        ['sh', '-c', 'echo mount "$@" >> ' + calls, 'mount'])
+    monkeypatch.setattr(MountManager, 'UMOUNT',
+                        ['sh', '-c', 'echo umount "$@" >> ' + calls,
+                         'umount'])
+    manager = MountManager('web')
+    manager.calls = calls
+    return manager
+
+
+def table(monkeypatch, *entries):
+    monkeypatch.setattr(mounts, 'mount_table',
+                        lambda: [(source, mountpoint, 'nullfs')
+                                 for source, mountpoint in entries])
+
+
+def calls(manager):
+    try:
+        with open(manager.calls) as content:
+            return content.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def test_plan_mounts_missing_volumes_parents_first(manager):
+    manager.volumes = {'/j/data/logs': '/srv/logs', '/j/data': '/srv/data'}
+    umounts, mounts_ = manager.plan([], set(manager.volumes))
+    assert umounts == []
+    assert mounts_ == [('/srv/data', '/j/data'),
+                       ('/srv/logs', '/j/data/logs')]
+
+
+def test_plan_keeps_mounted_volumes(manager):
+    manager.volumes = {'/j/data': '/srv/data'}
+    umounts, mounts_ = manager.plan([('/srv/data', '/j/data', 'nullfs')],
+                                    {'/j/data'})
+    assert (umounts, mounts_) == ([], [])
+
+
+def test_plan_remounts_children_of_a_changed_parent(manager):
+    manager.volumes = {'/j/data': '/srv/other', '/j/data/logs': '/srv/logs',
+                       '/j/cache': '/srv/cache'}
+    mounted = [('/srv/data', '/j/data', 'nullfs'),
+               ('/srv/logs', '/j/data/logs', 'nullfs'),
+               ('/srv/cache', '/j/cache', 'nullfs')]
+    umounts, mounts_ = manager.plan(mounted, set(manager.volumes))
+    assert umounts == ['/j/data/logs', '/j/data']
+    assert mounts_ == [('/srv/other', '/j/data'),
+                       ('/srv/logs', '/j/data/logs')]
+
+
+def test_plan_remounts_children_of_a_new_parent(manager):
+    manager.volumes = {'/j/data': '/srv/data', '/j/data/logs': '/srv/logs'}
+    umounts, mounts_ = manager.plan([('/srv/logs', '/j/data/logs', 'nullfs')],
+                                    set(manager.volumes))
+    assert umounts == ['/j/data/logs']
+    assert mounts_ == [('/srv/data', '/j/data'),
+                       ('/srv/logs', '/j/data/logs')]
+
+
+def test_plan_leaves_siblings_alone(manager):
+    manager.volumes = {'/j/data': '/srv/other', '/j/data-old': '/srv/old'}
+    mounted = [('/srv/data', '/j/data', 'nullfs'),
+               ('/srv/old', '/j/data-old', 'nullfs')]
+    umounts, mounts_ = manager.plan(mounted, set(manager.volumes))
+    assert umounts == ['/j/data']
+    assert mounts_ == [('/srv/other', '/j/data')]
+
+
+def test_apply_umounts_journal_leftovers_without_volumes(manager,
+                                                         monkeypatch):
+    manager.save_journal({'/j/data'})
+    table(monkeypatch, ('/srv/data', '/j/data'), ('devfs', '/j/dev'))
+    manager.apply()
+    assert calls(manager) == ['umount /j/data']
+    assert manager.load_journal() == set()
+
+
+def test_apply_without_journal_or_volumes_does_nothing(manager,
+                                                       monkeypatch):
+    monkeypatch.setattr(mounts, 'mount_table', pytest.fail)
+    manager.apply()
+    assert calls(manager) == []
+
+
+def test_apply_mounts_and_records_volumes(manager, monkeypatch):
+    table(monkeypatch)
+    manager.add('/srv/data', '/j/data')
+    manager.apply()
+    assert calls(manager) == ['mount /srv/data /j/data']
+    assert manager.load_journal() == {'/j/data'}
+    assert os.path.exists(manager.journal_path())
@@ -0,0 +1,76 @@
+"""
+Jockerfile parsing and its on-disk cache
+"""
+import os
+
+import pytest
+
+from jocker import parser
+from jocker.commands import CommandEnv, CommandName, CommandRun
+
+
+@pytest.fixture
+def cache_dir():
+    return parser.PARSE_CACHE_DIR
+
+
+def write(path, content, mtime=None):
+    with open(path, 'w') as jockerfile:
+        jockerfile.write(content)
+    if mtime:
+        os.utime(path, ns=(mtime, mtime))
+    return path
+
+
+def commands(jockerfile):
+    return [(type(command), command.value) for command in jockerfile.commands]
+
+
+def test_parse_joins_split_lines(tmp_path, cache_dir):
+    path = write(str(tmp_path / 'Jockerfile'),
+                 'NAME web\nENV A 1\nRUN echo \\\n  $A\n')
+    assert commands(parser.Jockerfile(path)) == [
+        (CommandName, 'web'), (CommandEnv, 'A 1'), (CommandRun, 'echo $A')
+    ]
+
+
+def test_parsed_commands_are_kept_on_disk(tmp_path, cache_dir,
+                                          monkeypatch):
+    path = write(str(tmp_path / 'Jockerfile'), 'NAME web\nRUN true\n')
+    first = commands(parser.Jockerfile(path))
+    assert len(os.listdir(cache_dir)) == 1
+
+    # a new process only has the disk cache, the file isn't read again
+    parser.PARSE_CACHE.clear()
+
+    def read_lines(path):
+        raise AssertionError('Jockerfile read again')
+
+    monkeypatch.setattr(parser, 'read_lines', read_lines)
+    assert commands(parser.Jockerfile(path)) == first
+
+
+def test_changed_jockerfile_is_parsed_again(tmp_path, cache_dir):
+    path = write(str(tmp_path / 'Jockerfile'), 'NAME web\n', mtime=10 ** 18)
+    assert commands(parser.Jockerfile(path)) == [(CommandName, 'web')]
+    parser.PARSE_CACHE.clear()
+    write(path, 'NAME api\n', mtime=10 ** 18 + 1)
+    assert commands(parser.Jockerfile(path)) == [(CommandName, 'api')]
+
+
+def test_unwritable_cache_is_ignored(tmp_path, monkeypatch):
+    blocker = write(str(tmp_path / 'file'), '')
+    monkeypatch.setattr(parser, 'PARSE_CACHE_DIR',
+                        os.path.join(blocker, 'parsed'))
+    path = write(str(tmp_path / 'Jockerfile'), 'NAME web\n')
+    assert commands(parser.Jockerfile(path)) == [(CommandName, 'web')]
+
+
+def test_env_snapshots(tmp_path, cache_dir):
+    path = write(str(tmp_path / 'Jockerfile'),
+                 'NAME web\nENV A 1\nRUN one\nENV A 2\nENV B 3\nRUN two\n')
+    jockerfile = parser.Jockerfile(path)
+    run_one, run_two = jockerfile.filter_commands(CommandRun)
+    assert jockerfile.env(jockerfile.index_of(run_one)) == {'A': '1'}
+    assert jockerfile.env(jockerfile.index_of(run_two)) == {'A': '2',
+                                                           'B': '3'}
@@ -0,0 +1,107 @@
+"""
+Jail registry against a fake jls
+"""
+import os
+import sys
+import subprocess
+
+import pytest
+
+from jocker.backends.registry import JailRegistry
+
+
+FAKE_JLS = """\
+import os, sys
+here = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(here, 'calls'), 'a') as calls:
+    calls.write(' '.join(sys.argv[1:]) + '\\n')
+with open(os.path.join(here, 'jails')) as jails:
+    sys.stdout.write(jails.read())
+sys.exit(int(os.environ.get('FAKE_JLS_STATUS', 0)))
+"""
+
+
+class FakeJls(object):
+    """jls listing the content of a file and recording its calls"""
+    def __init__(self, path):
+        self.path = path
+        self.script = os.path.join(path, 'jls.py')
+        with open(self.script, 'w') as script:
+            script.write(FAKE_JLS)
+        self.list()
+
+    def list(self, *lines):
+        with open(os.path.join(self.path, 'jails'), 'w') as jails:
+            jails.write(''.join(line + '\n' for line in lines))
+
+    def calls(self):
+        try:
+            with open(os.path.join(self.path, 'calls')) as calls:
+                return calls.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+
+@pytest.fixture
+def jls(tmp_path):
+    return FakeJls(str(tmp_path))
+
+
+@pytest.fixture
+def registry(jls):
+    return JailRegistry(jls=[sys.executable, jls.script])
+
+
+def test_parses_jid_and_name(jls, registry):
+    jls.list('1 web', '2 db', '', 'garbage', '3 too many values')
+    assert registry.jails() == {'web': '1', 'db': '2'}
+    assert jls.calls() == ['jid name']
+
+
+def test_jails_are_cached_until_invalidated(jls, registry):
+    jls.list('1 web')
+    assert registry.jails() == {'web': '1'}
+    jls.list('1 web', '2 db')
+    assert registry.jails() == {'web': '1'}
+    assert len(jls.calls()) == 1
+
+    registry.invalidate()
+    assert registry.jails() == {'web': '1', 'db': '2'}
+    assert len(jls.calls()) == 2
+
+
+def test_jid_reloads_a_stale_registry(jls, registry):
+    jls.list('1 web')
+    assert registry.jid('web') == '1'
+    # started by somebody else since the registry was loaded
+    jls.list('1 web', '2 db')
+    assert registry.jid('db') == '2'
+    assert len(jls.calls()) == 2
+
+
+def test_jid_of_a_missing_jail(jls, registry):
+    jls.list('1 web')
+    with pytest.raises(ValueError):
+        registry.jid('db')
+    assert len(jls.calls()) == 2
+
+
+def test_state(jls, registry):
+    jls.list('1 web')
+    assert registry.state('web') == 'running'
+    assert registry.state('db') == 'stopped'
+
+
+def test_stopped_jail_stays_listed_until_invalidated(jls, registry):
+    jls.list('1 web')
+    assert registry.state('web') == 'running'
+    jls.list()
+    assert registry.state('web') == 'running'
+    registry.invalidate()
+    assert registry.state('web') == 'stopped'
+
+
+def test_jls_failure(jls, registry, monkeypatch):
+    monkeypatch.setenv('FAKE_JLS_STATUS', '1')
+    with pytest.raises(subprocess.CalledProcessError):
+        registry.jails()
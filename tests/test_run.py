@@ -0,0 +1,36 @@
+"""
+Command line errors
+"""
+import io
+import tarfile
+
+import pytest
+
+from jocker import run
+
+
+@pytest.fixture
+def cli(backend, monkeypatch):
+    """Run the command line with the local backend and without daemon"""
+    monkeypatch.setenv('JOCKER_BACKEND', 'local')
+    monkeypatch.setenv('JOCKER_NO_DAEMON', '1')
+    monkeypatch.setattr(run, 'setup_logging', lambda stream=None: None)
+    return run.main
+
+
+def test_import_of_an_unsafe_archive_is_an_error(tmp_path, cli):
+    path = str(tmp_path / 'evil.tar')
+    with tarfile.open(path, 'w') as tar:
+        tarinfo = tarfile.TarInfo('../evil')
+        tarinfo.size = 4
+        tar.addfile(tarinfo, io.BytesIO(b'evil'))
+    with pytest.raises(SystemExit) as error:
+        cli(['import', path, '--name', 'evil'])
+    assert 'leaves the tree' in str(error.value.code)
+    assert not (tmp_path / 'evil').exists()
+
+
+def test_export_of_a_missing_base_is_an_error(tmp_path, cli):
+    with pytest.raises(SystemExit) as error:
+        cli(['export', 'missing', '--output', str(tmp_path / 'out.tgz')])
+    assert str(error.value.code) == 'No base missing installed'
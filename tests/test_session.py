@@ -0,0 +1,88 @@
+"""
+Persistent exec sessions
+"""
+import io
+from subprocess import CalledProcessError
+
+import pytest
+
+from jocker.backends.local import LocalBackend
+from jocker.backends.session import ExecSession
+
+
+@pytest.fixture
+def output():
+    return io.BytesIO()
+
+
+@pytest.fixture
+def session(output):
+    with ExecSession(['/bin/sh'], output=output) as session:
+        yield session
+
+
+def test_output_and_status(session, output):
+    assert session.exec('echo hello; echo world >&2').returncode == 0
+    assert output.getvalue() == b'hello\nworld\n'
+
+
+def test_output_without_trailing_newline(session, output):
+    session.exec('printf partial')
+    session.exec('echo next')
+    assert output.getvalue() == b'partialnext\n'
+
+
+def test_failing_command_keeps_the_session(session, output):
+    with pytest.raises(CalledProcessError) as error:
+        session.exec('echo failing; exit 3')
+    assert error.value.returncode == 3
+    session.exec('echo still running')
+    assert output.getvalue() == b'failing\nstill running\n'
+
+
+def test_output_containing_a_marker(session, output):
+    session.exec('true')
+    marker = session.marker.decode()
+    # a marker seen before, alone on its line with a status, as the session
+    # writes it
+    with pytest.raises(CalledProcessError) as error:
+        session.exec('echo "{marker} 0"; echo after; exit 2'.format(
+            marker=marker
+        ))
+    assert error.value.returncode == 2
+    assert output.getvalue() == '{marker} 0\nafter\n'.format(
+        marker=marker
+    ).encode()
+
+
+def test_large_output(session, output):
+    session.exec('head -c 3000000 /dev/zero')
+    assert output.getvalue() == b'\0' * 3000000
+
+
+def test_environment_and_stdin(session, output):
+    session.exec('echo "$NAME"; cat', NAME="it's")
+    session.exec('echo "[$NAME]"')
+    assert output.getvalue() == b"it's\n[]\n"
+
+
+def test_closed_session(session):
+    session.exec('true')
+    with pytest.raises(RuntimeError):
+        session.exec('kill -9 $$')
+
+
+def test_local_backend_session(tmp_path, monkeypatch, output):
+    monkeypatch.setattr(LocalBackend, 'JAILS_DIR', str(tmp_path))
+    backend = LocalBackend('session-test')
+    backend.start()
+    try:
+        with backend.session() as session:
+            session.output = output
+            session.exec('echo "$((6 * 7))"')
+            with pytest.raises(CalledProcessError):
+                session.exec('false')
+        assert output.getvalue() == b'42\n'
+    finally:
+        backend.stop()
+    assert not backend.running()
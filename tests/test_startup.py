@@ -0,0 +1,48 @@
+"""
+CLI startup budget, every check runs in a new interpreter
+"""
+import sys
+import json
+import subprocess
+
+import pytest
+
+from benchmarks.startup import STARTUP_PATHS, check, loaded
+
+
+BUDGET = 0.1
+
+HELP_PROBE = """
+import sys, json, runpy
+sys.argv = ['jocker'] + {argv!r}
+try:
+    runpy.run_module('jocker.run', run_name='__main__')
+except SystemExit:
+    pass
+sys.stdout.flush()
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+"""
+
+
+def run_modules(*argv):
+    """Return the output and the modules loaded running the CLI with argv"""
+    process = subprocess.run(
+        [sys.executable, '-c', HELP_PROBE.format(argv=list(argv))],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+    )
+    return process.stdout, json.loads(process.stderr)
+
+
+@pytest.mark.parametrize('module', sorted(STARTUP_PATHS))
+def test_import_within_budget(module):
+    duration, errors = check(module, STARTUP_PATHS[module], BUDGET, 5)
+    assert errors == []
+
+
+@pytest.mark.parametrize('argv', [['--help'], ['build', '--help'],
+                                  ['run', '--help']],
+                         ids=['help', 'build-help', 'run-help'])
+def test_help_skips_the_build_machinery(argv):
+    output, modules = run_modules(*argv)
+    assert output.startswith(b'usage:')
+    assert loaded(modules, ['jinja2', 'jocker.build', 'jocker.cache']) == []
@@ -0,0 +1,100 @@
+"""
+Content addressed store
+"""
+import os
+
+import pytest
+
+from jocker.store import ContentStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ContentStore(str(tmp_path / 'store'))
+
+
+def write(path, content, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as target:
+        target.write(content)
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+    return path
+
+
+def inode(path):
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+def test_same_content_and_mtime_is_shared(tmp_path, store):
+    first = write(str(tmp_path / 'a' / 'file'), b'data', mtime=10 ** 18)
+    second = write(str(tmp_path / 'b' / 'file'), b'data', mtime=10 ** 18)
+    store.dedup(str(tmp_path / 'a'))
+    stats = store.dedup(str(tmp_path / 'b'))
+    assert stats.shared == 1
+    assert inode(first) == inode(second)
+
+
+def test_files_keep_their_own_mtime(tmp_path, store):
+    first = write(str(tmp_path / 'a' / 'file'), b'data', mtime=10 ** 18)
+    second = write(str(tmp_path / 'b' / 'file'), b'data',
+                   mtime=2 * 10 ** 18)
+    store.dedup(str(tmp_path / 'a'))
+    stats = store.dedup(str(tmp_path / 'b'))
+    assert stats.stored == 1
+    assert inode(first) != inode(second)
+    assert os.stat(first).st_mtime_ns == 10 ** 18
+    assert os.stat(second).st_mtime_ns == 2 * 10 ** 18
+
+
+def test_verify_reports_changed_mtime(tmp_path, store):
+    path = write(str(tmp_path / 'a' / 'file'), b'data', mtime=10 ** 18)
+    store.dedup(str(tmp_path / 'a'))
+    assert store.verify() == []
+    os.utime(path, ns=(3 * 10 ** 18, 3 * 10 ** 18))
+    assert len(store.verify()) == 1
+
+
+def test_dedup_counts_stored_and_shared_files(tmp_path, store):
+    write(str(tmp_path / 'a' / 'one'), b'same', mtime=10 ** 18)
+    write(str(tmp_path / 'a' / 'two'), b'same', mtime=10 ** 18)
+    write(str(tmp_path / 'a' / 'three'), b'other', mtime=10 ** 18)
+    stats = store.dedup(str(tmp_path / 'a'))
+    assert stats.files == 3
+    assert stats.stored == 2
+    assert stats.shared == 1
+    assert stats.shared_bytes == len(b'same')
+    assert len(list(store.objects())) == 2
+    assert inode(str(tmp_path / 'a' / 'one')) == \
+        inode(str(tmp_path / 'a' / 'two'))
+
+
+def test_dedup_again_hashes_nothing_new(tmp_path, store):
+    write(str(tmp_path / 'a' / 'file'), b'data', mtime=10 ** 18)
+    store.dedup(str(tmp_path / 'a'))
+    stats = store.dedup(str(tmp_path / 'a'))
+    assert stats.stored == 0
+    assert stats.shared == 1
+
+
+def test_verify_reports_changed_content(tmp_path, store):
+    path = write(str(tmp_path / 'a' / 'file'), b'data', mtime=10 ** 18)
+    store.dedup(str(tmp_path / 'a'))
+    key, = [key for key, path_, stat in store.objects()]
+    with open(path, 'r+b') as target:
+        target.write(b'DATA')
+    os.utime(path, ns=(10 ** 18, 10 ** 18))
+    assert store.verify() == [key]
+
+
+def test_gc_removes_unused_objects_only(tmp_path, store):
+    write(str(tmp_path / 'a' / 'kept'), b'kept', mtime=10 ** 18)
+    write(str(tmp_path / 'b' / 'dropped'), b'dropped', mtime=10 ** 18)
+    store.dedup(str(tmp_path / 'a'))
+    store.dedup(str(tmp_path / 'b'))
+    assert store.gc() == (0, 0)
+    os.remove(str(tmp_path / 'b' / 'dropped'))
+    assert store.gc() == (1, len(b'dropped'))
+    kept, = [path for key, path, stat in store.objects()]
+    assert inode(kept) == inode(str(tmp_path / 'a' / 'kept'))